@@ -9,6 +9,7 @@ from typing import final
 
 from croniter import croniter
 
+from ogion import config, core, retention
 from ogion.models.backup_target_models import TargetModel
 
 log = logging.getLogger(__name__)
@@ -41,6 +42,18 @@ class BaseBackupTarget(ABC):
     def min_retention_days(self) -> int:
         return self.target_model.min_retention_days
 
+    @property
+    def keep_policy(self) -> retention.KeepPolicy:
+        return retention.KeepPolicy.from_target_model(self.target_model)
+
+    @property
+    def process_limits(self) -> core.ProcessLimits:
+        return core.ProcessLimits.from_target_model(self.target_model)
+
+    @property
+    def scratch_folder(self) -> Path:
+        return config.scratch_folder_path(self.target_model.scratch_dir)
+
     @final
     def _get_next_backup_time(self) -> datetime:
         now = datetime.now(UTC)
@@ -73,3 +86,7 @@ class BaseBackupTarget(ABC):
     @abstractmethod
     def restore(self, path: str) -> None:  # pragma: no cover
         pass
+
+    def estimated_size(self) -> int | None:
+        """Approximate size in bytes of backup file before compression."""
+        return None
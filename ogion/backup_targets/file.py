@@ -25,14 +25,20 @@ class File(BaseBackupTarget):
         out_file = core.get_new_backup_path(self.env_name, escaped_filename)
 
         log.debug("start copy of %s to %s", self.target_model.abs_path, out_file)
-        shutil.copy2(self.target_model.abs_path, out_file)
+        core.copy_file(self.target_model.abs_path, out_file)
+        shutil.copystat(self.target_model.abs_path, out_file)
         log.debug("finished ln, output: %s", out_file)
         return out_file
 
+    @override
+    def estimated_size(self) -> int | None:
+        return self.target_model.abs_path.stat().st_size
+
     @override
     def restore(self, path: str) -> None:
         log.info("start restore of %s", path)
         log.debug("start copy of %s to %s", path, self.target_model.abs_path)
-        shutil.copy2(path, self.target_model.abs_path)
+        core.copy_file(Path(path), self.target_model.abs_path)
+        shutil.copystat(path, self.target_model.abs_path)
         log.debug("finished cp to %s", self.target_model.abs_path)
         log.info("success restore of %s", path)
@@ -2,6 +2,7 @@
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
 import logging
+import os
 from pathlib import Path
 from typing import override
 
@@ -37,10 +38,21 @@ class Folder(BaseBackupTarget):
             "start tar in subprocess: %s",
             tar_args,
         )
-        core.run_subprocess(tar_args)
+        core.run_subprocess(tar_args, progress_path=out_file)
         log.debug("finished tar, output: %s", out_file)
         return out_file
 
+    @override
+    def estimated_size(self) -> int | None:
+        total = 0
+        for root, _, files in os.walk(self.target_model.abs_path):
+            for file in files:
+                try:
+                    total += os.lstat(os.path.join(root, file)).st_size
+                except OSError:
+                    continue
+        return total
+
     @override
     def restore(self, path: str) -> None:
         log.info("start restore of %s", path)
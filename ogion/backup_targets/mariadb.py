@@ -138,10 +138,28 @@ class MariaDB(BaseBackupTarget):
             self.target_model.db,
         ]
         log.debug("start mariadbdump in subprocess: %s", mariadb_dump_args)
-        core.run_subprocess(mariadb_dump_args)
+        core.run_subprocess(mariadb_dump_args, progress_path=out_file)
         log.debug("finished mariadbdump, output: %s", out_file)
         return out_file
 
+    @override
+    def estimated_size(self) -> int | None:
+        try:
+            result = core.run_subprocess(
+                [
+                    "mariadb",
+                    f"--defaults-file={self.option_file}",
+                    self.target_model.db,
+                    "--skip-column-names",
+                    "--execute=SELECT COALESCE(SUM(data_length + index_length), 0) "
+                    "FROM information_schema.tables WHERE table_schema = DATABASE();",
+                ],
+            )
+            return int(result.strip())
+        except (core.CoreSubprocessError, ValueError) as err:
+            log.warning("could not get database size of `%s`: %s", self.env_name, err)
+            return None
+
     @override
     @core.retry_on_network_errors()
     def restore(self, path: str) -> None:
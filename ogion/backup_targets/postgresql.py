@@ -148,10 +148,29 @@ class PostgreSQL(BaseBackupTarget):
             str(out_file),
         ]
         log.debug("start pg_dump in subprocess: %s", pg_dump_args)
-        core.run_subprocess(pg_dump_args)
+        core.run_subprocess(pg_dump_args, progress_path=out_file)
         log.debug("finished pg_dump, output: %s", out_file)
         return out_file
 
+    @override
+    def estimated_size(self) -> int | None:
+        try:
+            result = core.run_subprocess(
+                [
+                    "psql",
+                    "-d",
+                    self.conn_uri,
+                    "-w",
+                    "-tA",
+                    "--command",
+                    "SELECT pg_database_size(current_database());",
+                ],
+            )
+            return int(result.strip())
+        except (core.CoreSubprocessError, ValueError) as err:
+            log.warning("could not get database size of `%s`: %s", self.env_name, err)
+            return None
+
     @override
     @core.retry_on_network_errors()
     def restore(self, path: str) -> None:
@@ -0,0 +1,124 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import functools
+import logging
+import threading
+import time
+from collections.abc import Buffer, Mapping
+from datetime import UTC, datetime
+from typing import Any, BinaryIO, cast
+
+from ogion import config
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+BURST_SECS = 1
+# Global bucket limited by BANDWIDTH_LIMIT_MB_PER_SEC and BANDWIDTH_SCHEDULE
+DEFAULT_BUCKETS: Mapping[str, float | None] = {"": None}
+
+
+@functools.lru_cache(maxsize=4)
+def _schedule(schedule: str, limit_mb_per_sec: float) -> list[tuple[int, int, float]]:
+    return config.parse_bandwidth_schedule(schedule, limit_mb_per_sec)
+
+
+def current_limit(now: datetime | None = None) -> float:
+    """Bandwidth limit in bytes per second at given time, 0 means no limit."""
+    now = datetime.now(UTC) if now is None else now
+    minute = now.hour * 60 + now.minute
+    limit_mb_per_sec = config.options.BANDWIDTH_LIMIT_MB_PER_SEC
+    for start, end, window_limit_mb in _schedule(
+        config.options.BANDWIDTH_SCHEDULE, limit_mb_per_sec
+    ):
+        if start <= minute < end or (end < start and (minute >= start or minute < end)):
+            return window_limit_mb * MB
+    return limit_mb_per_sec * MB
+
+
+class BandwidthLimiter:
+    """Token buckets shared by upload and download streams of all providers.
+
+    Bytes over the limit are borrowed from future tokens and the caller sleeps
+    until they are paid back, so concurrent streams split the limit between
+    them and ogion never exceeds it for more than BURST_SECS. Default bucket
+    is limited by BANDWIDTH_LIMIT_MB_PER_SEC, named buckets by their own limit,
+    for example `max_bandwidth` of S3 provider. With backup worker processes,
+    `shared` is a proxy of one limiter in shared state process, see
+    `ogion.shared_state`.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self.shared: BandwidthLimiter = self
+
+    def borrow(self, nbytes: int, limit: float, bucket: str = "") -> float:
+        """Take `nbytes` from the bucket, returns seconds to wait for them."""
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated_at = self._buckets.get(bucket, (0, now))
+            tokens = min(tokens + (now - updated_at) * limit, limit * BURST_SECS)
+            tokens -= nbytes
+            self._buckets[bucket] = (tokens, now)
+            return -tokens / limit
+
+    def consume(
+        self, nbytes: int, buckets: Mapping[str, float | None] = DEFAULT_BUCKETS
+    ) -> None:
+        """Take bytes from all `buckets`, None limit is the current global one."""
+        if nbytes <= 0:
+            return
+        wait_secs: float = 0
+        for bucket, bucket_limit in buckets.items():
+            limit = current_limit() if bucket_limit is None else bucket_limit
+            if limit > 0:
+                wait_secs = max(wait_secs, self.shared.borrow(nbytes, limit, bucket))
+        if wait_secs > 0:
+            log.debug("bandwidth limit reached, waiting %.3fs", wait_secs)
+            time.sleep(wait_secs)
+
+
+LIMITER = BandwidthLimiter()
+
+
+class ThrottledFile:
+    """File object whose reads and writes are drawn from bandwidth limiter."""
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        limiter: BandwidthLimiter = LIMITER,
+        buckets: Mapping[str, float | None] = DEFAULT_BUCKETS,
+    ) -> None:
+        self._file = file
+        self._limiter = limiter
+        self._buckets = buckets
+
+    def _consume(self, nbytes: int) -> None:
+        self._limiter.consume(nbytes, self._buckets)
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._file.read(size)
+        self._consume(len(data))
+        return data
+
+    def readinto(self, buffer: Buffer) -> int:
+        nbytes: int = self._file.readinto(buffer)  # type: ignore[attr-defined]
+        self._consume(nbytes)
+        return nbytes
+
+    def write(self, data: Buffer) -> int:
+        self._consume(memoryview(data).nbytes)
+        return self._file.write(data)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._file, name)
+
+
+def throttle(file: BinaryIO, bucket: str = "", limit: float = 0) -> BinaryIO:
+    """Limit file by BANDWIDTH_LIMIT_MB_PER_SEC and by `limit` of `bucket`."""
+    buckets = {**DEFAULT_BUCKETS, bucket: limit} if limit > 0 else DEFAULT_BUCKETS
+    # Wrapper is passed to provider SDKs expecting regular binary file
+    return cast(BinaryIO, ThrottledFile(file, buckets=buckets))
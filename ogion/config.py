@@ -4,12 +4,14 @@
 import hashlib
 import logging
 import logging.config
+import re
 import socket
 from enum import StrEnum
 from pathlib import Path
 from typing import Literal, Self
 
-from pydantic import Field, HttpUrl, SecretStr, model_validator
+from croniter import croniter
+from pydantic import Field, HttpUrl, SecretStr, field_validator, model_validator
 from pydantic_settings import BaseSettings
 
 _log_levels = Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
@@ -19,10 +21,17 @@ CONST_DATA_FOLDER_PATH: Path = CONST_BASE_DIR / "data"
 CONST_CONFIG_FOLDER_PATH: Path = CONST_DATA_FOLDER_PATH / "_conf"
 CONST_DOWNLOADS_FOLDER_PATH: Path = CONST_DATA_FOLDER_PATH / "_downloads"
 CONST_DEBUG_FOLDER_PATH: Path = CONST_DATA_FOLDER_PATH / "_debug_upload_provider"
+CONST_INDEX_FOLDER_PATH: Path = CONST_DATA_FOLDER_PATH / "_index"
+CONST_SPOOL_FOLDER_PATH: Path = CONST_DATA_FOLDER_PATH / "_spool"
+CONST_HISTORY_DB_PATH: Path = CONST_DATA_FOLDER_PATH / "history.sqlite3"
+CONST_CGROUP_CPU_MAX_PATH: Path = Path("/sys/fs/cgroup/cpu.max")
+CONST_TMPFS_FOLDER_PATH: Path = Path("/dev/shm/ogion")
 CONST_DATA_FOLDER_PATH.mkdir(mode=0o700, parents=True, exist_ok=True)
 CONST_CONFIG_FOLDER_PATH.mkdir(mode=0o700, parents=True, exist_ok=True)
 CONST_DOWNLOADS_FOLDER_PATH.mkdir(mode=0o700, exist_ok=True)
 CONST_DEBUG_FOLDER_PATH.mkdir(mode=0o700, exist_ok=True)
+CONST_INDEX_FOLDER_PATH.mkdir(mode=0o700, exist_ok=True)
+CONST_SPOOL_FOLDER_PATH.mkdir(mode=0o700, exist_ok=True)
 
 
 try:
@@ -47,6 +56,58 @@ class BackupTargetEnum(StrEnum):
     FOLDER = "directory"
 
 
+def check_scratch_dir(scratch_dir: str) -> str:
+    if scratch_dir and scratch_dir != "tmpfs" and not Path(scratch_dir).is_absolute():
+        raise ValueError(
+            f"scratch dir `{scratch_dir}` must be empty, `tmpfs` or an absolute path"
+        )
+    return scratch_dir
+
+
+BANDWIDTH_WINDOW_PATTERN = re.compile(
+    r"^([01][0-9]|2[0-3]):([0-5][0-9])-([01][0-9]|2[0-3]|24):([0-5][0-9])"
+    r"=([0-9]+(?:\.[0-9]+)?)(%?)$"
+)
+
+
+def parse_bandwidth_schedule(
+    schedule: str, limit_mb_per_sec: float
+) -> list[tuple[int, int, float]]:
+    """Parse comma separated `HH:MM-HH:MM=LIMIT` windows of UTC day.
+
+    Limit is in MB/s or in percent of BANDWIDTH_LIMIT_MB_PER_SEC if it ends
+    with `%`, `0` means no limit. Returns start and end minute and limit.
+    """
+    windows: list[tuple[int, int, float]] = []
+    for window in filter(None, (part.strip() for part in schedule.split(","))):
+        match = BANDWIDTH_WINDOW_PATTERN.match(window)
+        if match is None:
+            raise ValueError(
+                f"bandwidth schedule window `{window}` must be HH:MM-HH:MM=LIMIT"
+            )
+        start_hour, start_minute, end_hour, end_minute, limit, percent = match.groups()
+        start = int(start_hour) * 60 + int(start_minute)
+        end = int(end_hour) * 60 + int(end_minute)
+        if start == end or end > 24 * 60:
+            raise ValueError(f"bandwidth schedule window `{window}` is empty")
+        if percent and not limit_mb_per_sec:
+            raise ValueError(
+                f"bandwidth schedule window `{window}` in percent "
+                "requires BANDWIDTH_LIMIT_MB_PER_SEC"
+            )
+        limit_mb = float(limit) * limit_mb_per_sec / 100 if percent else float(limit)
+        windows.append((start, end, limit_mb))
+    return windows
+
+
+def scratch_folder_path(scratch_dir: str) -> Path:
+    if scratch_dir == "tmpfs":
+        return CONST_TMPFS_FOLDER_PATH
+    if scratch_dir:
+        return Path(scratch_dir)
+    return CONST_DATA_FOLDER_PATH
+
+
 class Settings(BaseSettings):
     LOG_LEVEL: _log_levels = "INFO"
     BACKUP_PROVIDER: str
@@ -57,16 +118,39 @@ class Settings(BaseSettings):
         default="amd64", alias_priority=2, alias="OGION_CPU_ARCHITECTURE"
     )
     SUBPROCESS_TIMEOUT_SECS: float = Field(ge=5, le=3600 * 24, default=3600)
+    SUBPROCESS_STALL_TIMEOUT_SECS: float = Field(ge=0, le=3600 * 24, default=0)
+    SUBPROCESS_OUTPUT_LIMIT_KB: int = Field(ge=1, le=1024 * 1024, default=64)
     SIGTERM_TIMEOUT_SECS: float = Field(ge=0, le=3600 * 24, default=3600)
+    BACKUP_WORKER_PROCESSES: int = Field(ge=0, le=256, default=0)
+    BACKUP_WORKER_MAX_TASKS: int = Field(ge=1, le=10000, default=1)
+    BACKUP_DISK_SPACE_CHECK: bool = True
+    BACKUP_DISK_SPACE_WAIT_SECS: float = Field(ge=0, le=3600 * 24, default=3600)
+    BACKUP_DISK_PREALLOCATE: bool = False
+    BACKUP_SCRATCH_DIR: str = ""
+    BACKUP_DROP_PAGE_CACHE: bool = True
+    BACKUP_DIRECT_IO: bool = False
     BACKUP_MAX_NUMBER: int = Field(ge=1, le=998, default=7)
     BACKUP_MIN_RETENTION_DAYS: int = Field(ge=0, le=36600, default=3)
     BACKUP_DELETE: bool = True
+    BACKUP_LISTING_INDEX_TTL_SECS: int = Field(ge=0, le=3600 * 24 * 7, default=0)
+    UPLOAD_SPOOL_MAX_SIZE_MB: int = Field(ge=0, le=1024 * 1024 * 1024, default=0)
+    UPLOAD_SPOOL_RETRY_SECS: int = Field(ge=1, le=3600, default=60)
+    BACKUP_CLEANUP_CRON_RULE: str = ""
+    VERIFY_CRON_RULE: str = ""
+    VERIFY_WORKERS: int = Field(ge=1, le=64, default=2)
+    VERIFY_SAMPLE_DAYS: int = Field(ge=1, le=366, default=7)
+    VERIFY_AGE_SECRET_KEY: SecretStr = SecretStr("")
+    BANDWIDTH_LIMIT_MB_PER_SEC: float = Field(ge=0, le=1024 * 1024, default=0)
+    BANDWIDTH_SCHEDULE: str = ""
+    METRICS_PORT: int | None = Field(ge=1, le=65535, default=None)
+    HISTORY_RETENTION_DAYS: int = Field(ge=0, le=36600, default=90)
     DISCORD_WEBHOOK_URL: HttpUrl | None = None
     DISCORD_MAX_MSG_LEN: int = Field(ge=150, le=10000, default=1500)
     SLACK_WEBHOOK_URL: HttpUrl | None = None
     SLACK_MAX_MSG_LEN: int = Field(ge=150, le=10000, default=1500)
     LZIP_LEVEL: int = Field(ge=0, le=9, default=0)
     LZIP_THREADS: int | None = Field(ge=1, le=1024, default=None)
+    COMPRESSION_CPU_BUDGET: int | None = Field(ge=1, le=1024, default=None)
     SMTP_HOST: str = ""
     SMTP_PORT: int = 587
     SMTP_FROM_ADDR: str = ""
@@ -88,6 +172,34 @@ class Settings(BaseSettings):
     def smtp_addresses(self) -> list[str]:
         return self.SMTP_TO_ADDRS.split(",")
 
+    @field_validator("BACKUP_CLEANUP_CRON_RULE")
+    def cleanup_cron_rule_is_valid(cls, cron_rule: str) -> str:
+        if cron_rule and not croniter.is_valid(cron_rule):
+            raise ValueError(
+                f"Error in BACKUP_CLEANUP_CRON_RULE expression: `{cron_rule}` "
+                "is not valid"
+            )
+        return cron_rule
+
+    @field_validator("VERIFY_CRON_RULE")
+    def verify_cron_rule_is_valid(cls, cron_rule: str) -> str:
+        if cron_rule and not croniter.is_valid(cron_rule):
+            raise ValueError(
+                f"Error in VERIFY_CRON_RULE expression: `{cron_rule}` is not valid"
+            )
+        return cron_rule
+
+    @field_validator("BACKUP_SCRATCH_DIR")
+    def scratch_dir_is_valid(cls, scratch_dir: str) -> str:
+        return check_scratch_dir(scratch_dir)
+
+    @model_validator(mode="after")
+    def check_bandwidth_schedule(self) -> Self:
+        parse_bandwidth_schedule(
+            self.BANDWIDTH_SCHEDULE, self.BANDWIDTH_LIMIT_MB_PER_SEC
+        )
+        return self
+
     @model_validator(mode="after")
     def check_smtp_setup(self) -> Self:
         smtp_settings = [self.SMTP_HOST, self.SMTP_FROM_ADDR, self.SMTP_TO_ADDRS]
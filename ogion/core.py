@@ -1,31 +1,51 @@
 # Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
+import collections
+import errno
+import fcntl
 import getpass
+import hashlib
 import logging
+import math
+import mmap
 import os
 import re
 import secrets
 import shlex
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
 import typing
-from contextlib import nullcontext
+from collections.abc import Iterator
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
 from datetime import UTC, datetime, timedelta
 from pathlib import Path, PurePosixPath
-from typing import Any
+from typing import Any, Self, override
 
 import tenacity
+from croniter import croniter
 from pydantic import BaseModel
 
-from ogion import config
+from ogion import config, history, metrics
 from ogion.models import backup_target_models, models_mapping, upload_provider_models
 
 log = logging.getLogger(__name__)
 
 SAFE_LETTER_PATTERN = re.compile(r"[^A-Za-z0-9_]*")
 DATETIME_BACKUP_FILE_PATTERN = re.compile(r"_[0-9]{8}_[0-9]{4}_")
+BACKUP_CODEC_SUFFIXES = frozenset({".lz", ".age"})
+PIPE_READ_SIZE = 64 * 1024
+PROGRESS_CHECK_SECS = 1
+PROGRESS_LOG_SECS = 60
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+PAGE_CACHE_DROP_BYTES = 128 * 1024 * 1024
+DIRECT_IO_ALIGNMENT = 4096
 MODEL_SPLIT_EQUATION_PATTERN = re.compile(r"( (\w|\-)*\=|^(\w|\-)*\=)")
+MIRROR_PROVIDER_ENV_PREFIX = "backup_mirror_"
 
 
 class CoreSubprocessError(Exception):
@@ -69,11 +89,304 @@ def retry_on_network_errors(attempts: int = 3) -> typing.Callable:  # type: igno
     )
 
 
+class ProcessLimits(typing.NamedTuple):
+    """Scheduling and timeouts of backup subprocesses of a target.
+
+    `None` timeouts fall back to global SUBPROCESS_* settings.
+    """
+
+    nice: int = 0
+    ionice_class: str = "none"
+    cpu_affinity: str = ""
+    timeout_secs: float | None = None
+    stall_timeout_secs: float | None = None
+
+    @classmethod
+    def from_target_model(cls, target_model: backup_target_models.TargetModel) -> Self:
+        return cls(
+            nice=target_model.nice,
+            ionice_class=target_model.ionice_class,
+            cpu_affinity=target_model.cpu_affinity,
+            timeout_secs=target_model.subprocess_timeout_secs,
+            stall_timeout_secs=target_model.subprocess_stall_timeout_secs,
+        )
+
+    def command_prefix(self) -> list[str]:
+        prefix: list[str] = []
+        if self.nice:
+            prefix.extend(["nice", "-n", str(self.nice)])
+        if self.ionice_class != "none":
+            prefix.extend(["ionice", "-c", self.ionice_class])
+        if self.cpu_affinity:
+            prefix.extend(["taskset", "-c", self.cpu_affinity])
+        return prefix
+
+
+_process_limits: ContextVar[ProcessLimits] = ContextVar(
+    "ogion_process_limits", default=ProcessLimits()
+)
+
+
+@contextmanager
+def process_limits(limits: ProcessLimits) -> Iterator[ProcessLimits]:
+    token = _process_limits.set(limits)
+    try:
+        yield limits
+    finally:
+        _process_limits.reset(token)
+
+
+_scratch_folder: ContextVar[Path | None] = ContextVar(
+    "ogion_scratch_folder", default=None
+)
+
+
+@contextmanager
+def scratch_folder(path: Path) -> Iterator[Path]:
+    token = _scratch_folder.set(path)
+    try:
+        yield path
+    finally:
+        _scratch_folder.reset(token)
+
+
+def get_scratch_folder() -> Path:
+    return _scratch_folder.get() or config.CONST_DATA_FOLDER_PATH
+
+
+class CronSchedule:
+    """Cron rule in UTC of a job run by main loop, for example cleanup sweep."""
+
+    def __init__(self, cron_rule: str, job_name: str) -> None:
+        self.cron_rule = cron_rule
+        self.next_time: datetime = self._get_next_time()
+        log.info("first calculated %s will be: %s", job_name, self.next_time)
+
+    def _get_next_time(self) -> datetime:
+        cron = croniter(self.cron_rule, start_time=datetime.now(UTC))
+        next_time: datetime = cron.get_next(ret_type=datetime)
+        return next_time
+
+    def is_due(self) -> bool:
+        next_time = self._get_next_time()
+        if next_time > self.next_time:
+            self.next_time = next_time
+            return True
+        return False
+
+
+class SubprocessStalledError(subprocess.SubprocessError):
+    def __init__(self, cmd: list[str], stall_timeout: float) -> None:
+        self.cmd = cmd
+        self.stall_timeout = stall_timeout
+        self.stdout = ""
+        self.stderr = ""
+
+    @override
+    def __str__(self) -> str:
+        return f"Command '{self.cmd}' made no progress for {self.stall_timeout} seconds"
+
+
+class _ProgressWatch:
+    """Bytes written to pipes and output file or read from stdin by subprocess."""
+
+    def __init__(
+        self,
+        command: str,
+        output_path: Path | None,
+        stdin: typing.IO[bytes] | None,
+        stall_timeout: float,
+    ) -> None:
+        run = history.current_run()
+        self.labels = {
+            "target": run.target if run is not None else "",
+            "command": command,
+        }
+        self.output_path = output_path
+        self.stdin = stdin
+        self.stall_timeout = stall_timeout
+        self.pipe_chars = [0, 0]
+        self.started = self.last_check = self.last_progress = self.last_log = (
+            time.monotonic()
+        )
+        self.last_bytes = self.logged_bytes = 0
+
+    @property
+    def supervised(self) -> bool:
+        return self.output_path is not None or self.stdin is not None
+
+    def current(self) -> int:
+        total = sum(self.pipe_chars)
+        if self.output_path is not None:
+            try:
+                total += self.output_path.stat().st_size
+            except OSError:
+                pass
+        if self.stdin is not None:
+            total += os.lseek(self.stdin.fileno(), 0, os.SEEK_CUR)
+        return total
+
+    def stalled(self, now: float) -> bool:
+        if not self.supervised or now - self.last_check < PROGRESS_CHECK_SECS:
+            return False
+
+        current_bytes = self.current()
+        metrics.SUBPROCESS_THROUGHPUT.set(
+            (current_bytes - self.last_bytes) / (now - self.last_check), **self.labels
+        )
+        self.last_check = now
+        if now - self.last_log >= PROGRESS_LOG_SECS:
+            log.info(
+                "%s running for %.0fs, progress %.2f MB, %.2f MB/s",
+                self.labels["command"],
+                now - self.started,
+                current_bytes / 1024 / 1024,
+                (current_bytes - self.logged_bytes) / (now - self.last_log) / 2**20,
+            )
+            self.last_log, self.logged_bytes = now, current_bytes
+        if current_bytes != self.last_bytes:
+            self.last_bytes, self.last_progress = current_bytes, now
+            return False
+        if self.stall_timeout and now - self.last_progress >= self.stall_timeout:
+            metrics.SUBPROCESS_STALLS.inc(1, **self.labels)
+            return True
+        return False
+
+
+class _TailBuffer:
+    """Keeps only last `limit` characters of subprocess output in memory."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.chunks: collections.deque[str] = collections.deque()
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        while self.size - len(self.chunks[0]) >= self.limit:
+            dropped_chunk = self.chunks.popleft()
+            self.size -= len(dropped_chunk)
+            self.dropped += len(dropped_chunk)
+
+    def getvalue(self) -> str:
+        value = "".join(self.chunks)
+        if len(value) <= self.limit and not self.dropped:
+            return value
+        dropped = self.dropped + max(0, len(value) - self.limit)
+        return f"[{dropped} characters truncated]\n{value[-self.limit :]}"
+
+
+def _read_stream(
+    stream: typing.IO[str], output: _TailBuffer, progress: _ProgressWatch, index: int
+) -> None:
+    with stream:
+        while chunk := stream.read(PIPE_READ_SIZE):
+            output.write(chunk)
+            progress.pipe_chars[index] += len(chunk)
+
+
+def _run_process(
+    shell_args: list[str],
+    *,
+    command: str | None = None,
+    stdin: typing.IO[bytes] | None,
+    timeout: float,
+    stall_timeout: float = 0,
+    progress_path: Path | None = None,
+) -> tuple[str, str]:
+    """Run process reaping it with `os.wait4` to keep its resource usage.
+
+    When `progress_path` or `stdin` is given and `stall_timeout` is set,
+    process is also killed after `stall_timeout` seconds without progress.
+    `command` is executable run by wrappers like `nice` at start of args.
+    """
+    command = command or shell_args[0]
+    if command != shell_args[0] and shutil.which(command) is None:
+        # Wrapper would start and exit with 127 instead of failing here
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), command)
+    process = subprocess.Popen(
+        shell_args,
+        stdin=stdin,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    assert process.stdout is not None
+    assert process.stderr is not None
+    progress = _ProgressWatch(
+        command=Path(command).name,
+        output_path=progress_path,
+        stdin=stdin,
+        stall_timeout=stall_timeout,
+    )
+    output_limit = config.options.SUBPROCESS_OUTPUT_LIMIT_KB * 1024
+    stdout_buffer = _TailBuffer(limit=output_limit)
+    stderr_buffer = _TailBuffer(limit=output_limit)
+    readers = [
+        threading.Thread(
+            target=_read_stream, args=(process.stdout, stdout_buffer, progress, 0)
+        ),
+        threading.Thread(
+            target=_read_stream, args=(process.stderr, stderr_buffer, progress, 1)
+        ),
+    ]
+    for reader in readers:
+        reader.start()
+
+    deadline = time.monotonic() + timeout
+    poll_interval = 0.001
+    failure: subprocess.TimeoutExpired | SubprocessStalledError | None = None
+    while True:
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        now = time.monotonic()
+        if now >= deadline:
+            failure = subprocess.TimeoutExpired(shell_args, timeout)
+        elif progress.stalled(now):
+            failure = SubprocessStalledError(shell_args, stall_timeout)
+        if failure is not None:
+            process.kill()
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        time.sleep(min(poll_interval, deadline - now))
+        poll_interval = min(poll_interval * 2, 0.1)
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+    for reader in readers:
+        reader.join()
+    history.add_child_rusage(rusage)
+
+    stdout = stdout_buffer.getvalue()
+    stderr = stderr_buffer.getvalue()
+    if failure is not None:
+        failure.stdout = stdout
+        failure.stderr = stderr
+        raise failure
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, shell_args, output=stdout, stderr=stderr
+        )
+    return stdout, stderr
+
+
 def run_subprocess(
     shell_args: list[str],
     *,
     stdin_path: Path | None = None,
+    progress_path: Path | None = None,
 ) -> str:
+    """Run subprocess supervised by overall and stall timeouts.
+
+    Progress is measured as bytes written to `progress_path` and pipes or
+    read from `stdin_path`, subprocesses without any of them are only
+    limited by overall timeout.
+    """
+    limits = _process_limits.get()
+    command = shell_args[0]
+    shell_args = [*limits.command_prefix(), *shell_args]
     display_args = shlex.join(str(arg) for arg in shell_args)
 
     log.debug("run_subprocess running: '%s'", display_args)
@@ -81,39 +394,42 @@ def run_subprocess(
         with (
             open(stdin_path, "rb") if stdin_path is not None else nullcontext(None)
         ) as stdin_file:
-            p = subprocess.run(
+            stdout, stderr = _run_process(
                 shell_args,
-                capture_output=True,
-                text=True,
+                command=command,
                 stdin=stdin_file,
-                timeout=config.options.SUBPROCESS_TIMEOUT_SECS,
-                check=True,
+                timeout=limits.timeout_secs or config.options.SUBPROCESS_TIMEOUT_SECS,
+                stall_timeout=(
+                    limits.stall_timeout_secs
+                    if limits.stall_timeout_secs is not None
+                    else config.options.SUBPROCESS_STALL_TIMEOUT_SECS
+                ),
+                progress_path=progress_path,
             )
     except FileNotFoundError as process_error:
         log.error("run_subprocess executable not found: %s", process_error)
         raise CoreSubprocessError(str(process_error)) from process_error
     except subprocess.TimeoutExpired as process_error:
-        stdout_raw = process_error.stdout
-        stderr_raw = process_error.stderr
-        stdout: str | None = (
-            stdout_raw.decode(errors="replace")
-            if isinstance(stdout_raw, bytes)
-            else stdout_raw
-        )
-        stderr: str | None = (
-            stderr_raw.decode(errors="replace")
-            if isinstance(stderr_raw, bytes)
-            else stderr_raw
-        )
-
         log.error("run_subprocess timed out after %s seconds", process_error.timeout)
-        log.error("run_subprocess stdout: %s", stdout)
-        log.error("run_subprocess stderr: %s", stderr)
+        log.error("run_subprocess stdout: %s", process_error.stdout)
+        log.error("run_subprocess stderr: %s", process_error.stderr)
         raise CoreSubprocessError(
-            stderr
-            or stdout
+            process_error.stderr
+            or process_error.stdout
             or f"Command timed out after {process_error.timeout} seconds"
         ) from process_error
+    except SubprocessStalledError as process_error:
+        log.error(
+            "run_subprocess made no progress for %s seconds",
+            process_error.stall_timeout,
+        )
+        log.error("run_subprocess stdout: %s", process_error.stdout)
+        log.error("run_subprocess stderr: %s", process_error.stderr)
+        raise CoreSubprocessError(
+            process_error.stderr
+            or process_error.stdout
+            or f"Command made no progress for {process_error.stall_timeout} seconds"
+        ) from process_error
     except subprocess.CalledProcessError as process_error:
         log.error("run_subprocess failed with status %s", process_error.returncode)
         log.error("run_subprocess stdout: %s", process_error.stdout)
@@ -122,10 +438,10 @@ def run_subprocess(
             process_error.stderr or process_error.stdout
         ) from process_error
 
-    log.debug("run_subprocess finished with status %s", p.returncode)
-    log.debug("run_subprocess stdout: %s", p.stdout)
-    log.debug("run_subprocess stderr: %s", p.stderr)
-    return p.stdout
+    log.debug("run_subprocess finished with status 0")
+    log.debug("run_subprocess stdout: %s", stdout)
+    log.debug("run_subprocess stderr: %s", stderr)
+    return stdout
 
 
 def remove_path(path: Path) -> None:
@@ -135,8 +451,96 @@ def remove_path(path: Path) -> None:
         pass
 
 
+def _drop_page_cache(fd: int) -> None:
+    # Dirty pages cannot be dropped, they are written out first
+    os.fdatasync(fd)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def drop_page_cache(path: Path) -> None:
+    """Evict pages of file from page cache, so they do not push out hot pages
+    of database running on the same host."""
+    if not config.options.BACKUP_DROP_PAGE_CACHE:
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            _drop_page_cache(fd)
+        finally:
+            os.close(fd)
+    except OSError as err:
+        log.debug("could not drop page cache of %s: %s", path, err)
+
+
+def _write_all(fd: int, data: memoryview) -> None:
+    while data:
+        data = data[os.write(fd, data) :]
+
+
+def _copy_file_direct(src: Path, dst: Path, hash_obj: Any) -> None:
+    # O_DIRECT needs aligned buffer and lengths, anonymous mmap is page aligned,
+    # O_DIRECT is cleared before writing last unaligned chunk
+    src_fd = os.open(src, os.O_RDONLY | os.O_DIRECT)
+    try:
+        dst_fd = os.open(
+            dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o666
+        )
+        try:
+            with mmap.mmap(-1, COPY_CHUNK_SIZE) as buffer:
+                while read := os.readv(src_fd, [buffer]):
+                    if read % DIRECT_IO_ALIGNMENT:
+                        flags = fcntl.fcntl(dst_fd, fcntl.F_GETFL)
+                        fcntl.fcntl(dst_fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+                    _write_all(dst_fd, memoryview(buffer)[:read])
+                    if hash_obj is not None:
+                        hash_obj.update(memoryview(buffer)[:read])
+            os.fdatasync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def copy_file(src: Path, dst: Path, hash_name: str | None = None) -> str | None:
+    """Sequential copy of src to dst, keeping page cache clean.
+
+    Pages of both files are dropped every PAGE_CACHE_DROP_BYTES when
+    BACKUP_DROP_PAGE_CACHE is enabled, or bypassed completely with
+    BACKUP_DIRECT_IO where filesystem supports O_DIRECT. Returns hex digest
+    of copied bytes when hash_name, for example `sha256`, is given.
+    """
+    if config.options.BACKUP_DIRECT_IO:
+        hash_obj = hashlib.new(hash_name) if hash_name else None
+        try:
+            _copy_file_direct(src, dst, hash_obj)
+            return hash_obj.hexdigest() if hash_obj else None
+        except OSError as err:
+            log.debug("direct io copy of %s failed, fallback: %s", src, err)
+
+    hash_obj = hashlib.new(hash_name) if hash_name else None
+    drop_pages = config.options.BACKUP_DROP_PAGE_CACHE
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        os.posix_fadvise(src_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        not_dropped = 0
+        while chunk := src_file.read(COPY_CHUNK_SIZE):
+            dst_file.write(chunk)
+            if hash_obj is not None:
+                hash_obj.update(chunk)
+            not_dropped += len(chunk)
+            if drop_pages and not_dropped >= PAGE_CACHE_DROP_BYTES:
+                dst_file.flush()
+                _drop_page_cache(dst_file.fileno())
+                os.posix_fadvise(src_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                not_dropped = 0
+        dst_file.flush()
+        if drop_pages:
+            _drop_page_cache(dst_file.fileno())
+            os.posix_fadvise(src_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return hash_obj.hexdigest() if hash_obj else None
+
+
 def get_new_backup_path(env_name: str, name: str) -> Path:
-    base_dir_path = config.CONST_DATA_FOLDER_PATH / env_name
+    base_dir_path = get_scratch_folder() / env_name
     base_dir_path.mkdir(mode=0o700, exist_ok=True, parents=True)
     new_file = (
         f"{env_name}_"
@@ -147,9 +551,12 @@ def get_new_backup_path(env_name: str, name: str) -> Path:
     return base_dir_path / new_file
 
 
+def size_mb(size_bytes: int) -> str:
+    return f"{round(size_bytes / 1024 / 1024, 2)} MB"
+
+
 def size(path: Path) -> str:
-    file_size = round(path.stat().st_size / 1024 / 1024, 2)
-    return f"{file_size} MB"
+    return size_mb(path.stat().st_size)
 
 
 def get_safe_download_path(path: str) -> Path:
@@ -172,19 +579,119 @@ def get_safe_debug_download_paths(path: str) -> tuple[Path, Path]:
     return source, get_safe_download_path(path.removeprefix("/"))
 
 
+def cpu_budget() -> int:
+    """Number of CPUs usable by ogion, limited by cgroup v2 `cpu.max` quota."""
+    cpus = os.process_cpu_count() or 1
+    try:
+        quota, period = config.CONST_CGROUP_CPU_MAX_PATH.read_text().split()
+        if quota == "max":
+            return cpus
+        return max(1, min(cpus, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError) as err:
+        log.debug("using %s cpus, cannot read cgroup cpu.max: %s", cpus, err)
+        return cpus
+
+
+class CpuTokenAllocator:
+    """Fair share of CPU tokens (plzip threads) among concurrent jobs.
+
+    Jobs are served in arrival order, each gets the budget divided by the
+    number of running and waiting jobs, capped by tokens that are free right
+    now. When no token is free, job waits until a running job finishes, so
+    the sum of threads never exceeds the budget.
+
+    With backup worker processes, `shared` is a proxy of one allocator in
+    shared state process, see `ogion.shared_state`.
+    """
+
+    def __init__(self, budget: typing.Callable[[], int]) -> None:
+        self._budget = budget
+        self._condition = threading.Condition()
+        self._queue: collections.deque[object] = collections.deque()
+        self._allocated = 0
+        self._running = 0
+        self.shared: CpuTokenAllocator = self
+
+    def take(self) -> int:
+        ticket = object()
+        with self._condition:
+            self._queue.append(ticket)
+            if self._queue[0] is not ticket or self._allocated >= self._budget():
+                log.info("waiting for free cpu tokens, %s jobs running", self._running)
+            while self._queue[0] is not ticket or self._allocated >= self._budget():
+                self._condition.wait()
+            self._queue.popleft()
+            self._running += 1
+            budget = self._budget()
+            share = max(1, budget // (self._running + len(self._queue)))
+            tokens = max(1, min(share, budget - self._allocated))
+            self._allocated += tokens
+            self._condition.notify_all()
+        return tokens
+
+    def give_back(self, tokens: int) -> None:
+        with self._condition:
+            self._allocated -= tokens
+            self._running -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def acquire(self) -> Iterator[int]:
+        tokens = self.shared.take()
+        try:
+            yield tokens
+        finally:
+            self.shared.give_back(tokens)
+
+
+def compression_cpu_budget() -> int:
+    return config.options.COMPRESSION_CPU_BUDGET or cpu_budget()
+
+
+CPU_TOKENS = CpuTokenAllocator(compression_cpu_budget)
+
+
+@contextmanager
+def lzip_threads() -> Iterator[int]:
+    if config.options.LZIP_THREADS:
+        yield config.options.LZIP_THREADS
+        return
+    with CPU_TOKENS.acquire() as tokens:
+        yield tokens
+
+
 def run_lzip_compression(backup_file: Path) -> Path:
     log.info("start lzip compression on %s: %s", backup_file, size(backup_file))
     out = Path(f"{backup_file}.lz")
 
-    args = ["plzip", f"-{config.options.LZIP_LEVEL}"]
-    if config.options.LZIP_THREADS:
-        args.extend(["-n", str(config.options.LZIP_THREADS)])
-    args.extend(["-o", str(out), str(backup_file)])
-
-    run_subprocess(args)
+    env_name = backup_file.parent.name
+    with (
+        metrics.StageTimer(env_name, metrics.STAGE.COMPRESS),
+        lzip_threads() as threads,
+    ):
+        run_subprocess(
+            [
+                "plzip",
+                f"-{config.options.LZIP_LEVEL}",
+                "-n",
+                str(threads),
+                "-o",
+                str(out),
+                str(backup_file),
+            ],
+            progress_path=out,
+        )
 
     log.info("created compressed file %s: %s", out, size(out))
 
+    raw_bytes = backup_file.stat().st_size
+    compressed_bytes = out.stat().st_size
+    metrics.RAW_BYTES.inc(raw_bytes, target=env_name)
+    metrics.COMPRESSED_BYTES.inc(compressed_bytes, target=env_name)
+    history.add_bytes(raw=raw_bytes, compressed=compressed_bytes)
+    if compressed_bytes:
+        metrics.COMPRESSION_RATIO.set(raw_bytes / compressed_bytes, target=env_name)
+
     return out
 
 
@@ -199,12 +706,11 @@ def run_lzip_decrypt(backup_file: Path) -> Path:
     )
     out = Path(str(backup_file).removesuffix(".lz"))
 
-    args = ["plzip", "-d"]
-    if config.options.LZIP_THREADS:
-        args.extend(["-n", str(config.options.LZIP_THREADS)])
-    args.extend(["-o", str(out), str(backup_file)])
-
-    run_subprocess(args)
+    with lzip_threads() as threads:
+        run_subprocess(
+            ["plzip", "-d", "-n", str(threads), "-o", str(out), str(backup_file)],
+            progress_path=out,
+        )
 
     log.info("created decompressed file %s: %s", out, size(out))
 
@@ -236,7 +742,8 @@ def run_decrypt_age_archive(backup_file: Path) -> Path:
                 "-i",
                 identity_file.name,
                 str(backup_file),
-            ]
+            ],
+            progress_path=out,
         )
         log.info("finished age archive decrypt")
 
@@ -254,16 +761,18 @@ def run_create_age_archive(backup_file: Path) -> Path:
 
     recipients = config.options.age_recipients_file
 
-    run_subprocess(
-        [
-            "age",
-            "-R",
-            str(recipients),
-            "-o",
-            str(out_file),
-            str(backup_file),
-        ]
-    )
+    with metrics.StageTimer(backup_file.parent.name, metrics.STAGE.ENCRYPT):
+        run_subprocess(
+            [
+                "age",
+                "-R",
+                str(recipients),
+                "-o",
+                str(out_file),
+                str(backup_file),
+            ],
+            progress_path=out_file,
+        )
     log.info("finished age archive creating")
 
     remove_path(backup_file)
@@ -340,26 +849,40 @@ def create_target_models() -> list[backup_target_models.TargetModel]:
     return targets
 
 
-def create_provider_model() -> upload_provider_models.ProviderModel:
+def _validate_provider_model(
+    env_name: str, env_value: str
+) -> upload_provider_models.ProviderModel:
     provider_map = models_mapping.get_provider_map()
 
-    log.info("start validating BACKUP_PROVIDER environment variable")
-
     base_provider = _validate_model(
-        "backup_provider",
-        config.options.BACKUP_PROVIDER,
+        env_name,
+        env_value,
         upload_provider_models.ProviderModel,
     )
     target_model_cls = provider_map[base_provider.name]
-    return _validate_model(
-        "backup_provider", config.options.BACKUP_PROVIDER, target_model_cls
-    )
+    return _validate_model(env_name, env_value, target_model_cls)
 
 
-def file_before_retention_period_ends(
-    backup_name: str, min_retention_days: int
-) -> bool:
-    now = datetime.now(UTC)
+def create_provider_model() -> upload_provider_models.ProviderModel:
+    log.info("start validating BACKUP_PROVIDER environment variable")
+
+    return _validate_provider_model("backup_provider", config.options.BACKUP_PROVIDER)
+
+
+def create_mirror_provider_models() -> dict[str, upload_provider_models.ProviderModel]:
+    mirrors: dict[str, upload_provider_models.ProviderModel] = {}
+    for env_name, env_value in sorted(os.environ.items()):
+        env_name_lowercase = env_name.lower()
+        if not env_name_lowercase.startswith(MIRROR_PROVIDER_ENV_PREFIX):
+            continue
+        mirrors[env_name_lowercase] = _validate_provider_model(
+            env_name_lowercase, env_value
+        )
+
+    return mirrors
+
+
+def get_backup_datetime(backup_name: str) -> datetime:
     file_name = PurePosixPath(backup_name).name
     matches = list(DATETIME_BACKUP_FILE_PATTERN.finditer(file_name))
 
@@ -370,9 +893,78 @@ def file_before_retention_period_ends(
         )
     datetime_str = matches[0].group(0)
     backup_datetime = datetime.strptime(datetime_str, "_%Y%m%d_%H%M_")
-    backup_datetime = backup_datetime.replace(tzinfo=UTC)
+    return backup_datetime.replace(tzinfo=UTC)
+
+
+def before_retention_period_ends(
+    backup_datetime: datetime, min_retention_days: int
+) -> bool:
+    now = datetime.now(UTC)
     delete_not_before = backup_datetime + timedelta(days=min_retention_days)
 
     if now < delete_not_before:
         return True
     return False
+
+
+def file_before_retention_period_ends(
+    backup_name: str, min_retention_days: int
+) -> bool:
+    return before_retention_period_ends(
+        get_backup_datetime(backup_name), min_retention_days=min_retention_days
+    )
+
+
+class BackupEntry(typing.NamedTuple):
+    """Backup stored in upload provider, parsed once from its listing."""
+
+    key: str
+    timestamp: datetime
+    target: str
+    codec: str
+    size: int | None = None
+    etag: str | None = None
+    sha256: str | None = None
+
+    @classmethod
+    def from_key(
+        cls,
+        key: str,
+        size: int | None = None,
+        etag: str | None = None,
+        sha256: str | None = None,
+    ) -> typing.Self:
+        file_name = PurePosixPath(key).name
+        codec: list[str] = []
+        for suffix in reversed(PurePosixPath(file_name).suffixes):
+            if suffix not in BACKUP_CODEC_SUFFIXES:
+                break
+            codec.insert(0, suffix.removeprefix("."))
+        return cls(
+            key=key,
+            timestamp=get_backup_datetime(file_name),
+            target=PurePosixPath(key).parent.name,
+            codec=".".join(codec),
+            size=size,
+            etag=etag,
+            sha256=sha256,
+        )
+
+
+def backup_entries(
+    objects: typing.Iterable[tuple[str, int | None, str | None, str | None]],
+) -> list[BackupEntry]:
+    """Parse `(key, size, etag, sha256)` listing, sorted from newest to oldest."""
+    entries: list[BackupEntry] = []
+    for key, size, etag, sha256 in objects:
+        try:
+            entries.append(
+                BackupEntry.from_key(key, size=size, etag=etag, sha256=sha256)
+            )
+        except ValueError as err:
+            log.warning("skipping unexpected object in backups listing: %s", err)
+    return sort_backup_entries(entries)
+
+
+def sort_backup_entries(entries: typing.Iterable[BackupEntry]) -> list[BackupEntry]:
+    return sorted(entries, key=lambda entry: (entry.timestamp, entry.key), reverse=True)
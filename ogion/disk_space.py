@@ -0,0 +1,222 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import collections
+import contextlib
+import functools
+import logging
+import math
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+from types import TracebackType
+from typing import NamedTuple, Self
+
+from ogion import config, core, history
+from ogion.backup_targets.base_target import BaseBackupTarget
+
+log = logging.getLogger(__name__)
+
+SAFETY_MARGIN = 1.2
+WAIT_CHECK_SECS = 30
+
+
+class NotEnoughDiskSpaceError(Exception):
+    pass
+
+
+class BackupSizePrediction(NamedTuple):
+    raw_bytes: int
+    compression_ratio: float
+
+    @property
+    def peak_bytes(self) -> int:
+        # Until upload finishes, backup file, its .lz and .lz.age are all on disk
+        return math.ceil(
+            self.raw_bytes * (1 + 2 * self.compression_ratio) * SAFETY_MARGIN
+        )
+
+
+def predict_backup_size(target: BaseBackupTarget) -> BackupSizePrediction | None:
+    """Size from last successful backup in history or from target itself."""
+    try:
+        last_sizes = history.last_backup_sizes(target.env_name)
+    except sqlite3.Error as err:
+        log.warning("could not read run history of `%s`: %s", target.env_name, err)
+        last_sizes = None
+
+    if last_sizes is not None:
+        raw_bytes, compressed_bytes = last_sizes
+        return BackupSizePrediction(
+            raw_bytes=raw_bytes,
+            compression_ratio=min(1, compressed_bytes / raw_bytes),
+        )
+
+    estimated_size = target.estimated_size()
+    if estimated_size is None:
+        return None
+    return BackupSizePrediction(raw_bytes=estimated_size, compression_ratio=1)
+
+
+def written_bytes(folder: Path) -> int:
+    """Size of files in folder, missing folder is empty."""
+    total = 0
+    for root, _, files in folder.walk():
+        for name in files:
+            with contextlib.suppress(FileNotFoundError):
+                total += (root / name).lstat().st_size
+    return total
+
+
+class TargetReservation(NamedTuple):
+    size: int
+    # Bytes already in scratch folder of target when space was reserved
+    written_before: int
+
+
+class DiskReservation:
+    def __init__(self, release: Callable[[int], None], size: int) -> None:
+        self._release = release
+        self.size = size
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_traceback: TracebackType | None,
+    ) -> None:
+        self._release(self.size)
+
+
+class DiskAdmission:
+    """Admits backups only when predicted peak size fits on scratch folder disk.
+
+    Space of running backups is reserved per scratch folder, backups that do
+    not fit wait for them to finish up to BACKUP_DISK_SPACE_WAIT_SECS and are
+    rejected after. Bytes running backups have written to their target scratch
+    folder are already missing from free space, so only the rest of their
+    reservations is subtracted. With backup worker processes, `shared` is a proxy of one
+    admission in shared state process, see `ogion.shared_state`.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._reserved: collections.defaultdict[Path, dict[str, TargetReservation]] = (
+            collections.defaultdict(dict)
+        )
+        self.shared: DiskAdmission = self
+
+    def free_bytes(self, folder: Path) -> int:
+        folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+        return shutil.disk_usage(folder).free
+
+    def _available_bytes(self, folder: Path) -> int:
+        unwritten = sum(
+            max(
+                0,
+                reservation.size
+                - (written_bytes(folder / env_name) - reservation.written_before),
+            )
+            for env_name, reservation in self._reserved[folder].items()
+        )
+        return self.free_bytes(folder) - unwritten
+
+    def reserve(
+        self, folder: Path, needed: int, env_name: str, wait_secs: float
+    ) -> None:
+        deadline = time.monotonic() + wait_secs
+        with self._condition:
+            while (available := self._available_bytes(folder)) < needed:
+                remaining = deadline - time.monotonic()
+                if not self._reserved[folder] or remaining <= 0:
+                    raise NotEnoughDiskSpaceError(
+                        f"backup of `{env_name}` needs {core.size_mb(needed)} "
+                        f"of disk space, but only {core.size_mb(available)} is "
+                        f"available in {folder}"
+                    )
+                log.info(
+                    "waiting for disk space for backup of `%s`, needs %s, %s free",
+                    env_name,
+                    core.size_mb(needed),
+                    core.size_mb(available),
+                )
+                self._condition.wait(timeout=min(remaining, WAIT_CHECK_SECS))
+            reservation = self._reserved[folder].get(env_name)
+            self._reserved[folder][env_name] = (
+                TargetReservation(needed, written_bytes(folder / env_name))
+                if reservation is None
+                else reservation._replace(size=reservation.size + needed)
+            )
+
+    def admit(self, target: BaseBackupTarget) -> DiskReservation:
+        folder = target.scratch_folder
+        release = functools.partial(self.shared.release, folder, target.env_name)
+        if not config.options.BACKUP_DISK_SPACE_CHECK:
+            return DiskReservation(release, 0)
+
+        prediction = predict_backup_size(target)
+        if prediction is None:
+            log.info("unknown backup size of `%s`, skip disk check", target.env_name)
+            return DiskReservation(release, 0)
+
+        needed = prediction.peak_bytes
+        self.shared.reserve(
+            folder,
+            needed,
+            target.env_name,
+            config.options.BACKUP_DISK_SPACE_WAIT_SECS,
+        )
+
+        if config.options.BACKUP_DISK_PREALLOCATE:
+            try:
+                with core.scratch_folder(folder):
+                    self._preallocate(target.env_name, needed)
+            except OSError as err:
+                release(needed)
+                raise NotEnoughDiskSpaceError(
+                    f"could not preallocate {core.size_mb(needed)} for backup "
+                    f"of `{target.env_name}`: {err}"
+                ) from err
+
+        log.info(
+            "reserved %s of disk space for backup of `%s`",
+            core.size_mb(needed),
+            target.env_name,
+        )
+        return DiskReservation(release, needed)
+
+    def _preallocate(self, env_name: str, size: int) -> None:
+        # Filesystems with quotas or thin provisioning may report more free
+        # space than can be written, allocating it for real catches that early
+        path = core.get_new_backup_path(env_name, "disk_reservation")
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                os.posix_fallocate(fd, 0, size)
+            finally:
+                os.close(fd)
+        finally:
+            core.remove_path(path)
+
+    def release(self, folder: Path, env_name: str, size: int) -> None:
+        if not size:
+            return
+        with self._condition:
+            reservation = self._reserved[folder][env_name]
+            if reservation.size > size:
+                self._reserved[folder][env_name] = reservation._replace(
+                    size=reservation.size - size
+                )
+            else:
+                del self._reserved[folder][env_name]
+            self._condition.notify_all()
+
+
+ADMISSION = DiskAdmission()
@@ -0,0 +1,287 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import logging
+import resource
+import sqlite3
+import statistics
+import time
+from collections.abc import Iterator
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from ogion import config
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    target TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT NOT NULL,
+    raw_bytes INTEGER NOT NULL,
+    compressed_bytes INTEGER NOT NULL,
+    uploaded_bytes INTEGER NOT NULL,
+    child_cpu_seconds REAL NOT NULL,
+    child_max_rss_kb INTEGER NOT NULL,
+    child_read_blocks INTEGER NOT NULL,
+    child_write_blocks INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_target_started_at ON runs (target, started_at);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    cpu_seconds REAL NOT NULL,
+    failed INTEGER NOT NULL,
+    max_rss_kb INTEGER NOT NULL,
+    read_blocks INTEGER NOT NULL,
+    write_blocks INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stages_run_id ON stages (run_id);
+"""
+
+
+@dataclass
+class ChildUsage:
+    """Resource usage of child processes reaped with `os.wait4`."""
+
+    cpu_seconds: float = 0
+    max_rss_kb: int = 0
+    read_blocks: int = 0
+    write_blocks: int = 0
+
+    def add(self, rusage: resource.struct_rusage) -> None:
+        self.cpu_seconds += rusage.ru_utime + rusage.ru_stime
+        self.max_rss_kb = max(self.max_rss_kb, rusage.ru_maxrss)
+        self.read_blocks += rusage.ru_inblock
+        self.write_blocks += rusage.ru_oublock
+
+
+@dataclass
+class StageRecord:
+    stage: str
+    started_at: float
+    finished_at: float
+    cpu_seconds: float
+    failed: bool
+    max_rss_kb: int = 0
+    read_blocks: int = 0
+    write_blocks: int = 0
+
+
+@dataclass
+class RunRecord:
+    target: str
+    started_at: float = field(default_factory=time.time)
+    finished_at: float = 0
+    status: str = "running"
+    error: str = ""
+    raw_bytes: int = 0
+    compressed_bytes: int = 0
+    uploaded_bytes: int = 0
+    child_usage: ChildUsage = field(default_factory=ChildUsage)
+    stages: list[StageRecord] = field(default_factory=list)
+    open_stages: list[ChildUsage] = field(default_factory=list, repr=False)
+
+
+_current_run: ContextVar[RunRecord | None] = ContextVar(
+    "ogion_history_current_run", default=None
+)
+
+
+def current_run() -> RunRecord | None:
+    return _current_run.get()
+
+
+def add_child_rusage(rusage: resource.struct_rusage) -> None:
+    run = current_run()
+    if run is None:
+        return
+    run.child_usage.add(rusage)
+    for usage in run.open_stages:
+        usage.add(rusage)
+
+
+def open_stage_usage() -> ChildUsage:
+    usage = ChildUsage()
+    run = current_run()
+    if run is not None:
+        run.open_stages.append(usage)
+    return usage
+
+
+def close_stage_usage(usage: ChildUsage) -> None:
+    run = current_run()
+    if run is not None and usage in run.open_stages:
+        run.open_stages.remove(usage)
+
+
+def add_bytes(raw: int = 0, compressed: int = 0, uploaded: int = 0) -> None:
+    run = current_run()
+    if run is None:
+        return
+    run.raw_bytes += raw
+    run.compressed_bytes += compressed
+    run.uploaded_bytes += uploaded
+
+
+def add_stage(stage: StageRecord) -> None:
+    run = current_run()
+    if run is None:
+        return
+    run.stages.append(stage)
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(config.CONST_HISTORY_DB_PATH, timeout=30)
+    conn.executescript(SCHEMA)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def save_run(run: RunRecord) -> None:
+    retention_days = config.options.HISTORY_RETENTION_DAYS
+    with closing(_connect()) as conn, conn:
+        cursor = conn.execute(
+            "INSERT INTO runs (target, started_at, finished_at, status, error, "
+            "raw_bytes, compressed_bytes, uploaded_bytes, child_cpu_seconds, "
+            "child_max_rss_kb, child_read_blocks, child_write_blocks) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                run.target,
+                run.started_at,
+                run.finished_at,
+                run.status,
+                run.error,
+                run.raw_bytes,
+                run.compressed_bytes,
+                run.uploaded_bytes,
+                run.child_usage.cpu_seconds,
+                run.child_usage.max_rss_kb,
+                run.child_usage.read_blocks,
+                run.child_usage.write_blocks,
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO stages (run_id, stage, started_at, finished_at, "
+            "cpu_seconds, failed, max_rss_kb, read_blocks, write_blocks) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    cursor.lastrowid,
+                    stage.stage,
+                    stage.started_at,
+                    stage.finished_at,
+                    stage.cpu_seconds,
+                    stage.failed,
+                    stage.max_rss_kb,
+                    stage.read_blocks,
+                    stage.write_blocks,
+                )
+                for stage in run.stages
+            ],
+        )
+        conn.execute(
+            "DELETE FROM runs WHERE started_at < ?",
+            (time.time() - retention_days * 24 * 3600,),
+        )
+
+
+@contextmanager
+def record_run(target: str) -> Iterator[RunRecord]:
+    run = RunRecord(target=target)
+    token = _current_run.set(run)
+    try:
+        yield run
+        run.status = "success"
+    except BaseException as err:
+        run.status = "failed"
+        run.error = f"{type(err).__name__}: {err}"
+        raise
+    finally:
+        run.finished_at = time.time()
+        _current_run.reset(token)
+        if config.options.HISTORY_RETENTION_DAYS:
+            try:
+                save_run(run)
+            except sqlite3.Error as err:
+                log.warning("could not save run history of `%s`: %s", target, err)
+
+
+def last_backup_sizes(target: str) -> tuple[int, int] | None:
+    """Raw and compressed size of last successful backup of target."""
+    if not config.CONST_HISTORY_DB_PATH.exists():
+        return None
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT raw_bytes, compressed_bytes FROM runs WHERE target = ? "
+            "AND status = 'success' AND raw_bytes > 0 "
+            "ORDER BY started_at DESC LIMIT 1",
+            (target,),
+        ).fetchone()
+    return (row[0], row[1]) if row is not None else None
+
+
+@dataclass
+class StageStats:
+    target: str
+    stage: str
+    runs: int
+    failed: int
+    p50_seconds: float
+    p95_seconds: float
+    p50_cpu_seconds: float
+    p95_cpu_seconds: float
+
+
+def _percentile(values: list[float], percent: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def stage_stats(target: str | None = None) -> list[StageStats]:
+    if not config.CONST_HISTORY_DB_PATH.exists():
+        return []
+    query = (
+        "SELECT runs.target, stages.stage, stages.finished_at - stages.started_at, "
+        "stages.cpu_seconds, stages.failed FROM stages "
+        "JOIN runs ON runs.id = stages.run_id"
+    )
+    params: tuple[str, ...] = ()
+    if target is not None:
+        query += " WHERE runs.target = ?"
+        params = (target,)
+
+    durations: dict[tuple[str, str], list[tuple[float, float, int]]] = {}
+    with closing(_connect()) as conn:
+        for row_target, stage, duration, cpu_seconds, failed in conn.execute(
+            query, params
+        ):
+            durations.setdefault((row_target, stage), []).append(
+                (duration, cpu_seconds, failed)
+            )
+
+    stats: list[StageStats] = []
+    for (row_target, stage), rows in sorted(durations.items()):
+        seconds = [row[0] for row in rows]
+        cpu = [row[1] for row in rows]
+        stats.append(
+            StageStats(
+                target=row_target,
+                stage=stage,
+                runs=len(rows),
+                failed=sum(row[2] for row in rows),
+                p50_seconds=_percentile(seconds, 50),
+                p95_seconds=_percentile(seconds, 95),
+                p50_cpu_seconds=_percentile(cpu, 50),
+                p95_cpu_seconds=_percentile(cpu, 95),
+            )
+        )
+    return stats
@@ -7,18 +7,29 @@
 import argparse
 import functools
 import logging
+import multiprocessing
 import shutil
 import signal
 import sys
 import threading
 import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait
 from dataclasses import dataclass
+from http.server import ThreadingHTTPServer
 from types import FrameType
 from typing import NoReturn
 
 import argcomplete
 
-from ogion import config, core
+from ogion import (
+    config,
+    core,
+    disk_space,
+    history,
+    metrics,
+    shared_state,
+    verify,
+)
 from ogion.backup_targets import (
     base_target,
     targets_mapping,
@@ -30,8 +41,12 @@ from ogion.notifications.notifications_context import (
 from ogion.upload_providers import (
     base_provider,
     providers_mapping,
+    spool,
 )
 
+CLEANUP_SWEEP_TARGET = "cleanup_sweep"
+UPLOAD_SPOOL_THREAD = "upload_spool"
+VERIFY_THREAD = "verify_backups"
 exit_event = threading.Event()
 log = logging.getLogger(__name__)
 
@@ -59,6 +74,18 @@ def backup_provider() -> base_provider.BaseUploadProvider:
         "success initializing provider: `%s`",
         provider_model.name,
     )
+
+    namespaces = {res_backup_provider.listing_index.namespace}
+    for env_name, mirror_model in core.create_mirror_provider_models().items():
+        log.info("initializing mirror provider `%s`: `%s`", env_name, mirror_model.name)
+        mirror = provider_cls_map[mirror_model.name](target_provider=mirror_model)
+        if mirror.listing_index.namespace in namespaces:
+            raise ValueError(
+                f"mirror provider `{env_name}` duplicates other provider config"
+            )
+        namespaces.add(mirror.listing_index.namespace)
+        res_backup_provider.mirrors.append(mirror)
+        log.info("success initializing mirror provider: `%s`", env_name)
     return res_backup_provider
 
 
@@ -98,6 +125,9 @@ def shutdown() -> NoReturn:  # pragma: no cover
         "use this environment to control it, see https://ogion.rafsaf.pl/latest/configuration/.",
         timeout_secs,
     )
+    stop_metrics_server()
+    if backup_worker_pool.cache_info().currsize:
+        backup_worker_pool().shutdown(timeout_secs=deadline - time.time())
     for thread in threading.enumerate():
         if thread.name == "MainThread":
             continue
@@ -133,46 +163,259 @@ def shutdown() -> NoReturn:  # pragma: no cover
         sys.exit(1)
 
 
+@metrics.JOBS_RUNNING.track_inprogress()
 def run_backup(target: base_target.BaseBackupTarget) -> None:
-    log.info("start making backup of target: `%s`", target.env_name)
-
-    provider = backup_provider()
-
-    with NotificationsContext(
-        step_name=PROGRAM_STEP.BACKUP_CREATE, env_name=target.env_name
-    ):
-        backup_file = target.backup()
-    log.info(
-        "backup file created: %s, starting post save upload to provider %s",
-        backup_file,
-        provider.__class__.__name__,
-    )
-    with NotificationsContext(
-        step_name=PROGRAM_STEP.UPLOAD,
-        env_name=target.env_name,
+    with (
+        history.record_run(target.env_name),
+        core.process_limits(target.process_limits),
+        core.scratch_folder(target.scratch_folder),
     ):
-        provider.post_save(backup_file=backup_file)
+        log.info("start making backup of target: `%s`", target.env_name)
+
+        provider = backup_provider()
 
-    if config.options.BACKUP_DELETE:
         with NotificationsContext(
-            step_name=PROGRAM_STEP.CLEANUP,
-            env_name=target.env_name,
+            step_name=PROGRAM_STEP.DISK_SPACE, env_name=target.env_name
         ):
-            provider.clean(
-                backup_file=backup_file,
-                max_backups=target.max_backups,
-                min_retention_days=target.min_retention_days,
+            reservation = disk_space.ADMISSION.admit(target)
+
+        with reservation:
+            with (
+                NotificationsContext(
+                    step_name=PROGRAM_STEP.BACKUP_CREATE, env_name=target.env_name
+                ),
+                metrics.StageTimer(target.env_name, metrics.STAGE.DUMP),
+            ):
+                backup_file = target.backup()
+            log.info(
+                "backup file created: %s, starting post save upload to providers %s",
+                backup_file,
+                ", ".join(
+                    upload_provider.__class__.__name__
+                    for upload_provider in [provider, *provider.mirrors]
+                ),
             )
-    else:
-        log.info("BACKUP_DELETE is disabled, skipping cleanup step")
+            with NotificationsContext(
+                step_name=PROGRAM_STEP.UPLOAD,
+                env_name=target.env_name,
+            ):
+                provider.post_save(backup_file=backup_file)
+
+        if config.options.BACKUP_DELETE and config.options.BACKUP_CLEANUP_CRON_RULE:
+            log.info(
+                "BACKUP_CLEANUP_CRON_RULE is set, cleanup runs in scheduled sweeps"
+            )
+        elif config.options.BACKUP_DELETE:
+            with (
+                NotificationsContext(
+                    step_name=PROGRAM_STEP.CLEANUP,
+                    env_name=target.env_name,
+                ),
+                metrics.StageTimer(target.env_name, metrics.STAGE.CLEANUP),
+            ):
+                provider.clean(
+                    backup_file=backup_file,
+                    max_backups=target.max_backups,
+                    min_retention_days=target.min_retention_days,
+                    keep_policy=target.keep_policy,
+                )
+        else:
+            log.info("BACKUP_DELETE is disabled, skipping cleanup step")
+
+        metrics.LAST_SUCCESS.set(time.time(), target=target.env_name)
+        log.info(
+            "backup and upload finished, next backup of target `%s` is: %s",
+            target.env_name,
+            target.next_backup_time,
+        )
+
+
+def run_scheduled_backup(target: base_target.BaseBackupTarget) -> None:
+    metrics.JOBS_QUEUED.dec()
+    run_backup(target)
+
+
+def run_backup_in_worker(
+    target: base_target.BaseBackupTarget,
+) -> list[metrics.Snapshot]:
+    metrics.reset_worker_metrics()
+    try:
+        run_backup(target)
+    except Exception:
+        log.error(
+            "backup of target `%s` failed in worker process",
+            target.env_name,
+            exc_info=True,
+        )
+    return metrics.worker_snapshot()
+
+
+class BackupWorkerPool:
+    """Runs backups in worker processes replaced after `max_tasks_per_child`.
+
+    Upload SDKs and their memory stay in short-lived workers, so the main
+    process only schedules backups and its memory usage stays flat.
+    """
+
+    def __init__(self, processes: int, max_tasks_per_child: int) -> None:
+        self.processes = processes
+        mp_context = multiprocessing.get_context("forkserver")
+        # CPU, disk and bandwidth limits hold for all workers together
+        self.manager, state = shared_state.start(mp_context)
+        shared_state.use(state)
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=mp_context,
+            max_tasks_per_child=max_tasks_per_child,
+            initializer=shared_state.use,
+            initargs=(state,),
+        )
+        self._pending: dict[Future[list[metrics.Snapshot]], str] = {}
+        self._lock = threading.Lock()
+
+    def _update_metrics(self) -> None:
+        running = min(len(self._pending), self.processes)
+        metrics.JOBS_RUNNING.set(running)
+        metrics.JOBS_QUEUED.set(len(self._pending) - running)
+
+    def _finished(self, future: Future[list[metrics.Snapshot]]) -> None:
+        with self._lock:
+            env_name = self._pending.pop(future)
+            self._update_metrics()
+        if future.cancelled():
+            return
+        try:
+            metrics.merge_worker_snapshot(future.result())
+        except Exception:
+            log.error("backup worker of target `%s` crashed", env_name, exc_info=True)
+        # Failed upload may have been spooled by the worker
+        spool.SPOOL.update_metrics()
+
+    def submit(
+        self, target: base_target.BaseBackupTarget
+    ) -> Future[list[metrics.Snapshot]]:
+        with self._lock:
+            future = self.executor.submit(run_backup_in_worker, target)
+            self._pending[future] = target.env_name
+            self._update_metrics()
+        future.add_done_callback(self._finished)
+        return future
+
+    def shutdown(self, timeout_secs: float) -> None:
+        """Cancel queued backups and wait up to `timeout_secs` for running ones."""
+        with self._lock:
+            pending = dict(self._pending)
+        cancelled = sorted(
+            env_name for future, env_name in pending.items() if future.cancel()
+        )
+        if cancelled:
+            log.warning(
+                "cancelled %s queued backups on shutdown: %s",
+                len(cancelled),
+                ", ".join(cancelled),
+            )
+        _, running = wait(pending, timeout=max(0, timeout_secs))
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if running:
+            # Workers still need shared state, it exits together with ogion
+            log.warning(
+                "backups still running in worker processes: %s",
+                ", ".join(sorted(pending[future] for future in running)),
+            )
+            return
+        shared_state.use_local()
+        self.manager.shutdown()
+
+
+@functools.lru_cache(maxsize=1)
+def metrics_server() -> ThreadingHTTPServer:
+    assert config.options.METRICS_PORT is not None
+    return metrics.start_metrics_server(config.options.METRICS_PORT)
+
+
+def stop_metrics_server() -> None:
+    # Its serve_forever() never returns on its own, so shutdown would wait
+    # for metrics_server thread until SIGTERM_TIMEOUT_SECS
+    if metrics_server.cache_info().currsize:
+        server = metrics_server()
+        server.shutdown()
+        server.server_close()
+
 
+@functools.lru_cache(maxsize=1)
+def backup_worker_pool() -> BackupWorkerPool:
     log.info(
-        "backup and upload finished, next backup of target `%s` is: %s",
-        target.env_name,
-        target.next_backup_time,
+        "starting %s backup worker processes",
+        config.options.BACKUP_WORKER_PROCESSES,
+    )
+    return BackupWorkerPool(
+        processes=config.options.BACKUP_WORKER_PROCESSES,
+        max_tasks_per_child=config.options.BACKUP_WORKER_MAX_TASKS,
     )
 
 
+def schedule_backup(target: base_target.BaseBackupTarget) -> None:
+    if config.options.BACKUP_WORKER_PROCESSES:
+        backup_worker_pool().submit(target)
+        return
+
+    metrics.JOBS_QUEUED.inc()
+    threading.Thread(
+        target=run_scheduled_backup,
+        args=(target,),
+        daemon=True,
+        name=target.pretty_thread_name,
+    ).start()
+
+
+def run_cleanup_sweep(targets: list[base_target.BaseBackupTarget]) -> None:
+    with (
+        NotificationsContext(step_name=PROGRAM_STEP.CLEANUP),
+        metrics.StageTimer(CLEANUP_SWEEP_TARGET, metrics.STAGE.CLEANUP),
+    ):
+        backup_provider().clean_all(
+            target_models=[target.target_model for target in targets]
+        )
+
+
+def run_cleanup_sweep_after(
+    targets: list[base_target.BaseBackupTarget], threads: list[threading.Thread]
+) -> None:
+    for thread in threads:
+        thread.join()
+    run_cleanup_sweep(targets)
+
+
+def run_verify_backups(
+    targets: list[base_target.BaseBackupTarget],
+    sample_days: int = 1,
+) -> int:
+    with NotificationsContext(step_name=PROGRAM_STEP.VERIFY):
+        return verify.run_verify(
+            backup_provider(),
+            env_names=[target.env_name for target in targets],
+            sample_days=sample_days,
+            workers=config.options.VERIFY_WORKERS,
+        )
+
+
+def run_spool_uploads() -> None:
+    spool.SPOOL.upload_due(backup_provider().upload_callables())
+
+
+def schedule_spool_uploads() -> None:
+    if any(thread.name == UPLOAD_SPOOL_THREAD for thread in threading.enumerate()):
+        return
+    if not spool.SPOOL.due():
+        return
+
+    threading.Thread(
+        target=run_spool_uploads,
+        daemon=True,
+        name=UPLOAD_SPOOL_THREAD,
+    ).start()
+
+
 def target_completer(**kwargs) -> list[str]:  # type: ignore[no-untyped-def]
     try:
         targets = core.create_target_models()
@@ -220,6 +463,8 @@ class RuntimeArgs:
     restore_latest: bool
     target: str | None
     restore: str
+    history: bool
+    verify: bool
 
 
 def setup_runtime_arguments() -> RuntimeArgs:  # noqa: PLR0912
@@ -237,6 +482,8 @@ Examples:
                                         Restore the latest backup for 'mytarget'
   ogion --target mytarget --restore backup_file.sql.lz.age
                                         Restore specific backup file for 'mytarget'
+  ogion --history                       Show p50/p95 duration of backup stages
+  ogion --verify                        Verify all stored backups can be read back
         """,
     )
     parser.add_argument(
@@ -293,6 +540,16 @@ Examples:
         action="store_true",
         help="List all backups for given target",
     )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help="Show p50/p95 duration of backup stages (optionally for --target)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Verify stored backups can be read back (optionally for --target)",
+    )
 
     argcomplete.autocomplete(parser)
 
@@ -364,6 +621,33 @@ Examples:
     if runtime_args.restore_latest and runtime_args.restore is not None:
         parser.error("--restore-latest and --restore cannot be used together")
 
+    # --history can only be combined with --target
+    if runtime_args.history:
+        if (
+            runtime_args.single
+            or runtime_args.debug_notifications
+            or runtime_args.debug_download is not None
+            or runtime_args.debug_loop is not None
+            or runtime_args.restore_latest
+            or runtime_args.restore is not None
+            or runtime_args.list
+        ):
+            parser.error("--history can only be combined with --target")
+
+    # --verify can only be combined with --target
+    if runtime_args.verify:
+        if (
+            runtime_args.single
+            or runtime_args.debug_notifications
+            or runtime_args.debug_download is not None
+            or runtime_args.debug_loop is not None
+            or runtime_args.restore_latest
+            or runtime_args.restore is not None
+            or runtime_args.list
+            or runtime_args.history
+        ):
+            parser.error("--verify can only be combined with --target")
+
     # --list should not be combined with --restore-latest or --restore
     if runtime_args.list:
         if runtime_args.restore_latest or runtime_args.restore is not None:
@@ -394,12 +678,7 @@ def run_debug_loop(iterations: int) -> NoReturn:  # pragma: no cover
 
         for target in targets:
             target.next_backup()
-            threading.Thread(
-                target=run_backup,
-                args=(target,),
-                daemon=True,
-                name=target.pretty_thread_name,
-            ).start()
+            schedule_backup(target)
 
         while len(threading.enumerate()) > 6:  # noqa: PLR2004
             exit_event.wait(0.5)
@@ -437,17 +716,63 @@ def run_single_all_backups(target_name: str | None) -> NoReturn:
             print(f"target '{target_name}' does not exist")
             sys.exit(1)
 
-    for target in targets:
+    backup_threads = [
         threading.Thread(
             target=run_backup,
             args=(target,),
             daemon=True,
             name=target.pretty_thread_name,
+        )
+        for target in targets
+    ]
+    for thread in backup_threads:
+        thread.start()
+    if config.options.BACKUP_DELETE and config.options.BACKUP_CLEANUP_CRON_RULE:
+        # Sweeps are scheduled only by main loop, so single run sweeps once
+        threading.Thread(
+            target=run_cleanup_sweep_after,
+            args=(targets, backup_threads),
+            daemon=True,
+            name=CLEANUP_SWEEP_TARGET,
         ).start()
 
     shutdown()
 
 
+def run_history_report(target_name: str | None) -> NoReturn:
+    stats = history.stage_stats(
+        target_name.lower() if target_name is not None else None
+    )
+    if not stats:
+        print("no backup history yet")
+        sys.exit(0)
+
+    rows = [
+        ["target", "stage", "runs", "failed", "p50", "p95", "cpu p50", "cpu p95"],
+        *(
+            [
+                stat.target,
+                stat.stage,
+                str(stat.runs),
+                str(stat.failed),
+                f"{stat.p50_seconds:.1f}s",
+                f"{stat.p95_seconds:.1f}s",
+                f"{stat.p50_cpu_seconds:.1f}s",
+                f"{stat.p95_cpu_seconds:.1f}s",
+            ]
+            for stat in stats
+        ),
+    ]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print(
+            "  ".join(
+                cell.ljust(width) for cell, width in zip(row, widths, strict=True)
+            ).rstrip()
+        )
+    sys.exit(0)
+
+
 def run_download_backup_file(path: str) -> NoReturn:
     provider = backup_provider()
 
@@ -463,9 +788,8 @@ def run_list_backup_files(target_name: str) -> NoReturn:
     for target in targets:
         if target.env_name.lower() != target_name.lower():
             continue
-        backups = provider.all_target_backups(target.env_name.lower())
-        for i in backups:
-            print(i)
+        for entry in provider.all_target_entries(target.env_name.lower()):
+            print(entry.key)
         sys.exit(0)
     log.warning("target '%s' does not exist", target_name)
     print(f"target '{target_name}' does not exist")
@@ -479,13 +803,12 @@ def run_restore_latest(target_name: str) -> NoReturn:
     for target in targets:
         if target.env_name.lower() != target_name.lower():
             continue
-        backups = provider.all_target_backups(target.env_name.lower())
+        backups = provider.all_target_entries(target.env_name.lower())
         if not backups:
             log.warning("no backups at all for '%s'", target_name)
             print(f"no backups at all for '{target_name}'")
             sys.exit(2)
-        latest_backup = backups[0]
-        _restore_backup(target=target, backup_path=latest_backup, provider=provider)
+        _restore_backup(target=target, backup=backups[0], provider=provider)
         sys.exit(0)
     log.warning("target '%s' does not exist", target_name)
     print(f"target '{target_name}' does not exist")
@@ -494,16 +817,22 @@ def run_restore_latest(target_name: str) -> NoReturn:
 
 def _restore_backup(
     target: base_target.BaseBackupTarget,
-    backup_path: str,
+    backup: core.BackupEntry,
     provider: base_provider.BaseUploadProvider,
 ) -> None:
-    path_age = provider.download_backup(backup_path)
-    restore_dir = path_age.parent
-    try:
-        path = core.run_decrypt_age_archive(path_age)
-        target.restore(str(path))
-    finally:
-        shutil.rmtree(restore_dir, ignore_errors=True)
+    with (
+        core.process_limits(target.process_limits),
+        metrics.StageTimer(target.env_name, metrics.STAGE.RESTORE),
+    ):
+        path_age = provider.download_verified(
+            backup.key, provider.stored_sha256(backup)
+        )
+        restore_dir = path_age.parent
+        try:
+            path = core.run_decrypt_age_archive(path_age)
+            target.restore(str(path))
+        finally:
+            shutil.rmtree(restore_dir, ignore_errors=True)
 
 
 def run_restore(backup_name: str, target_name: str) -> NoReturn:
@@ -513,29 +842,65 @@ def run_restore(backup_name: str, target_name: str) -> NoReturn:
     for target in targets:
         if target.env_name.lower() != target_name.lower():
             continue
-        backups = provider.all_target_backups(target.env_name.lower())
+        backups = provider.all_target_entries(target.env_name.lower())
         if not backups:
             log.warning("no backups at all for '%s'", target_name)
             print(f"no backups at all for '{target_name}'")
             sys.exit(2)
-        if backup_name not in backups:
+        backups_by_key = {entry.key: entry for entry in backups}
+        if backup_name not in backups_by_key:
             log.warning(
                 "backup '%s' not exist at all for '%s'", backup_name, target_name
             )
             print(f"backup '{backup_name}' not exist at all for '{target_name}'")
             sys.exit(2)
-        _restore_backup(target=target, backup_path=backup_name, provider=provider)
+        _restore_backup(
+            target=target, backup=backups_by_key[backup_name], provider=provider
+        )
         sys.exit(0)
     log.warning("target '%s' does not exist", target_name)
     print(f"target '{target_name}' does not exist")
     sys.exit(1)
 
 
+def run_verify_and_exit(target_name: str | None) -> NoReturn:
+    backup_provider()
+    targets = backup_targets()
+    if target_name:
+        targets = [t for t in targets if t.env_name.lower() == target_name.lower()]
+        if not targets:
+            log.warning("target '%s' does not exist", target_name)
+            print(f"target '{target_name}' does not exist")
+            sys.exit(1)
+
+    try:
+        verified = run_verify_backups(targets)
+    except ExceptionGroup as err:
+        print(err)
+        for error in err.exceptions:
+            print(f"  {error.__notes__[-1]}: {error}")
+        sys.exit(1)
+    print(f"verified {verified} backups")
+    sys.exit(0)
+
+
 def run_main_loop() -> NoReturn:  # pragma: no cover
     log.info("start run_main_loop")
 
     backup_provider()
     targets = backup_targets()
+    if config.options.METRICS_PORT:
+        metrics_server()
+    cleanup_schedule: core.CronSchedule | None = None
+    if config.options.BACKUP_DELETE and config.options.BACKUP_CLEANUP_CRON_RULE:
+        cleanup_schedule = core.CronSchedule(
+            config.options.BACKUP_CLEANUP_CRON_RULE, "cleanup sweep"
+        )
+    verify_schedule: core.CronSchedule | None = None
+    if config.options.VERIFY_CRON_RULE:
+        verify_schedule = core.CronSchedule(
+            config.options.VERIFY_CRON_RULE, "backups verification"
+        )
 
     while not exit_event.is_set():
         if len(threading.enumerate()) - 1 > 3 * len(targets):
@@ -550,13 +915,37 @@ def run_main_loop() -> NoReturn:  # pragma: no cover
             if not target.next_backup():
                 continue
 
+            schedule_backup(target)
+            exit_event.wait(0.5)
+
+        if cleanup_schedule is not None and cleanup_schedule.is_due():
+            if any(
+                thread.name == CLEANUP_SWEEP_TARGET for thread in threading.enumerate()
+            ):
+                log.warning("previous cleanup sweep is still running, skipping")
+            else:
+                threading.Thread(
+                    target=run_cleanup_sweep,
+                    args=(targets,),
+                    daemon=True,
+                    name=CLEANUP_SWEEP_TARGET,
+                ).start()
+
+        if (
+            verify_schedule is not None
+            and verify_schedule.is_due()
+            and not any(
+                thread.name == VERIFY_THREAD for thread in threading.enumerate()
+            )
+        ):
             threading.Thread(
-                target=run_backup,
-                args=(target,),
+                target=run_verify_backups,
+                args=(targets, config.options.VERIFY_SAMPLE_DAYS),
                 daemon=True,
-                name=target.pretty_thread_name,
+                name=VERIFY_THREAD,
             ).start()
-            exit_event.wait(0.5)
+
+        schedule_spool_uploads()
 
         exit_event.wait(5)
 
@@ -589,6 +978,10 @@ def main() -> NoReturn:  # pragma: no cover
     elif runtime_args.restore is not None:
         assert runtime_args.target is not None
         run_restore(runtime_args.restore, runtime_args.target)
+    elif runtime_args.history:
+        run_history_report(runtime_args.target)
+    elif runtime_args.verify:
+        run_verify_and_exit(runtime_args.target)
     else:
         run_main_loop()
 
@@ -0,0 +1,430 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""
+https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+"""
+
+import bisect
+import logging
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Iterator
+from contextlib import ContextDecorator, contextmanager
+from enum import StrEnum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import TracebackType
+from typing import Self, override
+
+from ogion import history
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DURATION_BUCKETS = (
+    0.5,
+    1,
+    5,
+    15,
+    30,
+    60,
+    120,
+    300,
+    600,
+    1200,
+    1800,
+    3600,
+    7200,
+    14400,
+)
+
+
+class STAGE(StrEnum):
+    DUMP = "dump"
+    COMPRESS = "compress"
+    ENCRYPT = "encrypt"
+    UPLOAD = "upload"
+    CLEANUP = "cleanup"
+    RESTORE = "restore"
+    VERIFY = "verify"
+
+
+type Labels = tuple[str, ...]
+type Snapshot = dict[Labels, tuple[tuple[int, ...], float]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric(ABC):
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: dict[str, str]) -> Labels:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {labels}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abstractmethod
+    def _samples(self) -> list[str]:  # pragma: no cover
+        pass
+
+    @abstractmethod
+    def snapshot(self) -> Snapshot:  # pragma: no cover
+        pass
+
+    @abstractmethod
+    def merge(self, snapshot: Snapshot) -> None:  # pragma: no cover
+        pass
+
+    @abstractmethod
+    def reset(self) -> None:  # pragma: no cover
+        pass
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        with self._lock:
+            lines.extend(self._samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError("counters can only be incremented")
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._label_values(labels), 0)
+
+    @override
+    def snapshot(self) -> Snapshot:
+        with self._lock:
+            return {key: ((), value) for key, value in self._values.items()}
+
+    @override
+    def merge(self, snapshot: Snapshot) -> None:
+        with self._lock:
+            for key, (_, value) in snapshot.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+    @override
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    @override
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(Counter):
+    metric_type = "gauge"
+
+    @override
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    @override
+    def merge(self, snapshot: Snapshot) -> None:
+        # Only series set by the merged backup are in snapshot, their last
+        # value replaces older one, other series are kept
+        with self._lock:
+            for key, (_, value) in snapshot.items():
+                self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels: str) -> Iterator[None]:
+        self.inc(1, **labels)
+        try:
+            yield
+        finally:
+            self.dec(1, **labels)
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Labels = (),
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = (*sorted(buckets), math.inf)
+        self._counts: dict[Labels, list[int]] = {}
+        self._sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            return sum(self._counts.get(self._label_values(labels), []))
+
+    @override
+    def snapshot(self) -> Snapshot:
+        with self._lock:
+            return {
+                key: (tuple(counts), self._sums[key])
+                for key, counts in self._counts.items()
+            }
+
+    @override
+    def merge(self, snapshot: Snapshot) -> None:
+        with self._lock:
+            for key, (counts, total) in snapshot.items():
+                current = self._counts.setdefault(key, [0] * len(self.buckets))
+                for index, count in enumerate(counts):
+                    current[index] += count
+                self._sums[key] = self._sums.get(key, 0) + total
+
+    @override
+    def reset(self) -> None:
+        with self._lock:
+            self._counts.clear()
+            self._sums.clear()
+
+    @override
+    def _samples(self) -> list[str]:
+        lines: list[str] = []
+        for key, counts in sorted(self._counts.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts, strict=True):
+                cumulative += count
+                labels = _format_labels(
+                    self.labels, key, f'le="{_format_value(bucket)}"'
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(self._sums[key])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+STAGE_DURATION = Histogram(
+    "ogion_stage_duration_seconds",
+    "Duration of backup stages.",
+    ("target", "stage"),
+)
+STAGE_FAILURES = Counter(
+    "ogion_stage_failures_total",
+    "Number of failed backup stages.",
+    ("target", "stage"),
+)
+RAW_BYTES = Counter(
+    "ogion_backup_raw_bytes_total",
+    "Size of backup files before compression.",
+    ("target",),
+)
+COMPRESSED_BYTES = Counter(
+    "ogion_backup_compressed_bytes_total",
+    "Size of backup files after compression.",
+    ("target",),
+)
+COMPRESSION_RATIO = Gauge(
+    "ogion_backup_compression_ratio",
+    "Raw to compressed size ratio of the last backup.",
+    ("target",),
+)
+UPLOADED_BYTES = Counter(
+    "ogion_upload_bytes_total",
+    "Bytes uploaded to the upload provider.",
+    ("target",),
+)
+UPLOAD_THROUGHPUT = Gauge(
+    "ogion_upload_throughput_bytes_per_second",
+    "Throughput of the last upload to the upload provider.",
+    ("target",),
+)
+SUBPROCESS_THROUGHPUT = Gauge(
+    "ogion_subprocess_throughput_bytes_per_second",
+    "Bytes per second written or read by running subprocess in last check.",
+    ("target", "command"),
+)
+SUBPROCESS_STALLS = Counter(
+    "ogion_subprocess_stalls_total",
+    "Subprocesses killed after making no progress for stall timeout.",
+    ("target", "command"),
+)
+SPOOLED_UPLOADS = Gauge(
+    "ogion_spooled_uploads",
+    "Backups waiting in local spool for upload retry.",
+    ("target",),
+)
+JOBS_QUEUED = Gauge(
+    "ogion_backup_jobs_queued",
+    "Backups scheduled but not started yet.",
+)
+JOBS_RUNNING = Gauge(
+    "ogion_backup_jobs_running",
+    "Backups running right now.",
+)
+LAST_SUCCESS = Gauge(
+    "ogion_last_success_timestamp_seconds",
+    "Unix time of the last successful backup.",
+    ("target",),
+)
+
+REGISTRY: list[_Metric] = [
+    STAGE_DURATION,
+    STAGE_FAILURES,
+    RAW_BYTES,
+    COMPRESSED_BYTES,
+    COMPRESSION_RATIO,
+    UPLOADED_BYTES,
+    UPLOAD_THROUGHPUT,
+    SUBPROCESS_THROUGHPUT,
+    SUBPROCESS_STALLS,
+    SPOOLED_UPLOADS,
+    JOBS_QUEUED,
+    JOBS_RUNNING,
+    LAST_SUCCESS,
+]
+
+
+# Metrics of a single backup, collected in backup worker processes and merged
+# into the main process. Gauges of state of the whole process (queued and
+# running jobs, spool size) are owned by the main process only, worker copies
+# of them would replace its values with a view of one backup.
+PROCESS_GAUGES: list[_Metric] = [JOBS_QUEUED, JOBS_RUNNING, SPOOLED_UPLOADS]
+WORKER_REGISTRY: list[_Metric] = [
+    metric for metric in REGISTRY if metric not in PROCESS_GAUGES
+]
+
+
+def render() -> str:
+    return "".join(metric.render() for metric in REGISTRY)
+
+
+def reset_worker_metrics() -> None:
+    for metric in WORKER_REGISTRY:
+        metric.reset()
+
+
+def worker_snapshot() -> list[Snapshot]:
+    return [metric.snapshot() for metric in WORKER_REGISTRY]
+
+
+def merge_worker_snapshot(snapshot: list[Snapshot]) -> None:
+    for metric, metric_snapshot in zip(WORKER_REGISTRY, snapshot, strict=True):
+        metric.merge(metric_snapshot)
+
+
+class StageTimer(ContextDecorator):
+    def __init__(self, target: str, stage: STAGE) -> None:
+        self.target = target
+        self.stage = stage
+        self.duration: float = 0
+
+    def __enter__(self) -> Self:
+        self._started_at = time.time()
+        self._usage = history.open_stage_usage()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_traceback: TracebackType | None,
+    ) -> None:
+        self.duration = time.perf_counter() - self._start
+        STAGE_DURATION.observe(self.duration, target=self.target, stage=self.stage)
+        if exc_type is not None:
+            STAGE_FAILURES.inc(target=self.target, stage=self.stage)
+        history.close_stage_usage(self._usage)
+        history.add_stage(
+            history.StageRecord(
+                stage=self.stage,
+                started_at=self._started_at,
+                finished_at=self._started_at + self.duration,
+                cpu_seconds=self._usage.cpu_seconds,
+                failed=exc_type is not None,
+                max_rss_kb=self._usage.max_rss_kb,
+                read_blocks=self._usage.read_blocks,
+                write_blocks=self._usage.write_blocks,
+            )
+        )
+        log.debug("stage %s of `%s` took %.3fs", self.stage, self.target, self.duration)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @override
+    def log_message(self, format: str, *args: object) -> None:
+        log.debug("metrics server: " + format, *args)
+
+
+def start_metrics_server(port: int, host: str = "") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, daemon=True, name="metrics_server"
+    ).start()
+    log.info("metrics server listening on port %s", server.server_address[1])
+    return server
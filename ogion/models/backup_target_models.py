@@ -2,7 +2,7 @@
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
 from pathlib import Path
-from typing import Self
+from typing import Literal, Self
 
 from croniter import croniter
 from pydantic import (
@@ -25,6 +25,19 @@ class TargetModel(BaseModel):
     min_retention_days: int = Field(
         ge=0, le=36600, default=config.options.BACKUP_MIN_RETENTION_DAYS
     )
+    keep_hourly: int = Field(ge=0, le=36600, default=0)
+    keep_daily: int = Field(ge=0, le=36600, default=0)
+    keep_weekly: int = Field(ge=0, le=36600, default=0)
+    keep_monthly: int = Field(ge=0, le=36600, default=0)
+    keep_yearly: int = Field(ge=0, le=36600, default=0)
+    nice: int = Field(ge=0, le=19, default=0)
+    ionice_class: Literal["none", "best-effort", "idle"] = "none"
+    cpu_affinity: str = Field(pattern=r"^(\d+(-\d+)?(,\d+(-\d+)?)*)?$", default="")
+    subprocess_timeout_secs: float | None = Field(ge=5, le=3600 * 24 * 7, default=None)
+    subprocess_stall_timeout_secs: float | None = Field(
+        ge=0, le=3600 * 24, default=None
+    )
+    scratch_dir: str = config.options.BACKUP_SCRATCH_DIR
 
     model_config = ConfigDict(frozen=True)
 
@@ -36,6 +49,10 @@ class TargetModel(BaseModel):
             )
         return cron_rule
 
+    @field_validator("scratch_dir")
+    def scratch_dir_is_valid(cls, scratch_dir: str) -> str:
+        return config.check_scratch_dir(scratch_dir)
+
 
 class PostgreSQLTargetModel(TargetModel):
     name: config.BackupTargetEnum = config.BackupTargetEnum.POSTGRESQL
@@ -2,8 +2,9 @@
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
 import base64
+from typing import override
 
-from pydantic import BaseModel, ConfigDict, SecretStr, field_validator
+from pydantic import BaseModel, ConfigDict, Field, SecretStr, field_validator
 
 from ogion import config
 
@@ -13,6 +14,11 @@ class ProviderModel(BaseModel):
 
     model_config = ConfigDict(frozen=True)
 
+    @property
+    def location(self) -> tuple[str, ...]:
+        """Where backups are stored, tuning params and credentials excluded."""
+        return (self.name,)
+
 
 class DebugProviderModel(ProviderModel):
     name: str = config.UploadProviderEnum.LOCAL_FILES_DEBUG
@@ -25,6 +31,12 @@ class GCSProviderModel(ProviderModel):
     service_account_base64: SecretStr
     chunk_size_mb: int = 100
     chunk_timeout_secs: int = 60
+    transfer_workers: int = Field(ge=1, le=64, default=1)
+
+    @property
+    @override
+    def location(self) -> tuple[str, ...]:
+        return (self.name, self.bucket_name, self.bucket_upload_path)
 
     @field_validator("service_account_base64")
     def process_service_account_base64(
@@ -45,8 +57,35 @@ class S3ProviderModel(ProviderModel):
     region: str | None = None
     max_bandwidth: int | None = None
 
+    @property
+    @override
+    def location(self) -> tuple[str, ...]:
+        return (self.name, self.endpoint, self.bucket_name, self.bucket_upload_path)
+
 
 class AzureProviderModel(ProviderModel):
     name: str = config.UploadProviderEnum.AZURE
     container_name: str
     connect_string: SecretStr
+    max_concurrency: int = Field(ge=1, le=64, default=1)
+    max_block_size_mb: int = Field(ge=1, le=4000, default=64)
+    max_single_put_size_mb: int = Field(ge=1, le=5000, default=64)
+
+    @property
+    @override
+    def location(self) -> tuple[str, ...]:
+        # Account key is secret, account is identified by its name and
+        # endpoint, for example Azurite accounts share the same name
+        settings = {
+            key.strip().lower(): value.strip()
+            for key, _, value in (
+                part.partition("=")
+                for part in self.connect_string.get_secret_value().split(";")
+            )
+        }
+        return (
+            self.name,
+            settings.get("accountname", ""),
+            settings.get("blobendpoint", "").rstrip("/"),
+            self.container_name,
+        )
@@ -24,9 +24,11 @@ log = logging.getLogger(__name__)
 class PROGRAM_STEP(StrEnum):
     SETUP_PROVIDER = "upload provider setup"
     SETUP_TARGETS = "backup targets setup"
+    DISK_SPACE = "disk space check"
     BACKUP_CREATE = "backup create"
     UPLOAD = "upload to provider"
     CLEANUP = "cleanup old backups"
+    VERIFY = "verify stored backups"
     DEBUG_NOTIFICATIONS = "debug check notifications are fired"
 
 
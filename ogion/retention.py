@@ -0,0 +1,122 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import logging
+from datetime import UTC, datetime, timedelta
+from typing import NamedTuple, Self
+
+from ogion import core
+from ogion.models.backup_target_models import TargetModel
+
+log = logging.getLogger(__name__)
+
+
+class KeepPolicy(NamedTuple):
+    """Grandfather-father-son policy, number of most recent periods to keep.
+
+    For every period (hour, day, ISO week, month, year) only the newest backup
+    in that period is kept, `0` disables given period.
+    """
+
+    hourly: int = 0
+    daily: int = 0
+    weekly: int = 0
+    monthly: int = 0
+    yearly: int = 0
+
+    @classmethod
+    def from_target_model(cls, target_model: TargetModel) -> Self:
+        return cls(
+            hourly=target_model.keep_hourly,
+            daily=target_model.keep_daily,
+            weekly=target_model.keep_weekly,
+            monthly=target_model.keep_monthly,
+            yearly=target_model.keep_yearly,
+        )
+
+
+def _period_key(period: str, backup_datetime: datetime) -> tuple[int, ...]:
+    match period:
+        case "hourly":
+            return (
+                backup_datetime.year,
+                backup_datetime.month,
+                backup_datetime.day,
+                backup_datetime.hour,
+            )
+        case "daily":
+            return backup_datetime.year, backup_datetime.month, backup_datetime.day
+        case "weekly":
+            iso = backup_datetime.isocalendar()
+            return iso.year, iso.week
+        case "monthly":
+            return backup_datetime.year, backup_datetime.month
+        case _:
+            return (backup_datetime.year,)
+
+
+def select_backups_to_delete(
+    backups: list[core.BackupEntry],
+    max_backups: int,
+    min_retention_days: int,
+    keep_policy: KeepPolicy = KeepPolicy(),
+) -> list[core.BackupEntry]:
+    """Return backups to delete, `backups` must be sorted from newest to oldest."""
+    if any(keep_policy):
+        return _select_backups_to_delete_with_keep_policy(
+            backups, max_backups, min_retention_days, keep_policy
+        )
+
+    backups = backups.copy()
+    backups_to_delete: list[core.BackupEntry] = []
+
+    while len(backups) > max_backups:
+        backup_to_remove = backups.pop()
+        if core.before_retention_period_ends(
+            backup_datetime=backup_to_remove.timestamp,
+            min_retention_days=min_retention_days,
+        ):
+            log.info(
+                "there are more backups than max_backups (%s/%s), "
+                "but oldest cannot be removed due to min retention days",
+                len(backups),
+                max_backups,
+            )
+            break
+        backups_to_delete.append(backup_to_remove)
+        log.info("backup %s will be deleted", backup_to_remove.key)
+
+    return backups_to_delete
+
+
+def _select_backups_to_delete_with_keep_policy(
+    backups: list[core.BackupEntry],
+    max_backups: int,
+    min_retention_days: int,
+    keep_policy: KeepPolicy,
+) -> list[core.BackupEntry]:
+    delete_not_before = datetime.now(UTC) - timedelta(days=min_retention_days)
+    periods = {period: keep for period, keep in keep_policy._asdict().items() if keep}
+    last_keys: dict[str, tuple[int, ...]] = {}
+    kept_in_period = dict.fromkeys(periods, 0)
+    backups_to_delete: list[core.BackupEntry] = []
+
+    for position, backup in enumerate(backups):
+        keep = position < max_backups or backup.timestamp > delete_not_before
+
+        for period, period_keep in periods.items():
+            key = _period_key(period, backup.timestamp)
+            if key == last_keys.get(period):
+                continue
+            last_keys[period] = key
+            if kept_in_period[period] < period_keep:
+                kept_in_period[period] += 1
+                keep = True
+
+        if not keep:
+            backups_to_delete.append(backup)
+
+    backups_to_delete.reverse()
+    for backup in backups_to_delete:
+        log.info("backup %s will be deleted", backup.key)
+    return backups_to_delete
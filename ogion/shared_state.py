@@ -0,0 +1,70 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""CPU tokens, disk space reservations and bandwidth shared by worker processes.
+
+With BACKUP_WORKER_PROCESSES, every worker would have its own copy of module
+level `core.CPU_TOKENS`, `disk_space.ADMISSION` and `bandwidth.LIMITER`, so
+each limit would be multiplied by number of workers. Instead, their state
+lives in one manager process and main process with all workers use it through
+proxies.
+"""
+
+import logging
+from multiprocessing.context import BaseContext
+from multiprocessing.managers import BaseManager
+from typing import Any, NamedTuple, cast
+
+from ogion import bandwidth, core, disk_space
+
+log = logging.getLogger(__name__)
+
+
+class SharedStateManager(BaseManager):
+    pass
+
+
+def _cpu_tokens() -> core.CpuTokenAllocator:
+    return core.CpuTokenAllocator(core.compression_cpu_budget)
+
+
+SharedStateManager.register(
+    "CpuTokenAllocator", _cpu_tokens, exposed=("take", "give_back")
+)
+SharedStateManager.register(
+    "DiskAdmission", disk_space.DiskAdmission, exposed=("reserve", "release")
+)
+SharedStateManager.register(
+    "BandwidthLimiter", bandwidth.BandwidthLimiter, exposed=("borrow",)
+)
+
+
+class SharedState(NamedTuple):
+    cpu_tokens: Any
+    admission: Any
+    limiter: Any
+
+
+def start(ctx: BaseContext) -> tuple[SharedStateManager, SharedState]:
+    manager = SharedStateManager(ctx=ctx)
+    manager.start()
+    state = SharedState(
+        cpu_tokens=manager.CpuTokenAllocator(),  # type: ignore[attr-defined]
+        admission=manager.DiskAdmission(),  # type: ignore[attr-defined]
+        limiter=manager.BandwidthLimiter(),  # type: ignore[attr-defined]
+    )
+    log.info("started shared state process for backup worker processes")
+    return manager, state
+
+
+def use(state: SharedState) -> None:
+    """Point module level limits of this process to shared state."""
+    core.CPU_TOKENS.shared = cast(core.CpuTokenAllocator, state.cpu_tokens)
+    disk_space.ADMISSION.shared = cast(disk_space.DiskAdmission, state.admission)
+    bandwidth.LIMITER.shared = cast(bandwidth.BandwidthLimiter, state.limiter)
+
+
+def use_local() -> None:
+    core.CPU_TOKENS.shared = core.CPU_TOKENS
+    disk_space.ADMISSION.shared = disk_space.ADMISSION
+    bandwidth.LIMITER.shared = bandwidth.LIMITER
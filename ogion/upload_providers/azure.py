@@ -1,36 +1,56 @@
 # Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
+import contextvars
 import logging
+import math
+import threading
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from http import HTTPStatus
 from pathlib import Path
-from typing import override
+from typing import Any, override
 
-from ogion import core
+from ogion import bandwidth, core
 from ogion.models.upload_provider_models import AzureProviderModel
-from ogion.upload_providers.base_provider import BaseUploadProvider
+from ogion.upload_providers import checksum
+from ogion.upload_providers.base_provider import BaseUploadProvider, UploadedBackup
+from ogion.upload_providers.stream import ChunkedStream
 
 log = logging.getLogger(__name__)
 
+# https://learn.microsoft.com/en-us/rest/api/storageservices/blob-batch
+AZURE_BATCH_SIZE = 256
+AZURE_MAX_BLOCKS = 50000
+
 
 class UploadProviderAzure(BaseUploadProvider):
     """Azure blob storage for storing backups"""
 
     def __init__(self, target_provider: AzureProviderModel) -> None:
+        super().__init__(target_provider)
+
         from azure.storage.blob import BlobServiceClient  # noqa: PLC0415
 
         self.container_name = target_provider.container_name
+        self.max_concurrency = target_provider.max_concurrency
+        self.max_block_size = target_provider.max_block_size_mb * bandwidth.MB
+        self.max_single_put_size = target_provider.max_single_put_size_mb * bandwidth.MB
 
+        # Downloads use the same sizes for first ranged get and next chunks
         blob_service_client = BlobServiceClient.from_connection_string(
-            target_provider.connect_string.get_secret_value()
+            target_provider.connect_string.get_secret_value(),
+            max_block_size=self.max_block_size,
+            max_single_put_size=self.max_single_put_size,
+            max_chunk_get_size=self.max_block_size,
+            max_single_get_size=self.max_single_put_size,
         )
         self.container_client = blob_service_client.get_container_client(
             container=self.container_name
         )
 
     @override
-    def post_save(self, backup_file: Path) -> str:
-        age_backup_file = core.run_create_age_archive(backup_file=backup_file)
-
+    def _upload(self, age_backup_file: Path) -> UploadedBackup:
         backup_dest_in_azure_container = (
             f"{age_backup_file.parent.name}/{age_backup_file.name}"
         )
@@ -44,8 +64,21 @@ class UploadProviderAzure(BaseUploadProvider):
                 backup_dest_in_azure_container,
             )
 
-            with open(file=age_backup_file, mode="rb") as data:
-                blob_client.upload_blob(data=data)
+            size = age_backup_file.stat().st_size
+            if size <= self.max_single_put_size:
+                # Azure computes Content-MD5 of blobs uploaded in single request
+                with open(file=age_backup_file, mode="rb") as data:
+                    checksum_file = checksum.ChecksumFile(data)
+                    blob_client.upload_blob(
+                        data=bandwidth.throttle(checksum_file.binary),
+                        length=size,
+                        max_concurrency=self.max_concurrency,
+                    )
+                sha256 = checksum_file.hexdigest()
+                if sha256 is not None:
+                    blob_client.set_blob_metadata({checksum.SHA256_KEY: sha256})
+            else:
+                sha256 = self._block_upload(blob_client, age_backup_file, size)
 
             log.info(
                 "uploaded %s to %s in %s",
@@ -54,59 +87,198 @@ class UploadProviderAzure(BaseUploadProvider):
                 self.container_name,
             )
 
-        core.remove_path(age_backup_file)
-        core.remove_path(backup_file)
+        return UploadedBackup(backup_dest_in_azure_container, sha256)
+
+    def _block_upload(
+        self, blob_client: Any, age_backup_file: Path, size: int
+    ) -> str | None:
+        # Blocks are read and hashed in order, staged by max_concurrency threads
+        # and their ids are saved after every block, so failed or interrupted
+        # upload stages only blocks that Azure does not have yet. Whole blob
+        # md5 and sha256 are committed with block list, returns sha256
+        from azure.core.exceptions import ResourceNotFoundError  # noqa: PLC0415
+        from azure.storage.blob import BlobBlock, ContentSettings  # noqa: PLC0415
+
+        upload_checkpoint = self.upload_checkpoint(age_backup_file)
+        state = upload_checkpoint.load()
+        if state is None or state["blob_name"] != blob_client.blob_name:
+            state = {
+                "blob_name": blob_client.blob_name,
+                "block_size": max(
+                    self.max_block_size, math.ceil(size / AZURE_MAX_BLOCKS)
+                ),
+                "blocks": [],
+            }
+            upload_checkpoint.save(state)
+        else:
+            try:
+                _, uncommitted = blob_client.get_block_list("uncommitted")
+            except ResourceNotFoundError:
+                uncommitted = []
+            # Uncommitted blocks are removed by Azure after a week
+            staged = {block.id for block in uncommitted}
+            state["blocks"] = [block for block in state["blocks"] if block in staged]
+            log.info(
+                "resuming upload of %s, %s blocks already staged",
+                age_backup_file,
+                len(state["blocks"]),
+            )
+
+        block_size: int = state["block_size"]
+        block_ids = [f"{index:06d}" for index in range(math.ceil(size / block_size))]
+        staged_blocks: list[str] = state["blocks"]
+        already_staged = set(staged_blocks)
+        lock = threading.Lock()
+
+        def stage_block(block_id: str, data: bytes) -> None:
+            blob_client.stage_block(block_id=block_id, data=data)
+            with lock:
+                staged_blocks.append(block_id)
+                upload_checkpoint.save(state)
+
+        futures: list[Future[None]] = []
+        with (
+            open(age_backup_file, "rb") as raw_file,
+            ThreadPoolExecutor(
+                max_workers=self.max_concurrency, thread_name_prefix="azure-block"
+            ) as executor,
+        ):
+            checksum_file = checksum.ChecksumFile(raw_file, "md5", "sha256")
+            file = bandwidth.throttle(checksum_file.binary)
+            for block_id in block_ids:
+                if block_id in already_staged:
+                    checksum_file.read(block_size)
+                    continue
+                # At most max_concurrency blocks are kept in memory
+                in_flight = [future for future in futures if not future.done()]
+                if len(in_flight) >= self.max_concurrency:
+                    wait(in_flight, return_when=FIRST_COMPLETED)
+                if any(future.done() and future.exception() for future in futures):
+                    # Blocks after the first failed one are not read or staged
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+                futures.append(
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        stage_block,
+                        block_id,
+                        file.read(block_size),
+                    )
+                )
+
+        errors = [
+            error
+            for future in futures
+            if not future.cancelled() and (error := future.exception()) is not None
+        ]
+        if errors:
+            raise errors[0]
+
+        md5 = checksum_file.digest("md5")
+        sha256 = checksum_file.hexdigest("sha256")
+        blob_client.commit_block_list(
+            [BlobBlock(block_id) for block_id in block_ids],
+            content_settings=ContentSettings(content_md5=bytearray(md5))
+            if md5 is not None
+            else None,
+            metadata={checksum.SHA256_KEY: sha256} if sha256 is not None else None,
+        )
+        return sha256
+
+    @override
+    def _upload_stream(
+        self, stream: ChunkedStream, env_name: str, name: str
+    ) -> UploadedBackup:
+        # Blocks are staged as soon as they are read and committed at the end
+        # with checksums of the whole stream
+        from azure.storage.blob import BlobBlock, ContentSettings  # noqa: PLC0415
+
+        backup_dest_in_azure_container = f"{env_name}/{name}"
+        log.info("start uploading stream to %s", backup_dest_in_azure_container)
 
-        log.info("removed %s and %s from local disk", backup_file, age_backup_file)
+        with self.container_client.get_blob_client(
+            blob=backup_dest_in_azure_container
+        ) as blob_client:
+            block_ids: list[str] = []
+            for index, (chunk, is_last) in enumerate(
+                stream.chunks(self.max_block_size)
+            ):
+                if index == 0 and is_last:
+                    blob_client.upload_blob(
+                        data=chunk,
+                        length=len(chunk),
+                        metadata={checksum.SHA256_KEY: stream.sha256.hexdigest()},
+                    )
+                    break
+                block_ids.append(f"{index:06d}")
+                blob_client.stage_block(block_id=block_ids[-1], data=chunk)
+            else:
+                blob_client.commit_block_list(
+                    [BlobBlock(block_id) for block_id in block_ids],
+                    content_settings=ContentSettings(
+                        content_md5=bytearray(stream.md5.digest())
+                    ),
+                    metadata={checksum.SHA256_KEY: stream.sha256.hexdigest()},
+                )
 
-        return backup_dest_in_azure_container
+        return UploadedBackup(backup_dest_in_azure_container, stream.sha256.hexdigest())
 
     @override
-    def all_target_backups(self, env_name: str) -> list[str]:
-        backups: list[str] = []
-        for blob in self.container_client.list_blobs(name_starts_with=f"{env_name}/"):
-            backups.append(blob.name)
+    def _all_target_backups(self, env_name: str) -> list[core.BackupEntry]:
+        return core.backup_entries(
+            (blob.name, blob.size, blob.etag, checksum.metadata_sha256(blob.metadata))
+            for blob in self.container_client.list_blobs(
+                name_starts_with=f"{env_name}/", include=["metadata"]
+            )
+        )
 
-        backups.sort(reverse=True)
-        return backups
+    @override
+    def _all_backups(self) -> list[core.BackupEntry]:
+        return core.backup_entries(
+            (blob.name, blob.size, blob.etag, checksum.metadata_sha256(blob.metadata))
+            for blob in self.container_client.list_blobs(include=["metadata"])
+        )
 
     @override
-    def download_backup(self, path: str) -> Path:
+    def download_backup(self, path: str, sha256: str | None = None) -> Path:
         backup_file = core.get_safe_download_path(path)
-        backup_file.parent.mkdir(parents=True, exist_ok=True)
 
-        with open(backup_file, mode="wb") as file:
-            stream = self.container_client.download_blob(path)
-            stream.readinto(file)
+        with self.download_file(backup_file, sha256) as file:
+            # With max_concurrency, chunks written out of order are hashed by
+            # reading the file again before it is moved into place
+            stream = self.container_client.download_blob(
+                path, max_concurrency=self.max_concurrency
+            )
+            stream.readinto(bandwidth.throttle(file.binary))
 
         return backup_file
 
     @override
-    def clean(
-        self, backup_file: Path, max_backups: int, min_retention_days: int
-    ) -> None:
-        from azure.core.exceptions import ResourceNotFoundError  # noqa: PLC0415
-
-        backups = self.all_target_backups(env_name=backup_file.parent.name)
+    def _stream_backup(self, path: str) -> Iterator[bytes]:
+        stream = self.container_client.download_blob(
+            path, max_concurrency=self.max_concurrency
+        )
+        yield from stream.chunks()
 
-        while len(backups) > max_backups:
-            backup_to_remove = backups.pop()
-            file_name = backup_to_remove.split("/")[-1]
-            if core.file_before_retention_period_ends(
-                backup_name=file_name, min_retention_days=min_retention_days
-            ):
-                log.info(
-                    "there are more backups than max_backups (%s/%s), "
-                    "but oldest cannot be removed due to min retention days",
-                    len(backups),
-                    max_backups,
-                )
-                break
+    @override
+    def _delete_backups(self, backup_paths: list[str]) -> None:
+        for i in range(0, len(backup_paths), AZURE_BATCH_SIZE):
+            paths_batch = backup_paths[i : i + AZURE_BATCH_SIZE]
+            responses = self.container_client.delete_blobs(
+                *paths_batch, raise_on_any_failure=False
+            )
 
-            try:
-                self.container_client.delete_blob(blob=backup_to_remove)
-                log.info("deleted backup %s from azure blob storage", backup_to_remove)
-            except ResourceNotFoundError:
-                log.info(
-                    "backup %s already deleted (concurrent cleanup)", backup_to_remove
+            errors: list[str] = []
+            for backup_path, response in zip(paths_batch, responses, strict=True):
+                if response.status_code == HTTPStatus.NOT_FOUND:
+                    log.info(
+                        "backup %s already deleted (concurrent cleanup)", backup_path
+                    )
+                elif not HTTPStatus(response.status_code).is_success:
+                    errors.append(f"{backup_path}: {response.status_code}")
+                else:
+                    log.info("deleted backup %s from azure blob storage", backup_path)
+            if errors:
+                raise RuntimeError(
+                    f"Fail to delete backups from azure blob storage: {errors}"
                 )
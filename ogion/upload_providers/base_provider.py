@@ -1,34 +1,355 @@
 # Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
+import contextlib
+import contextvars
 import logging
 import pathlib
 from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, BinaryIO, NamedTuple, final
 
+from ogion import bandwidth, core, history, metrics, retention
+from ogion.models.backup_target_models import TargetModel
 from ogion.models.upload_provider_models import ProviderModel
+from ogion.upload_providers import checkpoint, checksum, spool
+from ogion.upload_providers.listing_index import ListingIndex
+from ogion.upload_providers.stream import ChunkedStream
 
 log = logging.getLogger(__name__)
 
 
+class UploadedBackup(NamedTuple):
+    """Backup path in provider and sha256 hashed while uploading, if known."""
+
+    path: str
+    sha256: str | None = None
+
+
 class BaseUploadProvider(ABC):
-    def __init__(self, target_provider: ProviderModel) -> None:  # pragma: no cover
+    """Upload provider from BACKUP_PROVIDER, optionally with mirror providers.
+
+    Backup is encrypted once and uploaded to provider and its mirrors in
+    parallel, retention is applied to each of them separately.
+    """
+
+    def __init__(self, target_provider: ProviderModel) -> None:
+        self.listing_index = ListingIndex(provider_model=target_provider)
+        self.mirrors: list[BaseUploadProvider] = []
+
+    @abstractmethod
+    def _all_target_backups(
+        self, env_name: str
+    ) -> list[core.BackupEntry]:  # pragma: no cover
         pass
 
     @abstractmethod
-    def all_target_backups(self, env_name: str) -> list[str]:  # pragma: no cover
+    def _all_backups(self) -> list[core.BackupEntry]:  # pragma: no cover
         pass
 
     @abstractmethod
-    def download_backup(self, path: str) -> pathlib.Path:  # pragma: no cover
+    def _upload(self, age_backup_file: Path) -> UploadedBackup:  # pragma: no cover
         pass
 
     @abstractmethod
-    def post_save(self, backup_file: Path) -> str:  # pragma: no cover
+    def _upload_stream(
+        self, stream: ChunkedStream, env_name: str, name: str
+    ) -> UploadedBackup:  # pragma: no cover
         pass
 
     @abstractmethod
-    def clean(
-        self, backup_file: Path, max_backups: int, min_retention_days: int
-    ) -> None:  # pragma: no cover
+    def _delete_backups(self, backup_paths: list[str]) -> None:  # pragma: no cover
+        pass
+
+    @abstractmethod
+    def download_backup(
+        self, path: str, sha256: str | None = None
+    ) -> pathlib.Path:  # pragma: no cover
         pass
+
+    @abstractmethod
+    def _stream_backup(self, path: str) -> Iterator[bytes]:  # pragma: no cover
+        pass
+
+    def stored_sha256(self, entry: core.BackupEntry) -> str | None:
+        """Sha256 stored with backup during upload, if known."""
+        return entry.sha256
+
+    def _abort_upload(self, state: dict[str, Any]) -> None:
+        """Free storage held by checkpointed upload that will not be resumed."""
+
+    @final
+    def all_target_entries(self, env_name: str) -> list[core.BackupEntry]:
+        return self.listing_index.backups(env_name, self._all_target_backups)
+
+    @final
+    def all_target_backups(self, env_name: str) -> list[str]:
+        return [entry.key for entry in self.all_target_entries(env_name)]
+
+    @final
+    def post_save(self, backup_file: Path) -> str:
+        age_backup_file = core.run_create_age_archive(backup_file=backup_file)
+        backup_paths, errors = self._upload_to_all_providers(age_backup_file)
+        if errors:
+            if spool.SPOOL.add(age_backup_file, providers=list(errors)) is not None:
+                core.remove_path(backup_file)
+            else:
+                for provider in [self, *self.mirrors]:
+                    if provider.listing_index.namespace in errors:
+                        provider.abort_upload(age_backup_file)
+            failed = list(errors.values())
+            if len(failed) == 1:
+                raise failed[0]
+            raise ExceptionGroup(
+                f"upload to {len(failed)} of {len(self.mirrors) + 1} providers failed",
+                failed,
+            )
+
+        core.remove_path(backup_file)
+        core.remove_path(age_backup_file)
+        log.info("removed %s and %s from local disk", backup_file, age_backup_file)
+
+        return backup_paths[self.listing_index.namespace]
+
+    def _upload_to_all_providers(
+        self, age_backup_file: Path
+    ) -> tuple[dict[str, str], dict[str, Exception]]:
+        """Upload file to provider and mirrors in parallel, keyed by namespace."""
+        providers = [self, *self.mirrors]
+        backup_paths: dict[str, str] = {}
+        errors: dict[str, Exception] = {}
+        with ThreadPoolExecutor(
+            max_workers=len(providers), thread_name_prefix="upload"
+        ) as executor:
+            futures = {
+                provider.listing_index.namespace: (
+                    provider,
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        provider.upload,
+                        age_backup_file,
+                    ),
+                )
+                for provider in providers
+            }
+            for namespace, (provider, future) in futures.items():
+                try:
+                    backup_path = future.result()
+                except Exception as err:
+                    log.error(
+                        "upload of %s to %s failed: %s",
+                        age_backup_file,
+                        provider.__class__.__name__,
+                        err,
+                    )
+                    errors[namespace] = err
+                    continue
+                backup_paths[namespace] = backup_path
+                log.info("uploaded %s to %s", backup_path, provider.__class__.__name__)
+        return backup_paths, errors
+
+    @final
+    def upload(self, age_backup_file: Path) -> str:
+        """Upload file to this provider only, file is left on local disk."""
+        env_name = age_backup_file.parent.name
+        backup_size = age_backup_file.stat().st_size
+        with metrics.StageTimer(env_name, metrics.STAGE.UPLOAD) as timer:
+            uploaded = self._upload(age_backup_file)
+        self._uploaded(env_name, uploaded, backup_size, timer.duration)
+        self.upload_checkpoint(age_backup_file).clear()
+
+        return uploaded.path
+
+    @final
+    def upload_stream(self, stream: BinaryIO, env_name: str, name: str) -> str:
+        """Upload stream of unknown length to this provider only, as data arrives.
+
+        Upload can overlap with process producing the stream, for example dump
+        written to a pipe. Stream cannot be read again, so failed upload is
+        neither resumed nor spooled, caller must retry it with a new stream.
+        """
+        chunked_stream = ChunkedStream(stream)
+        with metrics.StageTimer(env_name, metrics.STAGE.UPLOAD) as timer:
+            uploaded = self._upload_stream(chunked_stream, env_name, name)
+        self._uploaded(env_name, uploaded, chunked_stream.bytes_read, timer.duration)
+        log.info(
+            "uploaded stream of %s to %s",
+            core.size_mb(chunked_stream.bytes_read),
+            uploaded.path,
+        )
+
+        return uploaded.path
+
+    def _uploaded(
+        self,
+        env_name: str,
+        uploaded: UploadedBackup,
+        backup_size: int,
+        duration: float,
+    ) -> None:
+        metrics.UPLOADED_BYTES.inc(backup_size, target=env_name)
+        history.add_bytes(uploaded=backup_size)
+        if duration:
+            metrics.UPLOAD_THROUGHPUT.set(backup_size / duration, target=env_name)
+        self.listing_index.add(
+            env_name,
+            core.BackupEntry.from_key(
+                uploaded.path, size=backup_size, sha256=uploaded.sha256
+            ),
+        )
+
+    @final
+    def download_verified(self, path: str, sha256: str | None) -> pathlib.Path:
+        """Download backup and check it against sha256 stored during upload.
+
+        Backups uploaded before checksums were stored are not verified.
+        """
+        if sha256 is None:
+            log.warning("no sha256 stored for %s, skipping verification", path)
+        return self.download_backup(path, sha256)
+
+    @final
+    @contextlib.contextmanager
+    def download_file(
+        self, backup_file: Path, sha256: str | None
+    ) -> Iterator[checksum.ChecksumFile]:
+        """Partial file for download of backup_file, hashed as it is written.
+
+        It replaces backup_file only when it matches sha256, so corrupted
+        download is never left in place. When bytes are written out of order
+        or not through returned file, partial file is hashed by reading it.
+        """
+        backup_file.parent.mkdir(parents=True, exist_ok=True)
+        part_file = backup_file.with_name(f"{backup_file.name}.part")
+        try:
+            with open(part_file, "wb") as file:
+                checksum_file = checksum.ChecksumFile(file)
+                yield checksum_file
+            if sha256 is not None:
+                checksum.verify_file(part_file, sha256, checksum_file.hexdigest())
+            part_file.replace(backup_file)
+        finally:
+            part_file.unlink(missing_ok=True)
+        core.drop_page_cache(backup_file)
+
+    @final
+    def stream_backup(self, path: str) -> Iterator[bytes]:
+        """Yield backup content as it is downloaded, nothing is written to disk."""
+        for chunk in self._stream_backup(path):
+            bandwidth.LIMITER.consume(len(chunk))
+            yield chunk
+
+    @final
+    def upload_callables(self) -> dict[str, Callable[[Path], str]]:
+        return {
+            provider.listing_index.namespace: provider.upload
+            for provider in [self, *self.mirrors]
+        }
+
+    @final
+    def abort_upload(self, age_backup_file: Path) -> None:
+        """Abort failed upload of file that is not spooled for retry."""
+        upload_checkpoint = self.upload_checkpoint(age_backup_file)
+        state = upload_checkpoint.load()
+        if state is not None:
+            try:
+                self._abort_upload(state)
+            except Exception as err:
+                log.warning("could not abort upload of %s: %s", age_backup_file, err)
+            else:
+                log.info("aborted upload of %s", age_backup_file)
+        upload_checkpoint.clear()
+
+    @final
+    def upload_checkpoint(self, age_backup_file: Path) -> checkpoint.UploadCheckpoint:
+        return checkpoint.UploadCheckpoint(
+            age_backup_file, namespace=self.listing_index.namespace
+        )
+
+    @final
+    def clean(
+        self,
+        backup_file: Path,
+        max_backups: int,
+        min_retention_days: int,
+        keep_policy: retention.KeepPolicy = retention.KeepPolicy(),
+    ) -> None:
+        # Local files already cleaned up in post_save()
+        env_name = backup_file.parent.name
+        for provider in [self, *self.mirrors]:
+            provider._clean_target(
+                env_name,
+                max_backups=max_backups,
+                min_retention_days=min_retention_days,
+                keep_policy=keep_policy,
+            )
+
+    def _clean_target(
+        self,
+        env_name: str,
+        max_backups: int,
+        min_retention_days: int,
+        keep_policy: retention.KeepPolicy,
+    ) -> None:
+        backups_to_delete = retention.select_backups_to_delete(
+            self.all_target_entries(env_name=env_name),
+            max_backups=max_backups,
+            min_retention_days=min_retention_days,
+            keep_policy=keep_policy,
+        )
+        if not backups_to_delete:
+            return
+
+        keys_to_delete = [entry.key for entry in backups_to_delete]
+        self._delete_backups(keys_to_delete)
+        self.listing_index.remove(env_name, keys_to_delete)
+        log.info(
+            "%s backups were successfully deleted from %s",
+            len(backups_to_delete),
+            self.__class__.__name__,
+        )
+
+    @final
+    def all_backups_by_target(self) -> dict[str, list[core.BackupEntry]]:
+        backups_by_target: dict[str, list[core.BackupEntry]] = {}
+        for entry in core.sort_backup_entries(self._all_backups()):
+            backups_by_target.setdefault(entry.target, []).append(entry)
+        return backups_by_target
+
+    @final
+    def clean_all(self, target_models: Sequence[TargetModel]) -> None:
+        for provider in [self, *self.mirrors]:
+            provider._clean_all_targets(target_models)
+
+    def _clean_all_targets(self, target_models: Sequence[TargetModel]) -> None:
+        log.info("start cleanup sweep of %s targets", len(target_models))
+        backups_by_target = self.all_backups_by_target()
+
+        backups_to_delete: dict[str, list[core.BackupEntry]] = {}
+        for target_model in target_models:
+            backups = backups_by_target.get(target_model.env_name, [])
+            self.listing_index.replace(target_model.env_name, backups)
+            backups_to_delete[target_model.env_name] = (
+                retention.select_backups_to_delete(
+                    backups,
+                    max_backups=target_model.max_backups,
+                    min_retention_days=target_model.min_retention_days,
+                    keep_policy=retention.KeepPolicy.from_target_model(target_model),
+                )
+            )
+
+        all_backups_to_delete = [
+            entry.key for entries in backups_to_delete.values() for entry in entries
+        ]
+        if all_backups_to_delete:
+            self._delete_backups(all_backups_to_delete)
+            for env_name, entries in backups_to_delete.items():
+                self.listing_index.remove(env_name, [entry.key for entry in entries])
+
+        log.info(
+            "finished cleanup sweep, %s backups were deleted from %s",
+            len(all_backups_to_delete),
+            self.__class__.__name__,
+        )
@@ -0,0 +1,69 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import glob
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any
+
+from ogion import core
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_SUFFIX = ".upload.json"
+
+
+def checkpoint_path(age_backup_file: Path, namespace: str) -> Path:
+    return age_backup_file.with_name(
+        f"{age_backup_file.name}.{namespace}{CHECKPOINT_SUFFIX}"
+    )
+
+
+def checkpoint_paths(age_backup_file: Path) -> list[Path]:
+    """Checkpoints of file in all upload providers."""
+    return list(
+        age_backup_file.parent.glob(
+            f"{glob.escape(age_backup_file.name)}.*{CHECKPOINT_SUFFIX}"
+        )
+    )
+
+
+class UploadCheckpoint:
+    """Multipart or resumable upload session of file, persisted next to it.
+
+    State is bound to upload provider and to size and mtime of file, so
+    upload retried after failure or restart continues where it stopped.
+    """
+
+    def __init__(self, age_backup_file: Path, namespace: str) -> None:
+        self.path = checkpoint_path(age_backup_file, namespace)
+        stat = age_backup_file.stat()
+        self._file_key = {
+            "namespace": namespace,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    def load(self) -> dict[str, Any] | None:
+        try:
+            data = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return None
+        except ValueError as err:
+            log.warning("invalid upload checkpoint %s, ignoring: %s", self.path, err)
+            return None
+        if not isinstance(data, dict) or data.get("file") != self._file_key:
+            log.info("upload checkpoint %s is outdated, ignoring", self.path)
+            return None
+        state: dict[str, Any] = data["state"]
+        return state
+
+    def save(self, state: dict[str, Any]) -> None:
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"file": self._file_key, "state": state}))
+        os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        core.remove_path(self.path)
@@ -0,0 +1,102 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import hashlib
+import logging
+from collections.abc import Buffer, Mapping
+from pathlib import Path
+from typing import Any, BinaryIO, cast
+
+log = logging.getLogger(__name__)
+
+# Object metadata key, Azure allows only C# identifiers in metadata names
+SHA256_KEY = "ogion_sha256"
+CHUNK_SIZE = 1024 * 1024
+
+
+class ChecksumMismatchError(ValueError):
+    pass
+
+
+class ChecksumFile:
+    """File whose reads and writes are hashed in the same pass.
+
+    Bytes read or written again after seeking back, for example by retried
+    request, are hashed only once. Skipping over bytes that were not hashed
+    yet leaves hashes incomplete and their digests unknown.
+    """
+
+    def __init__(self, file: BinaryIO, *algorithms: str) -> None:
+        self._file = file
+        self._hashes = {
+            algorithm: hashlib.new(algorithm) for algorithm in algorithms or ["sha256"]
+        }
+        self._hashed = 0
+        self.complete = True
+
+    @property
+    def binary(self) -> BinaryIO:
+        # Wrapper is passed to provider SDKs expecting regular binary file
+        return cast(BinaryIO, self)
+
+    def _update(self, position: int, data: Buffer) -> None:
+        view = memoryview(data).cast("B")
+        if position > self._hashed:
+            self.complete = False
+        elif position + len(view) > self._hashed:
+            for hash_obj in self._hashes.values():
+                hash_obj.update(view[self._hashed - position :])
+            self._hashed = position + len(view)
+
+    def read(self, size: int = -1) -> bytes:
+        position = self._file.tell()
+        data = self._file.read(size)
+        self._update(position, data)
+        return data
+
+    def readinto(self, buffer: Buffer) -> int:
+        position = self._file.tell()
+        nbytes: int = self._file.readinto(buffer)  # type: ignore[attr-defined]
+        self._update(position, memoryview(buffer)[:nbytes])
+        return nbytes
+
+    def write(self, data: Buffer) -> int:
+        position = self._file.tell()
+        nbytes = self._file.write(data)
+        self._update(position, memoryview(data).cast("B")[:nbytes])
+        return nbytes
+
+    def digest(self, algorithm: str = "sha256") -> bytes | None:
+        return self._hashes[algorithm].digest() if self.complete else None
+
+    def hexdigest(self, algorithm: str = "sha256") -> str | None:
+        return self._hashes[algorithm].hexdigest() if self.complete else None
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._file, name)
+
+
+def file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def metadata_sha256(metadata: Mapping[str, str] | None) -> str | None:
+    if not isinstance(metadata, Mapping):
+        return None
+    sha256 = metadata.get(SHA256_KEY)
+    return sha256 if isinstance(sha256, str) else None
+
+
+def verify_file(path: Path, sha256: str, actual: str | None = None) -> None:
+    # Sha256 hashed while file was written is passed as `actual`
+    if actual is None:
+        actual = file_sha256(path)
+    if actual != sha256:
+        raise ChecksumMismatchError(
+            f"sha256 of {path} is {actual}, expected {sha256} stored with backup"
+        )
+    log.info("verified sha256 of %s", path)
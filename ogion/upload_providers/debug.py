@@ -2,16 +2,39 @@
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
 import logging
+import os
 import shutil
+from collections.abc import Iterator
 from pathlib import Path
 from typing import override
 
 from ogion import config, core
 from ogion.models.upload_provider_models import DebugProviderModel
-from ogion.upload_providers.base_provider import BaseUploadProvider
+from ogion.upload_providers import checksum
+from ogion.upload_providers.base_provider import BaseUploadProvider, UploadedBackup
+from ogion.upload_providers.stream import ChunkedStream
 
 log = logging.getLogger(__name__)
 
+DEBUG_STREAM_CHUNK_SIZE = 1024 * 1024
+DEBUG_SHA256_XATTR = f"user.{checksum.SHA256_KEY}"
+
+
+def _read_sha256(path: Path) -> str | None:
+    try:
+        return os.getxattr(path, DEBUG_SHA256_XATTR).decode()
+    except OSError:
+        return None
+
+
+def _write_sha256(path: Path, sha256: str) -> None:
+    # Extended attributes are not supported by every filesystem, e.g. tmpfs
+    # on older kernels, backups are then listed without checksum
+    try:
+        os.setxattr(path, DEBUG_SHA256_XATTR, sha256.encode())
+    except OSError as err:
+        log.debug("could not store sha256 of %s: %s", path, err)
+
 
 class UploadProviderLocalDebug(BaseUploadProvider):
     """Represent local folder `data` for storing backups.
@@ -20,70 +43,95 @@ class UploadProviderLocalDebug(BaseUploadProvider):
     """
 
     def __init__(self, target_provider: DebugProviderModel) -> None:
-        pass
+        super().__init__(target_provider)
 
     @override
-    def post_save(self, backup_file: Path) -> str:
-        age_file = core.run_create_age_archive(backup_file=backup_file)
-
-        out_path = config.CONST_DEBUG_FOLDER_PATH / age_file.parent.name / age_file.name
+    def _upload(self, age_backup_file: Path) -> UploadedBackup:
+        out_path = (
+            config.CONST_DEBUG_FOLDER_PATH
+            / age_backup_file.parent.name
+            / age_backup_file.name
+        )
         out_path.parent.mkdir(mode=0o700, exist_ok=True)
 
-        shutil.copy2(age_file, out_path)
+        sha256 = core.copy_file(age_backup_file, out_path, hash_name="sha256")
+        shutil.copystat(age_backup_file, out_path)
+        assert sha256 is not None
+        _write_sha256(out_path, sha256)
 
-        # Clean up source files immediately after copy
-        core.remove_path(age_file)
-        core.remove_path(backup_file)
-        log.info(
-            "removed source files %s and %s from local disk", backup_file, age_file
-        )
+        return UploadedBackup(str(out_path), sha256)
+
+    @override
+    def _upload_stream(
+        self, stream: ChunkedStream, env_name: str, name: str
+    ) -> UploadedBackup:
+        out_path = config.CONST_DEBUG_FOLDER_PATH / env_name / name
+        out_path.parent.mkdir(mode=0o700, exist_ok=True)
+
+        try:
+            with open(out_path, "wb") as file:
+                while chunk := stream.read_chunk(DEBUG_STREAM_CHUNK_SIZE):
+                    file.write(chunk)
+        except BaseException:
+            core.remove_path(out_path)
+            raise
+        core.drop_page_cache(out_path)
+        sha256 = stream.sha256.hexdigest()
+        _write_sha256(out_path, sha256)
 
-        return str(out_path)
+        return UploadedBackup(str(out_path), sha256)
 
     @override
-    def all_target_backups(self, env_name: str) -> list[str]:
-        backups: list[str] = []
+    def _all_target_backups(self, env_name: str) -> list[core.BackupEntry]:
         path = config.CONST_DEBUG_FOLDER_PATH / env_name
         path.mkdir(mode=0o700, exist_ok=True)
-        for backup_path in path.iterdir():
-            backups.append(str(backup_path.absolute()))
-        backups.sort(reverse=True)
-        return backups
+        return core.backup_entries(
+            (
+                str(backup_path.absolute()),
+                backup_path.stat().st_size,
+                None,
+                _read_sha256(backup_path),
+            )
+            for backup_path in path.iterdir()
+        )
 
     @override
-    def download_backup(self, path: str) -> Path:
+    def _all_backups(self) -> list[core.BackupEntry]:
+        return core.backup_entries(
+            (
+                str(backup_path.absolute()),
+                backup_path.stat().st_size,
+                None,
+                _read_sha256(backup_path),
+            )
+            for backup_path in config.CONST_DEBUG_FOLDER_PATH.glob("*/*")
+        )
+
+    @override
+    def download_backup(self, path: str, sha256: str | None = None) -> Path:
         source_path, backup_file = core.get_safe_debug_download_paths(path)
         log.debug("debug provider download backup file %s", backup_file)
-        backup_file.parent.mkdir(parents=True, exist_ok=True)
 
-        # Stream copy to avoid loading entire file into memory
-        with open(source_path, "rb") as src, open(backup_file, "wb") as dst:
-            shutil.copyfileobj(src, dst, length=16 * 1024 * 1024)
+        with (
+            open(source_path, "rb") as source_file,
+            self.download_file(backup_file, sha256) as file,
+        ):
+            shutil.copyfileobj(source_file, file.binary, checksum.CHUNK_SIZE)
 
         return backup_file
 
     @override
-    def clean(
-        self, backup_file: Path, max_backups: int, min_retention_days: int
-    ) -> None:
-        backups = self.all_target_backups(env_name=backup_file.parent.name)
-
-        while len(backups) > max_backups:
-            backup_to_remove = Path(backups.pop())
-            if core.file_before_retention_period_ends(
-                backup_name=backup_to_remove.name, min_retention_days=min_retention_days
-            ):
-                log.info(
-                    "there are more backups than max_backups (%s/%s), "
-                    "but oldest cannot be removed due to min retention days",
-                    len(backups),
-                    max_backups,
-                )
-                break
+    def _stream_backup(self, path: str) -> Iterator[bytes]:
+        source_path, _ = core.get_safe_debug_download_paths(path)
+        with open(source_path, "rb") as file:
+            while chunk := file.read(DEBUG_STREAM_CHUNK_SIZE):
+                yield chunk
+
+    @override
+    def _delete_backups(self, backup_paths: list[str]) -> None:
+        for backup_path in backup_paths:
             try:
-                core.remove_path(backup_to_remove)
-                log.info("removed path %s", backup_to_remove)
+                core.remove_path(Path(backup_path))
+                log.info("removed path %s", backup_path)
             except Exception as e:  # pragma: no cover
-                log.error(
-                    "could not remove path %s: %s", backup_to_remove, e, exc_info=True
-                )
+                log.error("could not remove path %s: %s", backup_path, e, exc_info=True)
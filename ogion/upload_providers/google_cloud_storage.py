@@ -2,25 +2,131 @@
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
 import base64
+import contextlib
+import io
 import json
 import logging
+import math
 import os
+from collections.abc import Iterator
+from http import HTTPStatus
 from pathlib import Path
-from typing import override
+from typing import Any, BinaryIO, cast, override
 
-from ogion import core
+from ogion import bandwidth, core
 from ogion.models.upload_provider_models import GCSProviderModel
-from ogion.upload_providers.base_provider import BaseUploadProvider
+from ogion.upload_providers import checksum
+from ogion.upload_providers.base_provider import BaseUploadProvider, UploadedBackup
+from ogion.upload_providers.stream import ChunkedStream
 
 log = logging.getLogger(__name__)
 
+# https://cloud.google.com/storage/docs/batch
+GCS_BATCH_SIZE = 100
+# https://cloud.google.com/storage/docs/composing-objects
+GCS_MAX_COMPOSE_SOURCES = 32
+GCS_SLICES_PREFIX = "_ogion_slices"
+CONTENT_TYPE = "application/octet-stream"
+
+
+def _slice_name(object_name: str, index: int) -> str:
+    return f"{GCS_SLICES_PREFIX}/{object_name}.{index:05d}"
+
+
+class ReplayableStream:
+    """Chunked stream whose last read can be sent again after seeking back.
+
+    GCS may persist only part of chunk sent in resumable upload, its rest is
+    sent again at the start of the next chunk. Only the last read is kept in
+    memory, so stream can be seeked back only within it.
+    """
+
+    def __init__(self, stream: ChunkedStream) -> None:
+        self._stream = stream
+        self._last_read = b""
+        self._last_read_start = 0
+        self._position = 0
+
+    @property
+    def binary(self) -> BinaryIO:
+        # Wrapper is passed to google-resumable-media expecting binary file
+        return cast(BinaryIO, self)
+
+    def read(self, size: int) -> bytes:
+        replay = self._last_read[self._position - self._last_read_start :]
+        data = replay + self._stream.read_chunk(size - len(replay))
+        self._last_read, self._last_read_start = data, self._position
+        self._position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        last_read_end = self._last_read_start + len(self._last_read)
+        if whence != os.SEEK_SET or not (
+            self._last_read_start <= offset <= last_read_end
+        ):
+            raise io.UnsupportedOperation(
+                f"cannot seek to {offset} outside of last read of stream"
+            )
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+
+class FileSlice(io.RawIOBase):
+    """Read only view of `length` bytes of file starting at `offset`."""
+
+    def __init__(self, path: Path, offset: int, length: int) -> None:
+        super().__init__()
+        self._file = open(path, "rb")  # noqa: SIM115
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    @override
+    def readable(self) -> bool:
+        return True
+
+    @override
+    def seekable(self) -> bool:
+        return True
+
+    @override
+    def readinto(self, buffer: Any) -> int:
+        size = min(len(buffer), self._length - self._position)
+        if size <= 0:
+            return 0
+        self._file.seek(self._offset + self._position)
+        nbytes = self._file.readinto(memoryview(buffer)[:size])
+        self._position += nbytes
+        return nbytes
+
+    @override
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: self._length}
+        self._position = max(0, base[whence] + offset)
+        return self._position
+
+    @override
+    def tell(self) -> int:
+        return self._position
+
+    @override
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
 
 class UploadProviderGCS(BaseUploadProvider):
     """GCS bucket for storing backups"""
 
     def __init__(self, target_provider: GCSProviderModel) -> None:
+        super().__init__(target_provider)
+
         import google.cloud.storage as cloud_storage  # noqa: PLC0415
         from google.auth.credentials import AnonymousCredentials  # noqa: PLC0415
+        from google.auth.transport.requests import AuthorizedSession  # noqa: PLC0415
         from google.oauth2 import service_account  # noqa: PLC0415
 
         service_account_bytes = base64.b64decode(
@@ -35,14 +141,30 @@ class UploadProviderGCS(BaseUploadProvider):
 
         self.storage_client = cloud_storage.Client(credentials=creds)
         self.bucket = self.storage_client.bucket(target_provider.bucket_name)
+        # Resumable uploads are made with google-resumable-media directly,
+        # blob API cannot resume session saved in upload checkpoint
+        self.transport = AuthorizedSession(creds)  # type: ignore[no-untyped-call]
+        self.upload_url = (
+            f"{self.storage_client.api_endpoint}/upload/storage/v1/b/"
+            f"{target_provider.bucket_name}/o"
+            "?uploadType=resumable&ifGenerationMatch=0"
+        )
         self.bucket_upload_path = target_provider.bucket_upload_path
         self.chunk_size_bytes = target_provider.chunk_size_mb * 1024 * 1024
         self.chunk_timeout_secs = target_provider.chunk_timeout_secs
+        self.transfer_workers = target_provider.transfer_workers
 
-    @override
-    def post_save(self, backup_file: Path) -> str:
-        age_backup_file = core.run_create_age_archive(backup_file=backup_file)
+    def _use_transfer_manager(self) -> bool:
+        if self.transfer_workers <= 1:
+            return False
+        if bandwidth.current_limit():
+            # Transfer manager workers read and write files on their own
+            log.info("bandwidth limit is active, using single stream transfer")
+            return False
+        return True
 
+    @override
+    def _upload(self, age_backup_file: Path) -> UploadedBackup:
         backup_dest_in_bucket = (
             f"{self.bucket_upload_path}/"
             f"{age_backup_file.parent.name}/"
@@ -52,74 +174,354 @@ class UploadProviderGCS(BaseUploadProvider):
         log.info("start uploading %s to %s", age_backup_file, backup_dest_in_bucket)
 
         blob = self.bucket.blob(backup_dest_in_bucket, chunk_size=self.chunk_size_bytes)
-        blob.upload_from_filename(
-            age_backup_file,
-            timeout=self.chunk_timeout_secs,
-            if_generation_match=0,
-            checksum="md5",
-        )
+        size = age_backup_file.stat().st_size
+        if size <= self.chunk_size_bytes:
+            with open(age_backup_file, "rb") as file:
+                checksum_file = checksum.ChecksumFile(file)
+                blob.upload_from_file(
+                    bandwidth.throttle(checksum_file.binary),
+                    size=size,
+                    timeout=self.chunk_timeout_secs,
+                    if_generation_match=0,
+                    checksum="md5",
+                )
+            sha256 = checksum_file.hexdigest()
+        elif self._use_transfer_manager():
+            sha256 = self._composite_upload(
+                backup_dest_in_bucket, age_backup_file, size
+            )
+        else:
+            sha256 = self._resumable_upload(
+                backup_dest_in_bucket, age_backup_file, size
+            )
+        self._store_sha256(blob, sha256)
 
         log.info("uploaded %s to %s", age_backup_file, backup_dest_in_bucket)
 
-        core.remove_path(age_backup_file)
-        core.remove_path(backup_file)
+        return UploadedBackup(backup_dest_in_bucket, sha256)
 
-        log.info("removed %s and %s from local disk", backup_file, age_backup_file)
+    def _store_sha256(self, blob: Any, sha256: str | None) -> None:
+        # Metadata is sent before object data, so sha256 known only at the end
+        # of upload is patched in, only metadata fields are sent
+        if sha256 is None:
+            return
+        blob.metadata = {checksum.SHA256_KEY: sha256}
+        blob.patch(timeout=self.chunk_timeout_secs)
 
-        return backup_dest_in_bucket
+    def _recover(
+        self, upload: Any, session_url: str, stream: BinaryIO, size: int
+    ) -> Any:
+        # Session saved in checkpoint is attached to new upload the same way
+        # as in google-resumable-media docs, then its persisted offset is
+        # recovered. Returns final response if session is already finished
+        from google.resumable_media import common  # noqa: PLC0415
 
-    @override
-    def all_target_backups(self, env_name: str) -> list[str]:
-        backups: list[str] = []
-        prefix = f"{self.bucket_upload_path}/{env_name}/"
-        for blob in self.storage_client.list_blobs(self.bucket, prefix=prefix):
-            backups.append(blob.name)
+        upload._resumable_url = session_url
+        upload._stream = stream
+        upload._total_bytes = size
+        upload._content_type = CONTENT_TYPE
+        try:
+            upload.recover(self.transport)
+        except common.InvalidResponse as err:
+            if err.response.status_code in {HTTPStatus.OK, HTTPStatus.CREATED}:
+                return err.response
+            raise
+        return None
+
+    def _transmit(self, upload: Any, stream: BinaryIO) -> Any:
+        # GCS may persist only part of chunk, its rest is read again
+        response = None
+        while not upload.finished:
+            response = upload.transmit_next_chunk(
+                self.transport, timeout=self.chunk_timeout_secs
+            )
+            stream.seek(upload.bytes_uploaded)
+        return response
+
+    def _resumable_upload(
+        self, object_name: str, age_backup_file: Path, size: int
+    ) -> str | None:
+        # Session URI is saved before first chunk, so failed or interrupted
+        # upload recovers persisted offset from GCS and continues from there.
+        # Returns sha256 hashed with md5 checked by GCS in the same pass
+        from google.resumable_media import common  # noqa: PLC0415
+        from google.resumable_media.requests import ResumableUpload  # noqa: PLC0415
+
+        upload_checkpoint = self.upload_checkpoint(age_backup_file)
+        state = upload_checkpoint.load()
+        upload = ResumableUpload(self.upload_url, self.chunk_size_bytes)  # type: ignore[no-untyped-call]
+        response = None
+        with open(age_backup_file, "rb") as raw_file:
+            file = checksum.ChecksumFile(raw_file, "md5", "sha256")
+            stream = bandwidth.throttle(file.binary)
+            if (
+                state is None
+                or state.get("kind") != "resumable"
+                or state["object_name"] != object_name
+            ):
+                upload.initiate(  # type: ignore[no-untyped-call]
+                    self.transport,
+                    stream,
+                    metadata={"name": object_name},
+                    content_type=CONTENT_TYPE,
+                    total_bytes=size,
+                    timeout=self.chunk_timeout_secs,
+                )
+                upload_checkpoint.save(
+                    {
+                        "kind": "resumable",
+                        "object_name": object_name,
+                        "session_url": upload.resumable_url,
+                    }
+                )
+            else:
+                try:
+                    response = self._recover(upload, state["session_url"], stream, size)
+                except common.InvalidResponse as err:
+                    if err.response.status_code in {
+                        HTTPStatus.NOT_FOUND,
+                        HTTPStatus.GONE,
+                    }:
+                        log.warning("upload session of %s expired", age_backup_file)
+                        upload_checkpoint.clear()
+                    raise
+                offset = size if response is not None else upload.bytes_uploaded
+                log.info(
+                    "resuming upload of %s from %s",
+                    age_backup_file,
+                    core.size_mb(offset),
+                )
+                # Bytes persisted before are read again only to hash them
+                file.seek(0)
+                while file.tell() < offset:
+                    file.read(min(self.chunk_size_bytes, offset - file.tell()))
+            if response is None:
+                response = self._transmit(upload, stream)
 
-        backups.sort(reverse=True)
-        return backups
+        md5_digest = file.digest("md5")
+        assert md5_digest is not None
+        md5_hash = base64.b64encode(md5_digest).decode()
+        if response.json().get("md5Hash", md5_hash) != md5_hash:
+            self.bucket.blob(object_name).delete(timeout=self.chunk_timeout_secs)
+            upload_checkpoint.clear()
+            raise ValueError(
+                f"md5 of uploaded {object_name} does not match local {age_backup_file}"
+            )
+        return file.hexdigest("sha256")
 
     @override
-    def download_backup(self, path: str) -> Path:
-        backup_file = core.get_safe_download_path(path)
-        backup_file.parent.mkdir(parents=True, exist_ok=True)
+    def _upload_stream(
+        self, stream: ChunkedStream, env_name: str, name: str
+    ) -> UploadedBackup:
+        # Resumable session of unknown size, total size is sent with the last
+        # chunk. Chunk is kept in memory until GCS persists all of it
+        from google.resumable_media.requests import ResumableUpload  # noqa: PLC0415
 
-        blob = self.bucket.blob(path, chunk_size=self.chunk_size_bytes)
-        blob.download_to_filename(
-            backup_file,
+        object_name = f"{self.bucket_upload_path}/{env_name}/{name}"
+        log.info("start uploading stream to %s", object_name)
+
+        upload = ResumableUpload(self.upload_url, self.chunk_size_bytes)  # type: ignore[no-untyped-call]
+        replayable_stream = ReplayableStream(stream).binary
+        upload.initiate(  # type: ignore[no-untyped-call]
+            self.transport,
+            replayable_stream,
+            metadata={"name": object_name},
+            content_type=CONTENT_TYPE,
+            stream_final=False,
             timeout=self.chunk_timeout_secs,
         )
+        response = self._transmit(upload, replayable_stream)
 
-        return backup_file
+        blob = self.bucket.blob(object_name)
+        md5_hash = base64.b64encode(stream.md5.digest()).decode()
+        if response.json().get("md5Hash", md5_hash) != md5_hash:
+            blob.delete(timeout=self.chunk_timeout_secs)
+            raise ValueError(f"md5 of uploaded {object_name} does not match stream")
+        sha256 = stream.sha256.hexdigest()
+        self._store_sha256(blob, sha256)
+
+        return UploadedBackup(object_name, sha256)
 
     @override
-    def clean(
-        self, backup_file: Path, max_backups: int, min_retention_days: int
-    ) -> None:
-        from google.api_core.exceptions import NotFound  # noqa: PLC0415
-
-        # Local files already cleaned up in post_save()
-        backups = self.all_target_backups(env_name=backup_file.parent.name)
-        while len(backups) > max_backups:
-            backup_to_remove = backups.pop()
-            file_name = backup_to_remove.split("/")[-1]
-            if core.file_before_retention_period_ends(
-                backup_name=file_name, min_retention_days=min_retention_days
-            ):
-                log.info(
-                    "there are more backups than max_backups (%s/%s), "
-                    "but oldest cannot be removed due to min retention days",
-                    len(backups),
-                    max_backups,
+    def _abort_upload(self, state: dict[str, Any]) -> None:
+        if state.get("kind") == "resumable":
+            # https://cloud.google.com/storage/docs/performing-resumable-uploads#cancel-upload
+            self.transport.delete(state["session_url"], timeout=self.chunk_timeout_secs)
+        elif state.get("kind") == "composite":
+            # Uploaded slices are stored and billed until they are deleted
+            self.bucket.delete_blobs(
+                [
+                    self.bucket.blob(_slice_name(state["object_name"], index))
+                    for index in state["slices"]
+                ],
+                on_error=lambda blob: None,
+                timeout=self.chunk_timeout_secs,
+            )
+
+    def _composite_upload(
+        self, object_name: str, age_backup_file: Path, size: int
+    ) -> str:
+        # Slices of chunk_size_mb are uploaded as temporary objects outside of
+        # bucket_upload_path in parallel and composed into backup. Uploaded
+        # slices are saved, so failed or interrupted upload skips them.
+        # Slices are read out of order, so sha256 needs its own local read
+        from google.cloud.storage import transfer_manager  # noqa: PLC0415
+
+        upload_checkpoint = self.upload_checkpoint(age_backup_file)
+        state = upload_checkpoint.load()
+        if (
+            state is None
+            or state.get("kind") != "composite"
+            or state["object_name"] != object_name
+        ):
+            state = {
+                "kind": "composite",
+                "object_name": object_name,
+                "slice_size": self.chunk_size_bytes,
+                "slices": [],
+            }
+            upload_checkpoint.save(state)
+        else:
+            log.info(
+                "resuming upload of %s, %s slices already uploaded",
+                age_backup_file,
+                len(state["slices"]),
+            )
+
+        slice_size: int = state["slice_size"]
+        uploaded_slices: list[int] = state["slices"]
+        slice_blobs = [
+            self.bucket.blob(_slice_name(object_name, index))
+            for index in range(math.ceil(size / slice_size))
+        ]
+        pending = [
+            index for index in range(len(slice_blobs)) if index not in uploaded_slices
+        ]
+        with contextlib.ExitStack() as stack:
+            file_blob_pairs = [
+                (
+                    stack.enter_context(
+                        FileSlice(
+                            age_backup_file,
+                            offset=index * slice_size,
+                            length=min(slice_size, size - index * slice_size),
+                        )
+                    ),
+                    slice_blobs[index],
                 )
-                break
+                for index in pending
+            ]
+            results = transfer_manager.upload_many(
+                file_blob_pairs,
+                upload_kwargs={"timeout": self.chunk_timeout_secs, "checksum": "md5"},
+                worker_type=transfer_manager.THREAD,
+                max_workers=self.transfer_workers,
+            )
 
-            blob = self.bucket.blob(backup_to_remove)
-            try:
-                blob.delete()
-                log.info(
-                    "deleted backup %s from google cloud storage", backup_to_remove
+        errors = [result for result in results if isinstance(result, Exception)]
+        uploaded_slices.extend(
+            index
+            for index, result in zip(pending, results, strict=True)
+            if not isinstance(result, Exception)
+        )
+        upload_checkpoint.save(state)
+        if errors:
+            raise errors[0]
+
+        blob = self.bucket.blob(object_name)
+        blob.compose(
+            slice_blobs[:GCS_MAX_COMPOSE_SOURCES], timeout=self.chunk_timeout_secs
+        )
+        for i in range(
+            GCS_MAX_COMPOSE_SOURCES, len(slice_blobs), GCS_MAX_COMPOSE_SOURCES - 1
+        ):
+            blob.compose(
+                [blob, *slice_blobs[i : i + GCS_MAX_COMPOSE_SOURCES - 1]],
+                timeout=self.chunk_timeout_secs,
+            )
+        self.bucket.delete_blobs(
+            slice_blobs, on_error=lambda blob: None, timeout=self.chunk_timeout_secs
+        )
+        return checksum.file_sha256(age_backup_file)
+
+    @override
+    def _all_target_backups(self, env_name: str) -> list[core.BackupEntry]:
+        return self._list_entries(prefix=f"{self.bucket_upload_path}/{env_name}/")
+
+    @override
+    def _all_backups(self) -> list[core.BackupEntry]:
+        return self._list_entries(prefix=f"{self.bucket_upload_path}/")
+
+    def _list_entries(self, prefix: str) -> list[core.BackupEntry]:
+        return core.backup_entries(
+            (blob.name, blob.size, blob.etag, checksum.metadata_sha256(blob.metadata))
+            for blob in self.storage_client.list_blobs(self.bucket, prefix=prefix)
+        )
+
+    @override
+    def download_backup(self, path: str, sha256: str | None = None) -> Path:
+        backup_file = core.get_safe_download_path(path)
+
+        blob = self.bucket.blob(path, chunk_size=self.chunk_size_bytes)
+        with self.download_file(backup_file, sha256) as file:
+            if self._use_transfer_manager():
+                from google.cloud.storage import transfer_manager  # noqa: PLC0415
+
+                transfer_manager.download_chunks_concurrently(
+                    blob,
+                    file.name,
+                    chunk_size=self.chunk_size_bytes,
+                    download_kwargs={"timeout": self.chunk_timeout_secs},
+                    worker_type=transfer_manager.THREAD,
+                    max_workers=self.transfer_workers,
                 )
-            except NotFound:
-                log.info(
-                    "backup %s already deleted (concurrent cleanup)", backup_to_remove
+                # Workers write chunks to file on their own, it is read again
+                file.complete = False
+            else:
+                blob.download_to_file(
+                    bandwidth.throttle(file.binary),
+                    timeout=self.chunk_timeout_secs,
                 )
+
+        return backup_file
+
+    @override
+    def _stream_backup(self, path: str) -> Iterator[bytes]:
+        blob = self.bucket.blob(path, chunk_size=self.chunk_size_bytes)
+        with blob.open(
+            "rb",
+            chunk_size=self.chunk_size_bytes,
+            timeout=self.chunk_timeout_secs,
+            raw_download=True,
+        ) as reader:
+            while chunk := reader.read(self.chunk_size_bytes):
+                yield chunk
+
+    @override
+    def _delete_backups(self, backup_paths: list[str]) -> None:
+        for i in range(0, len(backup_paths), GCS_BATCH_SIZE):
+            paths_batch = backup_paths[i : i + GCS_BATCH_SIZE]
+            with self.storage_client.batch(raise_exception=False):
+                for backup_path in paths_batch:
+                    self.bucket.blob(backup_path).delete()
+
+        # Batch does not expose result of every request, failed deletes are
+        # found by one listing of every prefix after all batches, backups
+        # deleted by concurrent cleanup are gone
+        errors = self._existing_blobs(backup_paths)
+        if errors:
+            raise RuntimeError(
+                f"Fail to delete backups from google cloud storage: {errors}"
+            )
+        log.info("deleted %s backups from google cloud storage", len(backup_paths))
+
+    def _existing_blobs(self, backup_paths: list[str]) -> list[str]:
+        prefixes = {path.rpartition("/")[0] for path in backup_paths}
+        existing = {
+            blob.name
+            for prefix in prefixes
+            for blob in self.storage_client.list_blobs(
+                self.bucket, prefix=f"{prefix}/" if prefix else None
+            )
+        }
+        return [path for path in backup_paths if path in existing]
@@ -0,0 +1,184 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from ogion import config, core
+from ogion.models.upload_provider_models import ProviderModel
+
+log = logging.getLogger(__name__)
+
+
+class ListingIndex:
+    """Local cache of backups stored in upload provider, one file per target.
+
+    Full provider listing is done only when index file is missing or older
+    than BACKUP_LISTING_INDEX_TTL_SECS, otherwise index is updated in place
+    after every upload and cleanup. Updates hold `flock` of the target lock
+    file, as backup worker processes share the index with the main process.
+    """
+
+    def __init__(self, provider_model: ProviderModel) -> None:
+        # Namespace also keys spooled uploads and upload checkpoints, so only
+        # changed location of backups makes provider a different one
+        self.namespace = hashlib.md5(
+            json.dumps(provider_model.location).encode(), usedforsecurity=False
+        ).hexdigest()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return config.options.BACKUP_LISTING_INDEX_TTL_SECS > 0
+
+    def index_path(self, env_name: str) -> Path:
+        return config.CONST_INDEX_FOLDER_PATH / self.namespace / f"{env_name}.json"
+
+    def _can_index(self, env_name: str) -> bool:
+        return (
+            self.enabled
+            and bool(env_name)
+            and core.safe_text_version(env_name) == env_name
+        )
+
+    @contextmanager
+    def _locked(self, env_name: str) -> Iterator[None]:
+        path = self.index_path(env_name)
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with (
+            self._lock,
+            open(path.with_suffix(".lock"), "a") as lock_file,
+        ):
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _read(self, env_name: str) -> tuple[float, list[core.BackupEntry]] | None:
+        try:
+            data = json.loads(self.index_path(env_name).read_text())
+            return float(data["reconciled_at"]), [
+                core.BackupEntry(
+                    key=entry["key"],
+                    timestamp=datetime.fromisoformat(entry["timestamp"]),
+                    target=entry["target"],
+                    codec=entry["codec"],
+                    size=entry["size"],
+                    etag=entry["etag"],
+                    sha256=entry.get("sha256"),
+                )
+                for entry in data["backups"]
+            ]
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as err:
+            log.warning("invalid listing index for `%s`, ignoring: %s", env_name, err)
+            return None
+
+    def _write(
+        self,
+        env_name: str,
+        reconciled_at: float,
+        backups: list[core.BackupEntry],
+    ) -> None:
+        path = self.index_path(env_name)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, prefix=f"{env_name}.", suffix=".tmp", delete=False
+        ) as tmp_file:
+            json.dump(
+                {
+                    "reconciled_at": reconciled_at,
+                    "backups": [
+                        entry._asdict() | {"timestamp": entry.timestamp.isoformat()}
+                        for entry in backups
+                    ],
+                },
+                tmp_file,
+            )
+        try:
+            os.replace(tmp_file.name, path)
+        except OSError:
+            os.unlink(tmp_file.name)
+            raise
+
+    def backups(
+        self,
+        env_name: str,
+        list_backups: Callable[[str], list[core.BackupEntry]],
+    ) -> list[core.BackupEntry]:
+        if not self._can_index(env_name):
+            return list_backups(env_name)
+
+        with self._locked(env_name):
+            index = self._read(env_name)
+            ttl = config.options.BACKUP_LISTING_INDEX_TTL_SECS
+            if index is not None and time.time() - index[0] < ttl:
+                log.debug("using listing index for `%s`", env_name)
+                return index[1]
+
+            log.debug("reconciling listing index for `%s`", env_name)
+            backups = list_backups(env_name)
+            if index is not None:
+                backups = self._keep_sha256(index[1], backups)
+            self._write(env_name, time.time(), backups)
+            return backups
+
+    @staticmethod
+    def _keep_sha256(
+        indexed: list[core.BackupEntry], listed: list[core.BackupEntry]
+    ) -> list[core.BackupEntry]:
+        # Providers without sha256 in listings (S3 keeps it in object tags)
+        # keep the one recorded after upload, unless object size changed
+        known = {
+            (entry.key, entry.size): entry.sha256 for entry in indexed if entry.sha256
+        }
+        return [
+            entry
+            if entry.sha256
+            else entry._replace(sha256=known.get((entry.key, entry.size)))
+            for entry in listed
+        ]
+
+    def replace(self, env_name: str, backups: list[core.BackupEntry]) -> None:
+        if not self._can_index(env_name):
+            return
+
+        with self._locked(env_name):
+            self._write(env_name, time.time(), backups)
+
+    def add(self, env_name: str, entry: core.BackupEntry) -> None:
+        if not self._can_index(env_name):
+            return
+
+        with self._locked(env_name):
+            index = self._read(env_name)
+            if index is None:
+                return
+            reconciled_at, backups = index
+            backups = [backup for backup in backups if backup.key != entry.key]
+            backups.append(entry)
+            self._write(env_name, reconciled_at, core.sort_backup_entries(backups))
+
+    def remove(self, env_name: str, backup_paths: Iterable[str]) -> None:
+        if not self._can_index(env_name):
+            return
+
+        with self._locked(env_name):
+            index = self._read(env_name)
+            if index is None:
+                return
+            reconciled_at, backups = index
+            to_remove = set(backup_paths)
+            self._write(
+                env_name,
+                reconciled_at,
+                [backup for backup in backups if backup.key not in to_remove],
+            )
@@ -1,25 +1,37 @@
 # Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
+import io
 import logging
+import math
+from collections.abc import Iterator
 from pathlib import Path
-from typing import override
+from typing import Any, BinaryIO, override
 
-from ogion import core
+from ogion import bandwidth, core
 from ogion.models.upload_provider_models import S3ProviderModel
-from ogion.upload_providers.base_provider import BaseUploadProvider
+from ogion.upload_providers import checksum
+from ogion.upload_providers.base_provider import BaseUploadProvider, UploadedBackup
+from ogion.upload_providers.stream import ChunkedStream
 
 log = logging.getLogger(__name__)
 
+S3_MIN_PART_SIZE = 64 * 1024 * 1024
+S3_MAX_PARTS = 10000
+S3_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class UploadProviderS3(BaseUploadProvider):
     """S3 compatibile storage bucket for storing backups"""
 
     def __init__(self, target_provider: S3ProviderModel) -> None:
+        super().__init__(target_provider)
+
         from minio import Minio  # noqa: PLC0415
 
         self.bucket_upload_path = target_provider.bucket_upload_path
-        self.max_bandwidth = target_provider.max_bandwidth
+        # Bytes per second of this provider, on top of BANDWIDTH_LIMIT_MB_PER_SEC
+        self.max_bandwidth = target_provider.max_bandwidth or 0
 
         self.client = Minio(
             target_provider.endpoint,
@@ -33,10 +45,20 @@ class UploadProviderS3(BaseUploadProvider):
 
         self.bucket = target_provider.bucket_name
 
-    @override
-    def post_save(self, backup_file: Path) -> str:
-        age_backup_file = core.run_create_age_archive(backup_file=backup_file)
+    def _throttle(self, file: BinaryIO) -> BinaryIO:
+        return bandwidth.throttle(
+            file, bucket=self.listing_index.namespace, limit=self.max_bandwidth
+        )
+
+    def _consume(self, nbytes: int) -> None:
+        # Only provider bucket, stream is already limited by global one
+        if self.max_bandwidth:
+            bandwidth.LIMITER.consume(
+                nbytes, {self.listing_index.namespace: self.max_bandwidth}
+            )
 
+    @override
+    def _upload(self, age_backup_file: Path) -> UploadedBackup:
         backup_dest_in_bucket = (
             f"{self.bucket_upload_path}/"
             f"{age_backup_file.parent.name}/"
@@ -45,82 +67,236 @@ class UploadProviderS3(BaseUploadProvider):
 
         log.info("start uploading %s to %s", age_backup_file, backup_dest_in_bucket)
 
-        self.client.fput_object(
-            bucket_name=self.bucket,
-            object_name=backup_dest_in_bucket,
-            file_path=str(age_backup_file),
-        )
+        size = age_backup_file.stat().st_size
+        if size <= S3_MIN_PART_SIZE:
+            with open(age_backup_file, "rb") as file:
+                checksum_file = checksum.ChecksumFile(file)
+                self.client.put_object(
+                    bucket_name=self.bucket,
+                    object_name=backup_dest_in_bucket,
+                    data=self._throttle(checksum_file.binary),
+                    length=size,
+                )
+            sha256 = checksum_file.hexdigest()
+        else:
+            sha256 = self._multipart_upload(
+                age_backup_file, backup_dest_in_bucket, size
+            )
+        self._store_sha256(backup_dest_in_bucket, sha256)
 
         log.info("uploaded %s to %s", age_backup_file, backup_dest_in_bucket)
 
-        core.remove_path(age_backup_file)
-        core.remove_path(backup_file)
+        return UploadedBackup(backup_dest_in_bucket, sha256)
+
+    def _store_sha256(self, object_name: str, sha256: str | None) -> None:
+        # Metadata of S3 object cannot be changed after upload without copying
+        # it, sha256 known only at the end of upload is stored in object tag
+        from minio.commonconfig import Tags  # noqa: PLC0415
+        from minio.error import S3Error  # noqa: PLC0415
+
+        if sha256 is None:
+            return
+        tags = Tags.new_object_tags()
+        tags[checksum.SHA256_KEY] = sha256
+        try:
+            self.client.set_object_tags(self.bucket, object_name, tags)
+        except S3Error as err:
+            # Backup is uploaded, sha256 is still kept in local listing index
+            log.warning("could not tag %s with sha256: %s", object_name, err)
+
+    def _multipart_upload(
+        self, age_backup_file: Path, object_name: str, size: int
+    ) -> str | None:
+        # Upload id and etags of uploaded parts are saved after every part,
+        # so failed or interrupted upload continues from the last part. Parts
+        # already uploaded are only read to hash them, returns sha256 of file.
+        # Upload not spooled for retry is aborted in `_abort_upload`
+        from minio.datatypes import Part  # noqa: PLC0415
+        from minio.error import S3Error  # noqa: PLC0415
+
+        upload_checkpoint = self.upload_checkpoint(age_backup_file)
+        state = upload_checkpoint.load()
+        if state is None or state["object_name"] != object_name:
+            part_size = max(S3_MIN_PART_SIZE, math.ceil(size / S3_MAX_PARTS))
+            state = {
+                "object_name": object_name,
+                "upload_id": self.client._create_multipart_upload(
+                    self.bucket, object_name, {}
+                ),
+                "part_size": part_size,
+                "parts": {},
+            }
+            upload_checkpoint.save(state)
+        else:
+            log.info(
+                "resuming upload of %s, %s parts already uploaded",
+                age_backup_file,
+                len(state["parts"]),
+            )
+
+        part_size = state["part_size"]
+        parts: dict[str, str] = state["parts"]
+        try:
+            with open(age_backup_file, "rb") as raw_file:
+                checksum_file = checksum.ChecksumFile(raw_file)
+                file = self._throttle(checksum_file.binary)
+                for part_number in range(1, math.ceil(size / part_size) + 1):
+                    if str(part_number) in parts:
+                        checksum_file.read(part_size)
+                        continue
+                    parts[str(part_number)] = self.client._upload_part(
+                        self.bucket,
+                        object_name,
+                        file.read(part_size),
+                        None,
+                        state["upload_id"],
+                        part_number,
+                    )
+                    upload_checkpoint.save(state)
+
+            self.client._complete_multipart_upload(
+                self.bucket,
+                object_name,
+                state["upload_id"],
+                [
+                    Part(part_number=int(part_number), etag=etag)
+                    for part_number, etag in sorted(
+                        parts.items(), key=lambda part: int(part[0])
+                    )
+                ],
+            )
+        except S3Error as err:
+            if err.code == "NoSuchUpload":
+                log.warning("multipart upload of %s expired, restarting", object_name)
+                upload_checkpoint.clear()
+            raise
+
+        return checksum_file.hexdigest()
+
+    @override
+    def _abort_upload(self, state: dict[str, Any]) -> None:
+        # Parts of multipart upload are stored and billed until it is aborted
+        self.client._abort_multipart_upload(
+            self.bucket, state["object_name"], state["upload_id"]
+        )
+
+    @override
+    def _upload_stream(
+        self, stream: ChunkedStream, env_name: str, name: str
+    ) -> UploadedBackup:
+        # Parts are uploaded as soon as they are read, with S3_MAX_PARTS parts
+        # of S3_MIN_PART_SIZE stream can be up to 640GB
+        from minio.datatypes import Part  # noqa: PLC0415
 
-        log.info("removed %s and %s from local disk", backup_file, age_backup_file)
+        object_name = f"{self.bucket_upload_path}/{env_name}/{name}"
+        log.info("start uploading stream to %s", object_name)
 
-        return backup_dest_in_bucket
+        upload_id = ""
+        parts: list[Part] = []
+        try:
+            for part_number, (chunk, is_last) in enumerate(
+                stream.chunks(S3_MIN_PART_SIZE), start=1
+            ):
+                # Stream itself is limited by BANDWIDTH_LIMIT_MB_PER_SEC
+                self._consume(len(chunk))
+                if part_number == 1 and is_last:
+                    self.client.put_object(
+                        bucket_name=self.bucket,
+                        object_name=object_name,
+                        data=io.BytesIO(chunk),
+                        length=len(chunk),
+                    )
+                    break
+                if not upload_id:
+                    upload_id = self.client._create_multipart_upload(
+                        self.bucket, object_name, {}
+                    )
+                etag = self.client._upload_part(
+                    self.bucket, object_name, chunk, None, upload_id, part_number
+                )
+                parts.append(Part(part_number=part_number, etag=etag))
+
+            if upload_id:
+                self.client._complete_multipart_upload(
+                    self.bucket, object_name, upload_id, parts
+                )
+        except BaseException:
+            if upload_id:
+                self.client._abort_multipart_upload(self.bucket, object_name, upload_id)
+            raise
+        sha256 = stream.sha256.hexdigest()
+        self._store_sha256(object_name, sha256)
+
+        return UploadedBackup(object_name, sha256)
 
     @override
-    def all_target_backups(self, env_name: str) -> list[str]:
-        backups: list[str] = []
-        prefix = f"{self.bucket_upload_path}/{env_name}/"
+    def _all_target_backups(self, env_name: str) -> list[core.BackupEntry]:
+        return self._list_entries(prefix=f"{self.bucket_upload_path}/{env_name}/")
 
-        for bucket_obj in self.client.list_objects(
-            self.bucket, prefix=prefix, recursive=True
-        ):
-            if bucket_obj.object_name:
-                backups.append(bucket_obj.object_name)
+    @override
+    def _all_backups(self) -> list[core.BackupEntry]:
+        return self._list_entries(prefix=f"{self.bucket_upload_path}/")
 
-        backups.sort(reverse=True)
-        return backups
+    def _list_entries(self, prefix: str) -> list[core.BackupEntry]:
+        return core.backup_entries(
+            (bucket_obj.object_name, bucket_obj.size, bucket_obj.etag, None)
+            for bucket_obj in self.client.list_objects(
+                self.bucket, prefix=prefix, recursive=True
+            )
+            if bucket_obj.object_name
+        )
 
     @override
-    def download_backup(self, path: str) -> Path:
+    def download_backup(self, path: str, sha256: str | None = None) -> Path:
         backup_file = core.get_safe_download_path(path)
-        backup_file.parent.mkdir(parents=True, exist_ok=True)
-        backup_file.touch(exist_ok=True)
 
-        self.client.fget_object(
-            self.bucket, object_name=path, file_path=str(backup_file)
-        )
+        response = self.client.get_object(self.bucket, object_name=path)
+        try:
+            with self.download_file(backup_file, sha256) as file:
+                throttled_file = self._throttle(file.binary)
+                for data in response.stream(S3_DOWNLOAD_CHUNK_SIZE):
+                    throttled_file.write(data)
+        finally:
+            response.close()
+            response.release_conn()
 
         return backup_file
 
     @override
-    def clean(
-        self, backup_file: Path, max_backups: int, min_retention_days: int
-    ) -> None:
-        from minio.deleteobjects import DeleteObject  # noqa: PLC0415
+    def _stream_backup(self, path: str) -> Iterator[bytes]:
+        response = self.client.get_object(self.bucket, object_name=path)
+        try:
+            for chunk in response.stream(S3_DOWNLOAD_CHUNK_SIZE):
+                self._consume(len(chunk))
+                yield chunk
+        finally:
+            response.close()
+            response.release_conn()
 
-        items_to_delete: list[DeleteObject] = []
-        backups = self.all_target_backups(env_name=backup_file.parent.name)
+    @override
+    def stored_sha256(self, entry: core.BackupEntry) -> str | None:
+        # Listing does not include object tags, they are fetched only for
+        # backups whose sha256 is missing in listing index
+        from minio.error import S3Error  # noqa: PLC0415
 
-        while len(backups) > max_backups:
-            backup_to_remove = backups.pop()
-            file_name = backup_to_remove.split("/")[-1]
-            if core.file_before_retention_period_ends(
-                backup_name=file_name, min_retention_days=min_retention_days
-            ):
-                log.info(
-                    "there are more backups than max_backups (%s/%s), "
-                    "but oldest cannot be removed due to min retention days",
-                    len(backups),
-                    max_backups,
-                )
-                break
+        if entry.sha256 is not None:
+            return entry.sha256
+        try:
+            tags = self.client.get_object_tags(self.bucket, entry.key)
+        except S3Error as err:
+            log.warning("could not read sha256 tag of %s: %s", entry.key, err)
+            return None
+        return checksum.metadata_sha256(tags)
 
-            items_to_delete.append(DeleteObject(name=backup_to_remove))
-            log.info("backup %s will be deleted from s3 bucket", backup_to_remove)
+    @override
+    def _delete_backups(self, backup_paths: list[str]) -> None:
+        from minio.deleteobjects import DeleteObject  # noqa: PLC0415
 
-        if items_to_delete:
-            delete_response = self.client.remove_objects(
-                self.bucket, delete_object_list=items_to_delete
-            )
-            # Filter out NoSuchKey errors (happens with concurrent cleanup)
-            errors = [error for error in delete_response if error.code != "NoSuchKey"]
-            if errors:
-                raise RuntimeError("Fail to delete backups from s3: %s", errors)
-            log.info(
-                "%s backups were successfully deleted from s3 bucket",
-                len(items_to_delete),
-            )
+        delete_response = self.client.remove_objects(
+            self.bucket,
+            delete_object_list=[DeleteObject(name=path) for path in backup_paths],
+        )
+        # Filter out NoSuchKey errors (happens with concurrent cleanup)
+        errors = [error for error in delete_response if error.code != "NoSuchKey"]
+        if errors:
+            raise RuntimeError("Fail to delete backups from s3: %s", errors)
@@ -0,0 +1,216 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import collections
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections.abc import Callable, Mapping, Sequence
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Self
+
+from ogion import config, core, metrics
+from ogion.upload_providers import checkpoint
+
+log = logging.getLogger(__name__)
+
+RETRY_MAX_SECS = 3600
+STATE_SUFFIX = ".json"
+PARTIAL_SUFFIX = ".part"
+
+
+@dataclass
+class SpoolItem:
+    path: Path
+    created_at: float = field(default_factory=time.time)
+    attempts: int = 0
+    next_attempt_at: float = 0
+    last_error: str = ""
+    providers: list[str] = field(default_factory=list)
+
+    @property
+    def env_name(self) -> str:
+        return self.path.parent.name
+
+    @property
+    def state_path(self) -> Path:
+        return self.path.with_name(self.path.name + STATE_SUFFIX)
+
+    @classmethod
+    def load(cls, path: Path) -> Self:
+        try:
+            data = json.loads(path.with_name(path.name + STATE_SUFFIX).read_text())
+            return cls(path=path, **data)
+        except FileNotFoundError:
+            # Spooled file without state, saving it was interrupted by restart
+            return cls(path=path, created_at=path.stat().st_mtime)
+        except (ValueError, TypeError) as err:
+            log.warning("invalid spool state of %s, ignoring: %s", path, err)
+            return cls(path=path, created_at=path.stat().st_mtime)
+
+    def save(self) -> None:
+        data = asdict(self)
+        del data["path"]
+        tmp_path = self.state_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data))
+        os.replace(tmp_path, self.state_path)
+
+    def remove(self) -> None:
+        core.remove_path(self.path)
+        core.remove_path(self.state_path)
+        for checkpoint_path in checkpoint.checkpoint_paths(self.path):
+            core.remove_path(checkpoint_path)
+
+
+class UploadSpool:
+    """Encrypted backups waiting for upload after it failed, one file per backup.
+
+    Spooled backups are kept on disk across restarts, up to
+    UPLOAD_SPOOL_MAX_SIZE_MB, and retried oldest first with exponential
+    backoff independently of backup cron rules. Each backup remembers
+    upload providers it is still missing from, empty list means all of them.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return config.options.UPLOAD_SPOOL_MAX_SIZE_MB > 0
+
+    def items(self) -> list[SpoolItem]:
+        if not config.CONST_SPOOL_FOLDER_PATH.exists():
+            return []
+        items: list[SpoolItem] = []
+        for path in config.CONST_SPOOL_FOLDER_PATH.glob("*/*.age"):
+            try:
+                items.append(SpoolItem.load(path))
+            except FileNotFoundError:
+                continue
+        return sorted(items, key=lambda item: item.created_at)
+
+    def due(self, now: float | None = None) -> list[SpoolItem]:
+        now = time.time() if now is None else now
+        return [item for item in self.items() if item.next_attempt_at <= now]
+
+    def add(
+        self, age_backup_file: Path, providers: Sequence[str] = ()
+    ) -> SpoolItem | None:
+        if not self.enabled:
+            return None
+
+        max_size = config.options.UPLOAD_SPOOL_MAX_SIZE_MB * 1024 * 1024
+        size = age_backup_file.stat().st_size
+        if size > max_size:
+            log.error(
+                "backup %s of %s is larger than UPLOAD_SPOOL_MAX_SIZE_MB, not spooled",
+                age_backup_file,
+                core.size_mb(size),
+            )
+            return None
+
+        with self._lock:
+            spooled = self.items()
+            spooled_size = sum(item.path.stat().st_size for item in spooled)
+            while spooled and spooled_size + size > max_size:
+                oldest = spooled.pop(0)
+                spooled_size -= oldest.path.stat().st_size
+                log.warning(
+                    "spool is full, dropping oldest spooled backup %s", oldest.path
+                )
+                oldest.remove()
+
+            item = SpoolItem(
+                path=config.CONST_SPOOL_FOLDER_PATH
+                / age_backup_file.parent.name
+                / age_backup_file.name,
+                providers=list(providers),
+            )
+            item.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            # Scratch folder may be on other filesystem, rename is atomic only
+            # within spool, so other processes never see partially moved file
+            partial_path = item.path.with_name(item.path.name + PARTIAL_SUFFIX)
+            item.next_attempt_at = (
+                item.created_at + config.options.UPLOAD_SPOOL_RETRY_SECS
+            )
+            try:
+                shutil.move(age_backup_file, partial_path)
+                for checkpoint_path in checkpoint.checkpoint_paths(age_backup_file):
+                    shutil.move(checkpoint_path, item.path.parent)
+                os.replace(partial_path, item.path)
+                item.save()
+            except OSError as err:
+                log.error("could not spool %s: %s", age_backup_file, err)
+                core.remove_path(partial_path)
+                return None
+
+        log.info("spooled %s for upload retry", item.path)
+        self.update_metrics()
+        return item
+
+    def upload_due(self, uploads: Mapping[str, Callable[[Path], str]]) -> int:
+        """Upload spooled backups that are due, oldest first.
+
+        Uploads are keyed by provider namespace. Returns number of fully
+        uploaded backups, failed ones are rescheduled for failed providers only.
+        """
+        uploaded = 0
+        for item in self.due():
+            log.info(
+                "retrying upload of spooled %s, attempt %s",
+                item.path,
+                item.attempts + 1,
+            )
+            namespaces = [
+                namespace for namespace in item.providers if namespace in uploads
+            ]
+            if len(namespaces) != len(item.providers):
+                log.warning(
+                    "some providers of spooled %s are no longer configured", item.path
+                )
+            failed: list[str] = []
+            errors: list[str] = []
+            # Backup is never dropped, without its providers it goes to all of them
+            for namespace in namespaces or list(uploads):
+                try:
+                    uploads[namespace](item.path)
+                except Exception as err:
+                    failed.append(namespace)
+                    errors.append(f"{err.__class__.__name__}: {err}")
+
+            if failed:
+                item.providers = failed
+                item.attempts += 1
+                item.last_error = "; ".join(errors)
+                item.next_attempt_at = time.time() + min(
+                    config.options.UPLOAD_SPOOL_RETRY_SECS * 2 ** (item.attempts - 1),
+                    RETRY_MAX_SECS,
+                )
+                if item.path.exists():
+                    item.save()
+                log.error(
+                    "upload of spooled %s failed, next attempt in %ss: %s",
+                    item.path,
+                    round(item.next_attempt_at - time.time()),
+                    item.last_error,
+                )
+                continue
+            item.remove()
+            uploaded += 1
+            log.info("uploaded spooled %s", item.path)
+
+        self.update_metrics()
+        return uploaded
+
+    def update_metrics(self) -> None:
+        counts = collections.Counter(item.env_name for item in self.items())
+        metrics.SPOOLED_UPLOADS.reset()
+        for env_name, count in counts.items():
+            metrics.SPOOLED_UPLOADS.set(count, target=env_name)
+
+
+SPOOL = UploadSpool()
@@ -0,0 +1,49 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import hashlib
+from collections.abc import Iterator
+from typing import BinaryIO
+
+from ogion import bandwidth
+
+
+class ChunkedStream:
+    """Byte stream of unknown length, for example pipe of running dump.
+
+    Pipes return short reads, so chunks are filled until they reach requested
+    size or the stream ends. Reads are drawn from bandwidth limiter and
+    hashed, so checksums are known as soon as the stream ends.
+    """
+
+    def __init__(self, stream: BinaryIO) -> None:
+        self._stream = bandwidth.throttle(stream)
+        self.bytes_read = 0
+        self.md5 = hashlib.md5(usedforsecurity=False)
+        self.sha256 = hashlib.sha256()
+
+    def read_chunk(self, size: int) -> bytes:
+        buffer = bytearray()
+        while len(buffer) < size:
+            data = self._stream.read(size - len(buffer))
+            if not data:
+                break
+            buffer += data
+        self.bytes_read += len(buffer)
+        self.md5.update(buffer)
+        self.sha256.update(buffer)
+        return bytes(buffer)
+
+    def chunks(self, size: int) -> Iterator[tuple[bytes, bool]]:
+        """Yield chunks with flag set for the last one, reading one chunk ahead.
+
+        There is always at least one chunk, only the last one can be shorter
+        than size and it is empty only for empty stream.
+        """
+        chunk = self.read_chunk(size)
+        while True:
+            next_chunk = self.read_chunk(size) if len(chunk) == size else b""
+            yield chunk, not next_chunk
+            if not next_chunk:
+                return
+            chunk = next_chunk
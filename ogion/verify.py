@@ -0,0 +1,273 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Scrub of stored backups, proving they can be read back without restore.
+
+Backups are streamed from upload provider and compared with size and sha256
+stored during upload. When age secret key is configured, stream is also
+decrypted and decompressed, restored content is only counted and dropped,
+nothing is written to disk.
+"""
+
+import contextvars
+import hashlib
+import logging
+import subprocess
+import tempfile
+import threading
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import UTC, date, datetime
+from pathlib import Path
+from types import TracebackType
+from typing import IO, Self
+
+from ogion import config, core, metrics
+from ogion.upload_providers.base_provider import BaseUploadProvider
+from ogion.upload_providers.checksum import ChecksumMismatchError
+
+log = logging.getLogger(__name__)
+
+PIPE_READ_SIZE = 1024 * 1024
+
+
+def in_sample(key: str, sample_days: int, day: date) -> bool:
+    """Every backup is selected exactly once in `sample_days` consecutive days."""
+    bucket = int.from_bytes(hashlib.sha256(key.encode()).digest()[:8])
+    return bucket % sample_days == day.toordinal() % sample_days
+
+
+def decode_commands(codec: str, identity_path: Path) -> list[list[str]]:
+    # Codecs are applied left to right when backup is created, e.g. `lz.age`
+    commands: list[list[str]] = []
+    for suffix in reversed(codec.split(".") if codec else []):
+        if suffix == "age":
+            commands.append(["age", "-d", "-i", str(identity_path)])
+        elif suffix == "lz":
+            # Workers already verify backups in parallel
+            commands.append(["plzip", "-d", "-n", "1"])
+    return commands
+
+
+class DecodePipeline:
+    """Processes decoding backup stream written in chunks, output is dropped.
+
+    age authenticates every chunk of the archive and lzip checks CRC of every
+    member, so pipeline fails on any corrupted byte. Without commands, written
+    data is only discarded.
+    """
+
+    def __init__(self, commands: Sequence[list[str]]) -> None:
+        self.commands = commands
+        self.restored_bytes = 0
+        self._processes: list[subprocess.Popen[bytes]] = []
+        self._stderr: list[bytes] = []
+        self._readers: list[threading.Thread] = []
+        self._broken = False
+
+    def __enter__(self) -> Self:
+        stdin: IO[bytes] | int | None = subprocess.PIPE
+        for command in self.commands:
+            process = subprocess.Popen(
+                command,
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            if self._processes:
+                # Only next process reads it, so it gets SIGPIPE when that exits
+                assert self._processes[-1].stdout is not None
+                self._processes[-1].stdout.close()
+            self._processes.append(process)
+            self._stderr.append(b"")
+            stdin = process.stdout
+            self._start_reader(self._read_stderr, len(self._processes) - 1)
+        if self._processes:
+            self._start_reader(self._read_output)
+        return self
+
+    def _start_reader(self, target: Callable[..., None], *args: int) -> None:
+        reader = threading.Thread(target=target, args=args, daemon=True)
+        reader.start()
+        self._readers.append(reader)
+
+    def _read_stderr(self, index: int) -> None:
+        stderr = self._processes[index].stderr
+        assert stderr is not None
+        self._stderr[index] = stderr.read()
+
+    def _read_output(self) -> None:
+        stdout = self._processes[-1].stdout
+        assert stdout is not None
+        while data := stdout.read(PIPE_READ_SIZE):
+            self.restored_bytes += len(data)
+
+    def write(self, data: bytes) -> None:
+        if not self._processes or self._broken:
+            return
+        stdin = self._processes[0].stdin
+        assert stdin is not None
+        try:
+            stdin.write(data)
+        except BrokenPipeError:
+            # Process exited early, its error is raised from close()
+            self._broken = True
+
+    def close(self) -> None:
+        if not self._processes:
+            return
+        stdin = self._processes[0].stdin
+        assert stdin is not None
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            self._broken = True
+        for reader in self._readers:
+            reader.join()
+        for command, process, stderr in zip(
+            self.commands, self._processes, self._stderr, strict=True
+        ):
+            if process.wait() != 0:
+                raise core.CoreSubprocessError(
+                    f"{command[0]} failed with status {process.returncode}: "
+                    f"{stderr.decode(errors='replace').strip()}"
+                )
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_traceback: TracebackType | None,
+    ) -> None:
+        if exc_type is not None:
+            for process in self._processes:
+                process.kill()
+        for reader in self._readers:
+            reader.join()
+        for process in self._processes:
+            process.wait()
+            for pipe in (process.stdin, process.stdout, process.stderr):
+                if pipe is not None:
+                    pipe.close()
+
+
+@contextmanager
+def age_identity() -> Iterator[Path | None]:
+    """Age identity file for decryption, or None when no secret key is set."""
+    secret = (
+        config.options.VERIFY_AGE_SECRET_KEY.get_secret_value()
+        or config.options.DEBUG_AGE_SECRET_KEY
+    )
+    if not secret:
+        yield None
+        return
+    with tempfile.NamedTemporaryFile(
+        "w", dir=config.CONST_CONFIG_FOLDER_PATH
+    ) as identity_file:
+        identity_file.write(secret)
+        identity_file.flush()
+        yield Path(identity_file.name)
+
+
+def verify_backup(
+    provider: BaseUploadProvider,
+    entry: core.BackupEntry,
+    identity_path: Path | None,
+) -> None:
+    """Stream backup from provider and check it can be read back unchanged."""
+    expected_sha256 = provider.stored_sha256(entry)
+    commands = (
+        decode_commands(entry.codec, identity_path) if identity_path is not None else []
+    )
+    sha256 = hashlib.sha256()
+    size = 0
+    with (
+        metrics.StageTimer(entry.target, metrics.STAGE.VERIFY),
+        DecodePipeline(commands) as pipeline,
+    ):
+        for chunk in provider.stream_backup(entry.key):
+            sha256.update(chunk)
+            size += len(chunk)
+            pipeline.write(chunk)
+
+        if entry.size is not None and size != entry.size:
+            raise ChecksumMismatchError(
+                f"size of {entry.key} is {size}, expected {entry.size} from listing"
+            )
+        if expected_sha256 is None:
+            log.warning("no sha256 stored for %s, checked only size", entry.key)
+        elif sha256.hexdigest() != expected_sha256:
+            raise ChecksumMismatchError(
+                f"sha256 of {entry.key} is {sha256.hexdigest()}, "
+                f"expected {expected_sha256} stored with backup"
+            )
+        pipeline.close()
+
+    log.info(
+        "verified %s: %s stored, %s restored",
+        entry.key,
+        core.size_mb(size),
+        core.size_mb(pipeline.restored_bytes) if commands else "not decrypted",
+    )
+
+
+def run_verify(
+    provider: BaseUploadProvider,
+    env_names: Sequence[str],
+    sample_days: int = 1,
+    workers: int = 1,
+    day: date | None = None,
+) -> int:
+    """Verify backups of targets in provider and its mirrors, in parallel.
+
+    With `sample_days` above 1, only backups sampled for `day` are verified,
+    so all of them are verified over that many consecutive days. Returns
+    number of verified backups, failures are raised together at the end.
+    """
+    day = day or datetime.now(UTC).date()
+    jobs = [
+        (backup_provider, entry)
+        for backup_provider in [provider, *provider.mirrors]
+        for env_name in env_names
+        for entry in backup_provider.all_target_entries(env_name)
+        if in_sample(entry.key, sample_days, day)
+    ]
+    log.info("start verification of %s backups with %s workers", len(jobs), workers)
+
+    errors: list[Exception] = []
+    with (
+        age_identity() as identity_path,
+        ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="verify"
+        ) as executor,
+    ):
+        if identity_path is None:
+            log.warning("no age secret key set, backups will not be decrypted")
+        futures = [
+            (
+                entry,
+                executor.submit(
+                    contextvars.copy_context().run,
+                    verify_backup,
+                    backup_provider,
+                    entry,
+                    identity_path,
+                ),
+            )
+            for backup_provider, entry in jobs
+        ]
+        for entry, future in futures:
+            try:
+                future.result()
+            except Exception as err:
+                log.error("verification of %s failed: %s", entry.key, err)
+                err.add_note(f"backup: {entry.key}")
+                errors.append(err)
+
+    if errors:
+        raise ExceptionGroup(
+            f"verification of {len(errors)} of {len(jobs)} backups failed", errors
+        )
+    log.info("finished verification of %s backups", len(jobs))
+    return len(jobs)
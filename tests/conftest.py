@@ -122,6 +122,14 @@ def fixed_const_config_setup(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) ->
     debug_folder_path = tmp_path / "pytest_data_debug"
     monkeypatch.setattr(config, "CONST_DEBUG_FOLDER_PATH", debug_folder_path)
     debug_folder_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    index_folder_path = tmp_path / "pytest_index"
+    monkeypatch.setattr(config, "CONST_INDEX_FOLDER_PATH", index_folder_path)
+    index_folder_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    spool_folder_path = tmp_path / "pytest_spool"
+    monkeypatch.setattr(config, "CONST_SPOOL_FOLDER_PATH", spool_folder_path)
+    monkeypatch.setattr(
+        config, "CONST_HISTORY_DB_PATH", tmp_path / "pytest_history.sqlite3"
+    )
     options = config.Settings(
         LOG_LEVEL="DEBUG",
         BACKUP_PROVIDER="name=debug",
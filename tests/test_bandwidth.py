@@ -0,0 +1,159 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import io
+import time
+from datetime import UTC, datetime
+
+import pytest
+from pydantic import ValidationError
+
+from ogion import bandwidth, config
+from ogion.models.upload_provider_models import S3ProviderModel
+from ogion.upload_providers.s3 import UploadProviderS3
+
+MB = 1024 * 1024
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps: list[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, secs: float) -> None:
+        self.sleeps.append(secs)
+        self.now += secs
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    fake_clock = FakeClock()
+    monkeypatch.setattr(time, "monotonic", fake_clock.monotonic)
+    monkeypatch.setattr(time, "sleep", fake_clock.sleep)
+    return fake_clock
+
+
+@pytest.mark.parametrize(
+    "schedule,limit,expected",
+    [
+        ("", 0, []),
+        ("08:00-18:00=2", 0, [(480, 1080, 2.0)]),
+        ("08:00-18:00=20%, 22:30-06:00=0", 10, [(480, 1080, 2.0), (1350, 360, 0.0)]),
+        ("18:00-24:00=0.5", 0, [(1080, 1440, 0.5)]),
+    ],
+)
+def test_parse_bandwidth_schedule(
+    schedule: str, limit: float, expected: list[tuple[int, int, float]]
+) -> None:
+    assert config.parse_bandwidth_schedule(schedule, limit) == expected
+
+
+@pytest.mark.parametrize(
+    "schedule,limit",
+    [
+        ("8:00-18:00=2", 0),
+        ("08:00-18:00", 0),
+        ("08:00-08:00=2", 0),
+        ("08:00-24:30=2", 0),
+        ("08:00-18:00=20%", 0),
+    ],
+)
+def test_invalid_bandwidth_schedule(schedule: str, limit: float) -> None:
+    with pytest.raises(ValidationError):
+        config.Settings(
+            BACKUP_PROVIDER="name=debug",
+            AGE_RECIPIENTS="age1",
+            BANDWIDTH_SCHEDULE=schedule,
+            BANDWIDTH_LIMIT_MB_PER_SEC=limit,
+        )
+
+
+@pytest.mark.parametrize(
+    "hour,expected_mb",
+    [(3, 10), (8, 2), (17, 2), (18, 10), (23, 0), (1, 0)],
+)
+def test_current_limit_follows_schedule(
+    monkeypatch: pytest.MonkeyPatch, hour: int, expected_mb: float
+) -> None:
+    monkeypatch.setattr(config.options, "BANDWIDTH_LIMIT_MB_PER_SEC", 10)
+    monkeypatch.setattr(
+        config.options, "BANDWIDTH_SCHEDULE", "08:00-18:00=20%,22:00-03:00=0"
+    )
+
+    now = datetime(2024, 1, 1, hour, 30, tzinfo=UTC)
+    assert bandwidth.current_limit(now) == expected_mb * MB
+
+
+def test_limiter_is_noop_without_limit(clock: FakeClock) -> None:
+    bandwidth.BandwidthLimiter().consume(100 * MB)
+
+    assert clock.sleeps == []
+
+
+def test_limiter_splits_limit_between_streams(
+    clock: FakeClock, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(config.options, "BANDWIDTH_LIMIT_MB_PER_SEC", 2)
+    limiter = bandwidth.BandwidthLimiter()
+
+    limiter.consume(2 * MB)
+    limiter.consume(2 * MB)
+    assert clock.sleeps == [1, 1]
+
+    # Idle time refills at most BURST_SECS of tokens
+    clock.now += 60
+    limiter.consume(2 * MB)
+    limiter.consume(2 * MB)
+    assert clock.sleeps == [1, 1, 1]
+
+
+def test_throttled_file_consumes_read_and_written_bytes(
+    clock: FakeClock, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(config.options, "BANDWIDTH_LIMIT_MB_PER_SEC", 1)
+    limiter = bandwidth.BandwidthLimiter()
+    source = bandwidth.ThrottledFile(io.BytesIO(b"x" * 2 * MB), limiter=limiter)
+    target = bandwidth.ThrottledFile(io.BytesIO(), limiter=limiter)
+
+    target.write(source.read(MB))
+    buffer = bytearray(MB)
+    assert source.readinto(buffer) == MB
+    target.write(buffer)
+
+    assert sum(clock.sleeps) == 4  # noqa: PLR2004
+    assert source.tell() == 2 * MB
+    assert target.getvalue() == b"x" * 2 * MB
+
+
+def test_throttle_applies_bucket_limit_on_top_of_global_limit(
+    clock: FakeClock, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(bandwidth, "LIMITER", bandwidth.BandwidthLimiter())
+    monkeypatch.setattr(config.options, "BANDWIDTH_LIMIT_MB_PER_SEC", 4)
+    file = bandwidth.throttle(io.BytesIO(b"x" * 8 * MB), bucket="s3", limit=MB)
+
+    file.read(4 * MB)
+    assert clock.sleeps == [4]
+
+    # Global limit alone does not touch bucket of other provider
+    bandwidth.throttle(io.BytesIO(b"x" * 8 * MB)).read(8 * MB)
+    assert clock.sleeps == [4, 1]
+
+
+def test_s3_max_bandwidth_limits_provider_streams(
+    clock: FakeClock, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(bandwidth, "LIMITER", bandwidth.BandwidthLimiter())
+    provider = UploadProviderS3(
+        S3ProviderModel(
+            bucket_name="bucket", bucket_upload_path="test", max_bandwidth=MB
+        )
+    )
+
+    provider._throttle(io.BytesIO(b"x" * 2 * MB)).read(2 * MB)
+    provider._consume(MB)
+
+    assert clock.sleeps == [2, 1]
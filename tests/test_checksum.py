@@ -0,0 +1,139 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import hashlib
+import io
+import os
+import time
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+
+from ogion import config, core
+from ogion.models.upload_provider_models import DebugProviderModel
+from ogion.upload_providers import checksum
+from ogion.upload_providers.debug import UploadProviderLocalDebug
+from ogion.upload_providers.listing_index import ListingIndex
+
+DATA = os.urandom(3000)
+BACKUP_NAME = "env_20240101_0000_db.lz.age"
+
+
+def test_checksum_file_hashes_bytes_read_again_once() -> None:
+    file = checksum.ChecksumFile(io.BytesIO(DATA), "md5", "sha256")
+
+    file.read(1000)
+    file.seek(500)
+    buffer = bytearray(1500)
+    file.readinto(buffer)
+    file.seek(0)
+    file.read()
+
+    assert file.complete
+    assert file.hexdigest() == hashlib.sha256(DATA).hexdigest()
+    assert file.digest("md5") == hashlib.md5(DATA).digest()
+
+
+def test_checksum_file_hashes_written_bytes() -> None:
+    target = io.BytesIO()
+    file = checksum.ChecksumFile(target)
+
+    file.write(DATA[:1000])
+    file.write(memoryview(DATA)[1000:])
+
+    assert file.hexdigest() == hashlib.sha256(DATA).hexdigest()
+    assert target.getvalue() == DATA
+
+
+def test_checksum_file_is_incomplete_after_skipping_bytes() -> None:
+    file = checksum.ChecksumFile(io.BytesIO(DATA))
+
+    file.read(1000)
+    file.seek(2000)
+    file.read()
+
+    assert not file.complete
+    assert file.hexdigest() is None
+
+
+@pytest.mark.parametrize(
+    "metadata,expected",
+    [
+        ({checksum.SHA256_KEY: "abc"}, "abc"),
+        ({"other": "abc"}, None),
+        (None, None),
+        (Mock(), None),
+    ],
+)
+def test_metadata_sha256(metadata: object, expected: str | None) -> None:
+    assert checksum.metadata_sha256(metadata) == expected  # type: ignore[arg-type]
+
+
+def test_debug_upload_stores_sha256_in_listing_and_index() -> None:
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    age_file = config.CONST_DATA_FOLDER_PATH / "env" / BACKUP_NAME
+    age_file.parent.mkdir()
+    age_file.write_bytes(DATA)
+    sha256 = hashlib.sha256(DATA).hexdigest()
+
+    backup_path = provider.upload(age_file)
+
+    (entry,) = provider.all_target_entries("env")
+    assert entry.sha256 == sha256
+    (listed,) = provider._all_target_backups("env")
+    assert listed.sha256 in {sha256, None}  # None without xattr support
+    assert provider.download_verified(backup_path, sha256).read_bytes() == DATA
+
+
+def test_download_verified_rejects_corrupted_backup() -> None:
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    age_file = config.CONST_DATA_FOLDER_PATH / "env" / BACKUP_NAME
+    age_file.parent.mkdir()
+    age_file.write_bytes(DATA)
+    backup_path = provider.upload(age_file)
+    with open(backup_path, "r+b") as file:
+        file.write(b"corrupted")
+
+    with pytest.raises(checksum.ChecksumMismatchError):
+        provider.download_verified(backup_path, hashlib.sha256(DATA).hexdigest())
+
+    # Corrupted download is not moved into place
+    download_folder = core.get_safe_download_path(backup_path.removeprefix("/")).parent
+    assert list(download_folder.iterdir()) == []
+
+
+def test_download_file_hashes_out_of_order_writes_again(tmp_path: Path) -> None:
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    backup_file = tmp_path / BACKUP_NAME
+
+    with provider.download_file(backup_file, hashlib.sha256(DATA).hexdigest()) as file:
+        file.seek(1000)
+        file.write(DATA[1000:])
+        file.seek(0)
+        file.write(DATA[:1000])
+        assert not file.complete
+
+    assert backup_file.read_bytes() == DATA
+
+
+def test_listing_index_keeps_sha256_missing_from_listing(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 3600)
+    index = ListingIndex(DebugProviderModel())
+    uploaded = core.BackupEntry.from_key(f"env/{BACKUP_NAME}", size=3, sha256="abc")
+    index.replace("env", [uploaded])
+    listed = [
+        core.BackupEntry.from_key(f"env/{BACKUP_NAME}", size=3, etag="etag"),
+        core.BackupEntry.from_key("env/env_20240102_0000_db.lz.age", size=3),
+    ]
+    # Index is older than BACKUP_LISTING_INDEX_TTL_SECS and is reconciled
+    monkeypatch.setattr(time, "time", lambda: 10**12)
+
+    backups = index.backups("env", lambda env_name: listed)
+
+    assert [(entry.etag, entry.sha256) for entry in backups] == [
+        ("etag", "abc"),
+        (None, None),
+    ]
@@ -1,12 +1,16 @@
 # Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
+import hashlib
 import logging
 import os
 import subprocess
+import threading
+import time
+from datetime import UTC, datetime
 from pathlib import Path, PosixPath
 from typing import Any
-from unittest.mock import Mock
+from unittest.mock import ANY, Mock
 
 import pytest
 import tenacity
@@ -14,7 +18,7 @@ from freezegun import freeze_time
 from pydantic import SecretStr
 from pytest import LogCaptureFixture
 
-from ogion import config, core
+from ogion import config, core, history, metrics
 
 
 @pytest.mark.parametrize(
@@ -81,13 +85,13 @@ def test_run_subprocess_opens_stdin_path_in_binary_mode(
     stdin_file = tmp_path / "stdin.txt"
     stdin_file.write_bytes(b"welcome\xff")
 
-    def mock_run(*args: Any, **kwargs: Any) -> subprocess.CompletedProcess[str]:
+    def mock_run(*args: Any, **kwargs: Any) -> tuple[str, str]:
         del args
         assert kwargs["stdin"] is not None
         assert kwargs["stdin"].mode == "rb"
-        return subprocess.CompletedProcess([], 0, stdout="ok", stderr="")
+        return "ok", ""
 
-    monkeypatch.setattr("ogion.core.subprocess.run", mock_run)
+    monkeypatch.setattr(core, "_run_process", mock_run)
 
     result = core.run_subprocess(["cat"], stdin_path=stdin_file)
 
@@ -105,6 +109,32 @@ def test_run_subprocess_missing_executable(caplog: LogCaptureFixture) -> None:
     )
 
 
+def test_run_subprocess_missing_executable_with_process_limits() -> None:
+    with (
+        core.process_limits(core.ProcessLimits(nice=5, ionice_class="idle")),
+        pytest.raises(core.CoreSubprocessError, match="No such file or directory"),
+    ):
+        core.run_subprocess(["definitely-not-a-real-command-ogion"])
+
+
+def test_run_subprocess_progress_is_labelled_with_command(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    watches: list[Any] = []
+    progress_watch = core._ProgressWatch
+
+    def watch(**kwargs: Any) -> Any:
+        watches.append(progress_watch(**kwargs))
+        return watches[-1]
+
+    monkeypatch.setattr(core, "_ProgressWatch", watch)
+
+    with core.process_limits(core.ProcessLimits(nice=5)):
+        core.run_subprocess(["true"])
+
+    assert [progress.labels["command"] for progress in watches] == ["true"]
+
+
 def test_run_subprocess_timeout_is_wrapped(
     monkeypatch: pytest.MonkeyPatch, caplog: LogCaptureFixture
 ) -> None:
@@ -112,7 +142,7 @@ def test_run_subprocess_timeout_is_wrapped(
         cmd=["sleep", "1"], timeout=0.01, output="", stderr=""
     )
     run_mock = Mock(side_effect=timeout_error)
-    monkeypatch.setattr("ogion.core.subprocess.run", run_mock)
+    monkeypatch.setattr(core, "_run_process", run_mock)
 
     with caplog.at_level(logging.DEBUG):
         with pytest.raises(core.CoreSubprocessError, match="Command timed out"):
@@ -121,6 +151,168 @@ def test_run_subprocess_timeout_is_wrapped(
     assert "run_subprocess timed out after 0.01 seconds" in caplog.messages
 
 
+def test_run_subprocess_kills_process_after_timeout(
+    monkeypatch: pytest.MonkeyPatch, caplog: LogCaptureFixture
+) -> None:
+    monkeypatch.setattr(config.options, "SUBPROCESS_TIMEOUT_SECS", 0.2)
+
+    with caplog.at_level(logging.DEBUG):
+        with pytest.raises(core.CoreSubprocessError, match="Command timed out"):
+            core.run_subprocess(["sleep", "10"])
+
+    assert "run_subprocess timed out after 0.2 seconds" in caplog.messages
+
+
+def test_run_subprocess_records_child_rusage_in_current_run() -> None:
+    with history.record_run("target") as run:
+        core.run_subprocess(
+            ["sh", "-c", "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done"]
+        )
+
+    assert run.child_usage.cpu_seconds > 0
+    assert run.child_usage.max_rss_kb > 0
+
+
+def test_process_limits_command_prefix() -> None:
+    assert core.ProcessLimits().command_prefix() == []
+    assert core.ProcessLimits(
+        nice=10, ionice_class="idle", cpu_affinity="0-1,3"
+    ).command_prefix() == [
+        "nice",
+        "-n",
+        "10",
+        "ionice",
+        "-c",
+        "idle",
+        "taskset",
+        "-c",
+        "0-1,3",
+    ]
+
+
+def test_run_subprocess_applies_process_limits(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    run_mock = Mock(return_value=("ok", ""))
+    monkeypatch.setattr(core, "_run_process", run_mock)
+
+    with core.process_limits(core.ProcessLimits(nice=5)):
+        core.run_subprocess(["pg_dump", "db"])
+    core.run_subprocess(["pg_dump", "db"])
+
+    assert run_mock.call_args_list[0].args[0] == ["nice", "-n", "5", "pg_dump", "db"]
+    assert run_mock.call_args_list[1].args[0] == ["pg_dump", "db"]
+
+
+def test_run_subprocess_uses_target_timeouts(monkeypatch: pytest.MonkeyPatch) -> None:
+    run_mock = Mock(return_value=("ok", ""))
+    monkeypatch.setattr(core, "_run_process", run_mock)
+    monkeypatch.setattr(config.options, "SUBPROCESS_TIMEOUT_SECS", 3600)
+    monkeypatch.setattr(config.options, "SUBPROCESS_STALL_TIMEOUT_SECS", 600)
+
+    limits = core.ProcessLimits(timeout_secs=6 * 3600, stall_timeout_secs=0)
+    with core.process_limits(limits):
+        core.run_subprocess(["pg_dump", "db"], progress_path=Path("out.sql"))
+    core.run_subprocess(["pg_dump", "db"])
+
+    assert run_mock.call_args_list[0].kwargs["timeout"] == 6 * 3600
+    assert run_mock.call_args_list[0].kwargs["stall_timeout"] == 0
+    assert run_mock.call_args_list[0].kwargs["progress_path"] == Path("out.sql")
+    assert run_mock.call_args_list[1].kwargs["timeout"] == 3600  # noqa: PLR2004
+    assert run_mock.call_args_list[1].kwargs["stall_timeout"] == 600  # noqa: PLR2004
+
+
+def test_run_subprocess_kills_stalled_process(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, caplog: LogCaptureFixture
+) -> None:
+    monkeypatch.setattr(core, "PROGRESS_CHECK_SECS", 0.05)
+    monkeypatch.setattr(config.options, "SUBPROCESS_STALL_TIMEOUT_SECS", 0.3)
+    out = tmp_path / "out"
+    stalls = metrics.SUBPROCESS_STALLS.value(target="", command="sh")
+
+    with caplog.at_level(logging.DEBUG):
+        with pytest.raises(core.CoreSubprocessError, match="made no progress"):
+            core.run_subprocess(
+                ["sh", "-c", f"echo started > {out}; sleep 10"], progress_path=out
+            )
+
+    assert "run_subprocess made no progress for 0.3 seconds" in caplog.messages
+    assert metrics.SUBPROCESS_STALLS.value(target="", command="sh") == stalls + 1
+
+
+def test_run_subprocess_keeps_process_making_progress(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(core, "PROGRESS_CHECK_SECS", 0.05)
+    monkeypatch.setattr(config.options, "SUBPROCESS_STALL_TIMEOUT_SECS", 0.3)
+    out = tmp_path / "out"
+
+    core.run_subprocess(
+        ["sh", "-c", f"for i in 1 2 3 4 5 6; do echo $i >> {out}; sleep 0.1; done"],
+        progress_path=out,
+    )
+
+    assert out.read_text().split() == ["1", "2", "3", "4", "5", "6"]
+    assert metrics.SUBPROCESS_THROUGHPUT.value(target="", command="sh") >= 0
+
+
+def test_tail_buffer_keeps_last_characters() -> None:
+    buffer = core._TailBuffer(limit=5)
+    buffer.write("abc")
+    assert buffer.getvalue() == "abc"
+
+    for chunk in ["defg", "hi", "jklmnop"]:
+        buffer.write(chunk)
+
+    assert buffer.size < 5 + len("jklmnop")
+    assert buffer.getvalue() == "[11 characters truncated]\nlmnop"
+
+
+def test_run_subprocess_output_is_bounded(
+    monkeypatch: pytest.MonkeyPatch, caplog: LogCaptureFixture
+) -> None:
+    monkeypatch.setattr(config.options, "SUBPROCESS_OUTPUT_LIMIT_KB", 1)
+
+    stdout = core.run_subprocess(["sh", "-c", "yes | head -c 1000000"])
+
+    assert stdout.startswith("[998976 characters truncated]\n")
+    assert stdout.endswith("y\n" * 512)
+
+    with caplog.at_level(logging.DEBUG):
+        with pytest.raises(core.CoreSubprocessError) as err:
+            core.run_subprocess(
+                ["sh", "-c", "yes | head -c 1000000 >&2; echo failed >&2; exit 1"]
+            )
+    assert str(err.value).endswith("y\nfailed\n")
+    assert len(str(err.value)) < 2 * 1024
+
+
+def test_run_subprocess_without_progress_source_is_not_stall_supervised(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(core, "PROGRESS_CHECK_SECS", 0.05)
+    monkeypatch.setattr(config.options, "SUBPROCESS_STALL_TIMEOUT_SECS", 0.1)
+
+    assert core.run_subprocess(["sh", "-c", "sleep 0.4; echo done"]) == "done\n"
+
+
+def test_run_subprocess_nice_is_applied_to_child() -> None:
+    with core.process_limits(core.ProcessLimits(nice=7)):
+        stdout = core.run_subprocess(["sh", "-c", "cut -d ' ' -f 19 /proc/self/stat"])
+
+    assert int(stdout) == min(os.nice(0) + 7, 19)
+
+
+@freeze_time("2022-12-11")
+def test_get_new_backup_path_in_scratch_folder(tmp_path: Path) -> None:
+    with core.scratch_folder(tmp_path):
+        new_path = core.get_new_backup_path("env_name", "db_string")
+
+    assert new_path == tmp_path / "env_name/env_name_20221211_0000_db_string_mock"
+    assert new_path.parent.is_dir()
+    assert core.get_scratch_folder() == config.CONST_DATA_FOLDER_PATH
+
+
 @freeze_time("2022-12-11")
 def test_get_new_backup_path() -> None:
     new_path = core.get_new_backup_path("env_name", "db_string")
@@ -129,6 +321,76 @@ def test_get_new_backup_path() -> None:
     assert str(new_path) == str(expected_path)
 
 
+def test_copy_file_drops_page_cache(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    advices: list[int] = []
+    posix_fadvise = os.posix_fadvise
+
+    def record_fadvise(fd: int, offset: int, length: int, advice: int) -> None:
+        advices.append(advice)
+        posix_fadvise(fd, offset, length, advice)
+
+    monkeypatch.setattr(os, "posix_fadvise", record_fadvise)
+    monkeypatch.setattr(core, "COPY_CHUNK_SIZE", core.DIRECT_IO_ALIGNMENT)
+    monkeypatch.setattr(core, "PAGE_CACHE_DROP_BYTES", 2 * core.DIRECT_IO_ALIGNMENT)
+    src = tmp_path / "src"
+    src.write_bytes(os.urandom(5 * core.DIRECT_IO_ALIGNMENT + 123))
+    dst = tmp_path / "dst"
+
+    sha256 = core.copy_file(src, dst, hash_name="sha256")
+
+    assert dst.read_bytes() == src.read_bytes()
+    assert sha256 == hashlib.sha256(src.read_bytes()).hexdigest()
+    # source and destination after 2nd and 4th chunk and at the end
+    assert advices.count(os.POSIX_FADV_DONTNEED) == 6  # noqa: PLR2004
+
+
+def test_copy_file_direct_io_unaligned_size(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_DIRECT_IO", True)
+    monkeypatch.setattr(core, "COPY_CHUNK_SIZE", 2 * core.DIRECT_IO_ALIGNMENT)
+    src = tmp_path / "src"
+    src.write_bytes(os.urandom(5 * core.DIRECT_IO_ALIGNMENT + 123))
+    dst = tmp_path / "dst"
+
+    sha256 = core.copy_file(src, dst, hash_name="sha256")
+
+    assert dst.read_bytes() == src.read_bytes()
+    assert sha256 == hashlib.sha256(src.read_bytes()).hexdigest()
+
+
+def test_copy_file_direct_io_error_falls_back_to_buffered_copy(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_DIRECT_IO", True)
+    monkeypatch.setattr(
+        core, "_copy_file_direct", Mock(side_effect=OSError(22, "Invalid argument"))
+    )
+    src = tmp_path / "src"
+    src.write_text("abcdefghijk\n12345")
+    dst = tmp_path / "dst"
+
+    core.copy_file(src, dst)
+
+    assert dst.read_text() == "abcdefghijk\n12345"
+
+
+def test_drop_page_cache(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    fadvise_mock = Mock()
+    monkeypatch.setattr(os, "posix_fadvise", fadvise_mock)
+    path = tmp_path / "file"
+    path.write_text("abc")
+
+    core.drop_page_cache(path)
+    core.drop_page_cache(tmp_path / "missing")
+    monkeypatch.setattr(config.options, "BACKUP_DROP_PAGE_CACHE", False)
+    core.drop_page_cache(path)
+
+    fadvise_mock.assert_called_once_with(ANY, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
 def test_run_create_age_archive_out_path_exists(tmp_path: Path) -> None:
     fake_backup_file = tmp_path / "fake_backup"
     with open(fake_backup_file, "w") as f:
@@ -175,9 +437,11 @@ def test_lzip_compression_with_threads_none(
 ) -> None:
     monkeypatch.setattr(config.options, "LZIP_THREADS", None)
     monkeypatch.setattr(config.options, "LZIP_LEVEL", 0)
+    monkeypatch.setattr(core, "cpu_budget", Mock(return_value=2))
 
     init_fake_backup_file = tmp_path / "fake_backup_file"
     init_fake_backup_file.write_text("test data")
+    (tmp_path / "fake_backup_file.lz").write_text("lz")
 
     run_subprocess_mock = Mock(return_value="")
     monkeypatch.setattr(core, "run_subprocess", run_subprocess_mock)
@@ -186,12 +450,16 @@ def test_lzip_compression_with_threads_none(
 
     result = core.run_lzip_compression(init_fake_backup_file)
 
+    assert metrics.RAW_BYTES.value(target=tmp_path.name) == len("test data")
+    assert metrics.COMPRESSED_BYTES.value(target=tmp_path.name) == len("lz")
+    assert metrics.COMPRESSION_RATIO.value(target=tmp_path.name) == 4.5  # noqa: PLR2004
     run_subprocess_mock.assert_called_once()
     called_command = run_subprocess_mock.call_args[0][0]
-    assert "-n" not in called_command
     expected = [
         "plzip",
         "-0",
+        "-n",
+        "2",
         "-o",
         str(tmp_path / "fake_backup_file.lz"),
         str(init_fake_backup_file),
@@ -200,6 +468,90 @@ def test_lzip_compression_with_threads_none(
     assert result == tmp_path / "fake_backup_file.lz"
 
 
+@pytest.mark.parametrize(
+    "cpu_max,expected_budget",
+    [
+        ("max 100000\n", 8),
+        ("200000 100000\n", 2),
+        ("150000 100000\n", 2),
+        ("50000 100000\n", 1),
+        ("3200000 100000\n", 8),
+        ("invalid\n", 8),
+        (None, 8),
+    ],
+)
+def test_cpu_budget_respects_cgroup_quota(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    cpu_max: str | None,
+    expected_budget: int,
+) -> None:
+    cpu_max_path = tmp_path / "cpu.max"
+    if cpu_max is not None:
+        cpu_max_path.write_text(cpu_max)
+    monkeypatch.setattr(config, "CONST_CGROUP_CPU_MAX_PATH", cpu_max_path)
+    monkeypatch.setattr(os, "process_cpu_count", Mock(return_value=8))
+
+    assert core.cpu_budget() == expected_budget
+
+
+def test_cpu_token_allocator_single_job_gets_whole_budget() -> None:
+    allocator = core.CpuTokenAllocator(lambda: 4)
+
+    with allocator.acquire() as tokens:
+        assert tokens == 4  # noqa: PLR2004
+    with allocator.acquire() as tokens:
+        assert tokens == 4  # noqa: PLR2004
+
+
+def test_cpu_token_allocator_shares_budget_among_waiting_jobs() -> None:
+    allocator = core.CpuTokenAllocator(lambda: 4)
+    allocations: list[int] = []
+    release = threading.Event()
+
+    def job() -> None:
+        with allocator.acquire() as tokens:
+            allocations.append(tokens)
+            release.wait(timeout=5)
+
+    with allocator.acquire() as first_tokens:
+        waiting_jobs = [threading.Thread(target=job) for _ in range(2)]
+        for thread in waiting_jobs:
+            thread.start()
+        time.sleep(0.1)
+        assert allocations == []
+
+    deadline = time.monotonic() + 5
+    while len(allocations) < len(waiting_jobs) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert first_tokens == 4  # noqa: PLR2004
+    assert allocations == [2, 2]
+
+    release.set()
+    for thread in waiting_jobs:
+        thread.join(timeout=5)
+
+
+def test_lzip_threads_uses_fixed_lzip_threads(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(config.options, "LZIP_THREADS", 3)
+    monkeypatch.setattr(config.options, "COMPRESSION_CPU_BUDGET", 1)
+
+    with core.lzip_threads() as first, core.lzip_threads() as second:
+        assert (first, second) == (3, 3)
+
+
+def test_lzip_threads_uses_compression_cpu_budget(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(config.options, "LZIP_THREADS", None)
+    monkeypatch.setattr(config.options, "COMPRESSION_CPU_BUDGET", 6)
+
+    with core.lzip_threads() as threads:
+        assert threads == 6  # noqa: PLR2004
+
+
 def test_lzip_compression_with_threads_value(
     tmp_path: Path, monkeypatch: pytest.MonkeyPatch
 ) -> None:
@@ -208,6 +560,7 @@ def test_lzip_compression_with_threads_value(
 
     init_fake_backup_file = tmp_path / "fake_backup_file"
     init_fake_backup_file.write_text("test data")
+    (tmp_path / "fake_backup_file.lz").write_text("lz")
 
     run_subprocess_mock = Mock(return_value="")
     monkeypatch.setattr(core, "run_subprocess", run_subprocess_mock)
@@ -236,6 +589,7 @@ def test_lzip_decompression_with_threads_none(
     tmp_path: Path, monkeypatch: pytest.MonkeyPatch
 ) -> None:
     monkeypatch.setattr(config.options, "LZIP_THREADS", None)
+    monkeypatch.setattr(core, "cpu_budget", Mock(return_value=2))
 
     fake_backup_file = tmp_path / "fake_backup_file.lz"
     fake_backup_file.write_text("compressed data")
@@ -249,10 +603,11 @@ def test_lzip_decompression_with_threads_none(
 
     run_subprocess_mock.assert_called_once()
     called_command = run_subprocess_mock.call_args[0][0]
-    assert "-n" not in called_command
     expected = [
         "plzip",
         "-d",
+        "-n",
+        "2",
         "-o",
         str(tmp_path / "fake_backup_file"),
         str(fake_backup_file),
@@ -396,13 +751,24 @@ test_data = [
         True,
         [
             {
+                "cpu_affinity": "",
                 "cron_rule": "* * * * *",
                 "db": "postgres",
                 "env_name": "postgresql_first_db",
                 "host": "localhost",
+                "ionice_class": "none",
+                "keep_daily": 0,
+                "keep_hourly": 0,
+                "keep_monthly": 0,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": config.options.BACKUP_MAX_NUMBER,
                 "min_retention_days": config.options.BACKUP_MIN_RETENTION_DAYS,
                 "name": config.BackupTargetEnum.POSTGRESQL,
+                "nice": 0,
+                "scratch_dir": "",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
                 "password": SecretStr("secret"),
                 "port": 5432,
                 "user": "postgres",
@@ -423,25 +789,47 @@ test_data = [
         True,
         [
             {
+                "cpu_affinity": "",
                 "cron_rule": "* * * * *",
                 "db": "postgres",
                 "env_name": "postgresql_first_of_two_db",
                 "host": "localhost",
+                "ionice_class": "none",
+                "keep_daily": 0,
+                "keep_hourly": 0,
+                "keep_monthly": 0,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": config.options.BACKUP_MAX_NUMBER,
                 "min_retention_days": config.options.BACKUP_MIN_RETENTION_DAYS,
                 "name": config.BackupTargetEnum.POSTGRESQL,
+                "nice": 0,
+                "scratch_dir": "",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
                 "password": SecretStr("secret"),
                 "port": 5432,
                 "user": "postgres",
             },
             {
+                "cpu_affinity": "",
                 "cron_rule": "* * * * *",
                 "db": "mariadb",
                 "env_name": "mariadb_second_of_two_db",
                 "host": "localhost",
+                "ionice_class": "none",
+                "keep_daily": 0,
+                "keep_hourly": 0,
+                "keep_monthly": 0,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": config.options.BACKUP_MAX_NUMBER,
                 "min_retention_days": config.options.BACKUP_MIN_RETENTION_DAYS,
                 "name": config.BackupTargetEnum.MARIADB,
+                "nice": 0,
+                "scratch_dir": "",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
                 "password": SecretStr("secret"),
                 "port": 3306,
                 "user": "root",
@@ -453,19 +841,32 @@ test_data = [
             (
                 "MARIADB_THIRD_DB",
                 "host=192.168.1.5 port=3308 user=root password=change_me_please! "
-                "db=project cron_rule=15 */3 * * * max_backups=15 min_retention_days=5",
+                "db=project cron_rule=15 */3 * * * max_backups=15 min_retention_days=5 "
+                "keep_daily=7 keep_monthly=12 nice=10 ionice_class=idle "
+                "cpu_affinity=0-1 scratch_dir=tmpfs",
             )
         ],
         True,
         [
             {
+                "cpu_affinity": "0-1",
                 "cron_rule": "15 */3 * * *",
                 "db": "project",
                 "env_name": "mariadb_third_db",
                 "host": "192.168.1.5",
+                "ionice_class": "idle",
+                "keep_daily": 7,
+                "keep_hourly": 0,
+                "keep_monthly": 12,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": 15,
                 "min_retention_days": 5,
                 "name": config.BackupTargetEnum.MARIADB,
+                "nice": 10,
+                "scratch_dir": "tmpfs",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
                 "password": SecretStr("change_me_please!"),
                 "port": 3308,
                 "user": "root",
@@ -483,11 +884,22 @@ test_data = [
         [
             {
                 "abs_path": PosixPath(Path(__file__)),
+                "cpu_affinity": "",
                 "cron_rule": "15 */3 * * *",
                 "env_name": "singlefile_third",
+                "ionice_class": "none",
+                "keep_daily": 0,
+                "keep_hourly": 0,
+                "keep_monthly": 0,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": 20,
                 "min_retention_days": config.options.BACKUP_MIN_RETENTION_DAYS,
                 "name": config.BackupTargetEnum.FILE,
+                "nice": 0,
+                "scratch_dir": "",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
             },
         ],
     ),
@@ -503,11 +915,22 @@ test_data = [
         [
             {
                 "abs_path": PosixPath(Path(__file__).parent),
+                "cpu_affinity": "",
                 "cron_rule": "15 */3 * * *",
                 "env_name": "directory_first",
+                "ionice_class": "none",
+                "keep_daily": 0,
+                "keep_hourly": 0,
+                "keep_monthly": 0,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": 20,
                 "min_retention_days": config.options.BACKUP_MIN_RETENTION_DAYS,
                 "name": config.BackupTargetEnum.FOLDER,
+                "nice": 0,
+                "scratch_dir": "",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
             },
         ],
     ),
@@ -521,13 +944,24 @@ test_data = [
         True,
         [
             {
+                "cpu_affinity": "",
                 "cron_rule": "* * * * *",
                 "db": "postgres",
                 "env_name": "postgresql_first_db",
                 "host": "localhostport=5432",
+                "ionice_class": "none",
+                "keep_daily": 0,
+                "keep_hourly": 0,
+                "keep_monthly": 0,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": config.options.BACKUP_MAX_NUMBER,
                 "min_retention_days": config.options.BACKUP_MIN_RETENTION_DAYS,
                 "name": config.BackupTargetEnum.POSTGRESQL,
+                "nice": 0,
+                "scratch_dir": "",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
                 "password": SecretStr("secret"),
                 "port": 5432,
                 "user": "postgres",
@@ -605,13 +1039,24 @@ test_data = [
         True,
         [
             {
+                "cpu_affinity": "",
                 "cron_rule": "* * * * *",
                 "db": "postgres",
                 "env_name": "postgresql_first_db",
                 "host": "localhost port5432",
+                "ionice_class": "none",
+                "keep_daily": 0,
+                "keep_hourly": 0,
+                "keep_monthly": 0,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": config.options.BACKUP_MAX_NUMBER,
                 "min_retention_days": config.options.BACKUP_MIN_RETENTION_DAYS,
                 "name": config.BackupTargetEnum.POSTGRESQL,
+                "nice": 0,
+                "scratch_dir": "",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
                 "password": SecretStr("secret"),
                 "port": 5432,
                 "user": "postgres",
@@ -629,13 +1074,24 @@ test_data = [
         True,
         [
             {
+                "cpu_affinity": "",
                 "cron_rule": "* * * * *",
                 "db": "postgres",
                 "env_name": "postgresql_first_db",
                 "host": "localhost port5432",
+                "ionice_class": "none",
+                "keep_daily": 0,
+                "keep_hourly": 0,
+                "keep_monthly": 0,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": config.options.BACKUP_MAX_NUMBER,
                 "min_retention_days": config.options.BACKUP_MIN_RETENTION_DAYS,
                 "name": config.BackupTargetEnum.POSTGRESQL,
+                "nice": 0,
+                "scratch_dir": "",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
                 "password": SecretStr("secret"),
                 "port": 5432,
                 "ssl_mode": "require",
@@ -659,13 +1115,24 @@ test_data = [
                 "client_ssl": "false",
                 "client_ssl-verify-server-cert": "true",
                 "client_tee": "name",
+                "cpu_affinity": "",
                 "cron_rule": "* * * * *",
                 "db": "mariadb",
                 "env_name": "mariadb_db",
                 "host": "localhost",
+                "ionice_class": "none",
+                "keep_daily": 0,
+                "keep_hourly": 0,
+                "keep_monthly": 0,
+                "keep_weekly": 0,
+                "keep_yearly": 0,
                 "max_backups": config.options.BACKUP_MAX_NUMBER,
                 "min_retention_days": config.options.BACKUP_MIN_RETENTION_DAYS,
                 "name": config.BackupTargetEnum.MARIADB,
+                "nice": 0,
+                "scratch_dir": "",
+                "subprocess_stall_timeout_secs": None,
+                "subprocess_timeout_secs": None,
                 "password": SecretStr("password"),
                 "port": 12011,
                 "user": "root",
@@ -792,6 +1259,43 @@ def test_file_before_retention_period_ends_rejects_ambiguous_datetime() -> None:
         )
 
 
+@pytest.mark.parametrize(
+    "key,target,codec",
+    [
+        ("env/env_20260314_1200_db_token.lz.age", "env", "lz.age"),
+        ("/tmp/debug/env/env_20260314_1200_file.txt_token.age", "env", "age"),
+        ("prefix/env/env_20260314_1200_db_token", "env", ""),
+    ],
+)
+def test_backup_entry_from_key(key: str, target: str, codec: str) -> None:
+    entry = core.BackupEntry.from_key(key, size=10, etag="etag")
+
+    assert entry == core.BackupEntry(
+        key=key,
+        timestamp=datetime(2026, 3, 14, 12, 0, tzinfo=UTC),
+        target=target,
+        codec=codec,
+        size=10,
+        etag="etag",
+    )
+
+
+def test_backup_entries_are_sorted_by_time_and_skip_unexpected_keys() -> None:
+    entries = core.backup_entries(
+        [
+            ("env/b_20260313_1200_db_token.lz.age", 1, None, None),
+            ("env/a_20260314_1200_db_token.lz.age", 2, None, "sha256"),
+            ("env/unexpected.txt", 3, None, None),
+        ]
+    )
+
+    assert [entry.key for entry in entries] == [
+        "env/a_20260314_1200_db_token.lz.age",
+        "env/b_20260313_1200_db_token.lz.age",
+    ]
+    assert [entry.sha256 for entry in entries] == ["sha256", None]
+
+
 @pytest.mark.parametrize(
     "exception,expected",
     [
@@ -809,3 +1313,15 @@ def test_file_before_retention_period_ends_rejects_ambiguous_datetime() -> None:
 )
 def test_is_network_error(exception: Exception, expected: bool) -> None:
     assert core.is_network_error(exception) == expected
+
+
+@freeze_time("2023-05-03 17:58")
+def test_cron_schedule_is_due_once_per_cron_time() -> None:
+    schedule = core.CronSchedule("0 3 * * *", "cleanup sweep")
+
+    assert schedule.next_time == datetime(2023, 5, 4, 3, 0, tzinfo=UTC)
+    assert not schedule.is_due()
+    with freeze_time("2023-05-04 03:00:02"):
+        assert schedule.is_due()
+        assert schedule.next_time == datetime(2023, 5, 5, 3, 0, tzinfo=UTC)
+        assert not schedule.is_due()
@@ -0,0 +1,182 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import os
+import threading
+from pathlib import Path
+
+import pytest
+
+from ogion import config, disk_space, history
+from ogion.backup_targets.file import File
+from ogion.backup_targets.folder import Folder
+
+from .conftest import FILE_1, FOLDER_1
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def admission(monkeypatch: pytest.MonkeyPatch) -> disk_space.DiskAdmission:
+    monkeypatch.setattr(config.options, "BACKUP_DISK_SPACE_CHECK", True)
+    monkeypatch.setattr(config.options, "BACKUP_DISK_PREALLOCATE", False)
+    monkeypatch.setattr(disk_space, "WAIT_CHECK_SECS", 0.05)
+    return disk_space.DiskAdmission()
+
+
+def test_file_and_folder_estimated_size() -> None:
+    assert (
+        File(target_model=FILE_1).estimated_size() == os.stat(FILE_1.abs_path).st_size
+    )
+    expected_folder_size = sum(
+        (path / name).lstat().st_size
+        for path, dirs, files in FOLDER_1.abs_path.walk()
+        for name in dirs + files
+    )
+    assert Folder(target_model=FOLDER_1).estimated_size() == expected_folder_size
+
+
+def test_predict_backup_size_prefers_last_successful_run() -> None:
+    target = File(target_model=FILE_1)
+    history.save_run(
+        history.RunRecord(
+            target=target.env_name,
+            status="success",
+            raw_bytes=100 * MB,
+            compressed_bytes=25 * MB,
+        )
+    )
+    history.save_run(history.RunRecord(target=target.env_name, status="failed"))
+
+    assert history.last_backup_sizes(target.env_name) == (100 * MB, 25 * MB)
+    prediction = disk_space.predict_backup_size(target)
+    assert prediction == disk_space.BackupSizePrediction(100 * MB, 0.25)
+    assert prediction.peak_bytes == 180 * MB
+
+
+def test_predict_backup_size_falls_back_to_target_estimate() -> None:
+    target = File(target_model=FILE_1)
+
+    assert history.last_backup_sizes(target.env_name) is None
+    assert disk_space.predict_backup_size(target) == (
+        disk_space.BackupSizePrediction(os.stat(FILE_1.abs_path).st_size, 1)
+    )
+
+
+def test_admit_rejects_when_nothing_reserved_and_no_space(
+    admission: disk_space.DiskAdmission, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(admission, "free_bytes", lambda folder: 0)
+
+    with pytest.raises(disk_space.NotEnoughDiskSpaceError, match="singlefile_1"):
+        admission.admit(File(target_model=FILE_1))
+
+
+def test_admit_skips_check_when_disabled(
+    admission: disk_space.DiskAdmission, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_DISK_SPACE_CHECK", False)
+    monkeypatch.setattr(admission, "free_bytes", lambda folder: 0)
+
+    with admission.admit(File(target_model=FILE_1)) as reservation:
+        assert reservation.size == 0
+
+
+def test_admit_waits_for_running_backup_to_release_space(
+    admission: disk_space.DiskAdmission, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    target = File(target_model=FILE_1)
+    needed = disk_space.BackupSizePrediction(
+        os.stat(FILE_1.abs_path).st_size, 1
+    ).peak_bytes
+    monkeypatch.setattr(admission, "free_bytes", lambda folder: needed)
+    admitted = threading.Event()
+
+    def admit_second() -> None:
+        with admission.admit(target):
+            admitted.set()
+
+    with admission.admit(target) as first:
+        assert first.size == needed
+        thread = threading.Thread(target=admit_second)
+        thread.start()
+        assert not admitted.wait(timeout=0.2)
+
+    thread.join(timeout=5)
+    assert admitted.is_set()
+
+
+def test_admit_rejects_after_wait_timeout(
+    admission: disk_space.DiskAdmission, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    target = File(target_model=FILE_1)
+    needed = disk_space.BackupSizePrediction(
+        os.stat(FILE_1.abs_path).st_size, 1
+    ).peak_bytes
+    monkeypatch.setattr(admission, "free_bytes", lambda folder: needed)
+    monkeypatch.setattr(config.options, "BACKUP_DISK_SPACE_WAIT_SECS", 0)
+
+    with (
+        admission.admit(target),
+        pytest.raises(disk_space.NotEnoughDiskSpaceError),
+    ):
+        admission.admit(target)
+
+
+def test_admit_reserves_space_per_scratch_folder(
+    admission: disk_space.DiskAdmission,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    target = File(target_model=FILE_1)
+    tmpfs_target = File(
+        target_model=FILE_1.model_copy(
+            update={"env_name": "tmpfs_file", "scratch_dir": str(tmp_path)}
+        )
+    )
+    needed = disk_space.BackupSizePrediction(
+        os.stat(FILE_1.abs_path).st_size, 1
+    ).peak_bytes
+    monkeypatch.setattr(admission, "free_bytes", lambda folder: needed)
+    monkeypatch.setattr(config.options, "BACKUP_DISK_SPACE_WAIT_SECS", 0)
+
+    with admission.admit(target), admission.admit(tmpfs_target) as reservation:
+        assert reservation.size == needed
+        assert admission._reserved[tmp_path]["tmpfs_file"].size == needed
+
+
+def test_admit_preallocate_failure_releases_reservation(
+    admission: disk_space.DiskAdmission, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def posix_fallocate(fd: int, offset: int, length: int) -> None:
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(config.options, "BACKUP_DISK_PREALLOCATE", True)
+    monkeypatch.setattr(os, "posix_fallocate", posix_fallocate)
+
+    with pytest.raises(disk_space.NotEnoughDiskSpaceError, match="preallocate"):
+        admission.admit(File(target_model=FILE_1))
+
+    assert not admission._reserved[config.CONST_DATA_FOLDER_PATH]
+    assert not list(config.CONST_DATA_FOLDER_PATH.rglob("*disk_reservation*"))
+
+
+def test_reserve_subtracts_only_unwritten_part_of_running_backups(
+    admission: disk_space.DiskAdmission,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "old_file").write_bytes(b"0" * 20)
+    admission.reserve(tmp_path, 60, "a", 0)
+    # Disk of 100 bytes, bytes written by running backup are no longer free
+    (tmp_path / "a" / "dump").write_bytes(b"0" * 50)
+    monkeypatch.setattr(admission, "free_bytes", lambda folder: 100 - 20 - 50)
+
+    admission.reserve(tmp_path, 10, "b", 0)
+    with pytest.raises(disk_space.NotEnoughDiskSpaceError):
+        admission.reserve(tmp_path, 11, "c", 0)
+
+    admission.release(tmp_path, "a", 60)
+    admission.release(tmp_path, "b", 10)
+    assert not admission._reserved[tmp_path]
@@ -0,0 +1,139 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import resource
+import sqlite3
+import time
+from contextlib import closing
+
+import pytest
+
+from ogion import config, history, metrics
+
+
+def _runs() -> list[tuple[str, str, str, int, int, int]]:
+    with closing(sqlite3.connect(config.CONST_HISTORY_DB_PATH)) as conn:
+        return conn.execute(
+            "SELECT target, status, error, raw_bytes, compressed_bytes, "
+            "uploaded_bytes FROM runs ORDER BY id"
+        ).fetchall()
+
+
+def test_record_run_saves_success_and_failure() -> None:
+    with history.record_run("target_a"):
+        history.add_bytes(raw=100, compressed=10)
+        history.add_bytes(uploaded=10)
+        with metrics.StageTimer("target_a", metrics.STAGE.DUMP):
+            pass
+
+    with pytest.raises(RuntimeError), history.record_run("target_a"):
+        raise RuntimeError("dump failed")
+
+    assert _runs() == [
+        ("target_a", "success", "", 100, 10, 10),
+        ("target_a", "failed", "RuntimeError: dump failed", 0, 0, 0),
+    ]
+    assert history.current_run() is None
+
+
+def test_record_run_not_saved_when_history_disabled(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(config.options, "HISTORY_RETENTION_DAYS", 0)
+
+    with history.record_run("target_a"):
+        pass
+
+    assert not config.CONST_HISTORY_DB_PATH.exists()
+    assert history.stage_stats() == []
+
+
+def test_record_run_prunes_old_runs() -> None:
+    history.save_run(
+        history.RunRecord(
+            target="target_a",
+            started_at=time.time() - 100 * 24 * 3600,
+            stages=[history.StageRecord("dump", 0, 1, 0, False)],
+        )
+    )
+    with history.record_run("target_a"):
+        pass
+
+    assert _runs() == [("target_a", "success", "", 0, 0, 0)]
+    assert history.stage_stats() == []
+
+
+def test_helpers_are_noop_outside_run() -> None:
+    history.add_bytes(raw=1, compressed=1, uploaded=1)
+    history.add_stage(history.StageRecord("dump", 0, 1, 0, False))
+    history.add_child_rusage(resource.getrusage(resource.RUSAGE_CHILDREN))
+
+    assert history.current_run() is None
+
+
+def test_add_child_rusage_sums_cpu_and_keeps_max_rss() -> None:
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+
+    with history.record_run("target_a") as run:
+        history.add_child_rusage(rusage)
+        history.add_child_rusage(rusage)
+
+    assert run.child_usage.cpu_seconds == pytest.approx(
+        2 * (rusage.ru_utime + rusage.ru_stime)
+    )
+    assert run.child_usage.max_rss_kb == rusage.ru_maxrss
+    assert run.child_usage.write_blocks == 2 * rusage.ru_oublock
+
+
+def test_stage_usage_is_attached_to_stage_record() -> None:
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+
+    with history.record_run("target_a") as run:
+        history.add_child_rusage(rusage)
+        with metrics.StageTimer("target_a", metrics.STAGE.COMPRESS):
+            history.add_child_rusage(rusage)
+        assert run.open_stages == []
+
+    (stage,) = run.stages
+    assert stage.cpu_seconds == pytest.approx(rusage.ru_utime + rusage.ru_stime)
+    assert stage.max_rss_kb == rusage.ru_maxrss
+    assert stage.read_blocks == rusage.ru_inblock
+    assert run.child_usage.cpu_seconds == pytest.approx(2 * stage.cpu_seconds)
+
+
+def test_stage_stats_percentiles_and_target_filter() -> None:
+    runs = 100
+    for seconds in range(1, runs + 1):
+        history.save_run(
+            history.RunRecord(
+                target="target_a",
+                stages=[
+                    history.StageRecord(
+                        "dump", 0, seconds, seconds / 10, seconds == runs
+                    )
+                ],
+            )
+        )
+    history.save_run(
+        history.RunRecord(
+            target="target_b",
+            stages=[history.StageRecord("upload", 0, 5, 0, False)],
+        )
+    )
+
+    (stats,) = history.stage_stats("target_a")
+    assert (stats.target, stats.stage, stats.runs, stats.failed) == (
+        "target_a",
+        "dump",
+        runs,
+        1,
+    )
+    assert stats.p50_seconds == pytest.approx(50.5)
+    assert stats.p95_seconds == pytest.approx(95.05)
+    assert stats.p50_cpu_seconds == pytest.approx(5.05)
+    assert stats.p95_cpu_seconds == pytest.approx(9.505)
+    assert [(stat.target, stat.stage) for stat in history.stage_stats()] == [
+        ("target_a", "dump"),
+        ("target_b", "upload"),
+    ]
+    assert history.stage_stats("target_b")[0].p95_seconds == 5  # noqa: PLR2004
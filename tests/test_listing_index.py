@@ -0,0 +1,232 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+from freezegun import freeze_time
+from pydantic import SecretStr
+
+from ogion import config, core
+from ogion.models.upload_provider_models import (
+    AzureProviderModel,
+    DebugProviderModel,
+    GCSProviderModel,
+)
+from ogion.upload_providers.debug import UploadProviderLocalDebug
+from ogion.upload_providers.listing_index import ListingIndex
+
+
+def _entry(name: str) -> core.BackupEntry:
+    return core.BackupEntry.from_key(f"env/file_{name}_dummy_xfcs.lz.age", size=1)
+
+
+A = _entry("20230425_0105")
+B = _entry("20230426_0105")
+C = _entry("20230427_0105")
+
+
+@pytest.fixture(autouse=True)
+def listing_index_ttl(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 3600)
+
+
+@pytest.fixture
+def listing_index() -> ListingIndex:
+    return ListingIndex(provider_model=DebugProviderModel())
+
+
+def test_listing_index_lists_provider_only_once(listing_index: ListingIndex) -> None:
+    list_mock = Mock(return_value=[B, A])
+
+    assert listing_index.backups("env", list_mock) == [B, A]
+    assert listing_index.backups("env", list_mock) == [B, A]
+
+    list_mock.assert_called_once_with("env")
+    assert listing_index.index_path("env").exists()
+
+
+def test_listing_index_reconciles_after_ttl(
+    listing_index: ListingIndex, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 60)
+    list_mock = Mock(return_value=[A])
+
+    with freeze_time("2024-01-01 00:00:00"):
+        listing_index.backups("env", list_mock)
+    with freeze_time("2024-01-01 00:00:59"):
+        listing_index.backups("env", list_mock)
+    assert list_mock.call_count == 1
+
+    list_mock.return_value = [B, A]
+    with freeze_time("2024-01-01 00:01:01"):
+        assert listing_index.backups("env", list_mock) == [B, A]
+    assert list_mock.call_count == 2  # noqa: PLR2004
+
+
+def test_listing_index_disabled_with_zero_ttl(
+    listing_index: ListingIndex, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 0)
+    list_mock = Mock(return_value=[A])
+
+    listing_index.backups("env", list_mock)
+    listing_index.backups("env", list_mock)
+    listing_index.add("env", B)
+    listing_index.remove("env", [A.key])
+
+    assert list_mock.call_count == 2  # noqa: PLR2004
+    assert not listing_index.index_path("env").exists()
+
+
+@pytest.mark.parametrize("env_name", ["", "../env", "env/nested", "env.json"])
+def test_listing_index_skips_unsafe_env_names(
+    listing_index: ListingIndex, env_name: str
+) -> None:
+    list_mock = Mock(return_value=[])
+
+    listing_index.backups(env_name, list_mock)
+    listing_index.backups(env_name, list_mock)
+
+    assert list_mock.call_count == 2  # noqa: PLR2004
+    assert not any(config.CONST_INDEX_FOLDER_PATH.rglob("*.json"))
+
+
+def test_listing_index_add_and_remove(listing_index: ListingIndex) -> None:
+    listing_index.backups("env", Mock(return_value=[B]))
+
+    listing_index.add("env", C)
+    listing_index.add("env", A)
+    listing_index.add("env", A)
+    assert listing_index.backups("env", Mock()) == [C, B, A]
+
+    listing_index.remove("env", [A.key, B.key, "env/unknown"])
+    assert listing_index.backups("env", Mock()) == [C]
+
+
+def test_listing_index_add_and_remove_without_index_is_noop(
+    listing_index: ListingIndex,
+) -> None:
+    listing_index.add("env", A)
+    listing_index.remove("env", [A.key])
+
+    assert not listing_index.index_path("env").exists()
+
+
+def test_listing_index_corrupted_file_is_reconciled(
+    listing_index: ListingIndex,
+) -> None:
+    index_path = listing_index.index_path("env")
+    index_path.parent.mkdir(parents=True)
+    index_path.write_text("{not json")
+    list_mock = Mock(return_value=[A])
+
+    assert listing_index.backups("env", list_mock) == [A]
+    assert listing_index.backups("env", list_mock) == [A]
+    list_mock.assert_called_once_with("env")
+
+
+def test_listing_index_keys_only_format_is_reconciled(
+    listing_index: ListingIndex,
+) -> None:
+    index_path = listing_index.index_path("env")
+    index_path.parent.mkdir(parents=True)
+    index_path.write_text('{"reconciled_at": 9999999999, "backups": ["env/a"]}')
+    list_mock = Mock(return_value=[A])
+
+    assert listing_index.backups("env", list_mock) == [A]
+    list_mock.assert_called_once_with("env")
+
+
+def test_listing_index_namespace_depends_on_provider_model() -> None:
+    first = ListingIndex(provider_model=DebugProviderModel())
+    second = ListingIndex(provider_model=DebugProviderModel())
+    other = ListingIndex(provider_model=DebugProviderModel(name="other"))
+
+    assert first.namespace == second.namespace
+    assert first.namespace != other.namespace
+
+
+def _azure_model(account: str, max_concurrency: int = 1) -> AzureProviderModel:
+    return AzureProviderModel(
+        container_name="container",
+        connect_string=SecretStr(
+            f"DefaultEndpointsProtocol=https;AccountName={account};AccountKey=a2V5;"
+        ),
+        max_concurrency=max_concurrency,
+    )
+
+
+def test_listing_index_namespace_depends_only_on_location() -> None:
+    first = ListingIndex(provider_model=_azure_model("first"))
+    tuned = ListingIndex(provider_model=_azure_model("first", max_concurrency=8))
+    other_account = ListingIndex(provider_model=_azure_model("second"))
+    gcs = GCSProviderModel(
+        bucket_name="bucket",
+        bucket_upload_path="test",
+        service_account_base64=SecretStr("dGVzdA=="),
+    )
+
+    assert first.namespace == tuned.namespace
+    assert first.namespace != other_account.namespace
+    assert ListingIndex(gcs).namespace == (
+        ListingIndex(gcs.model_copy(update={"transfer_workers": 8})).namespace
+    )
+    assert ListingIndex(gcs).namespace != (
+        ListingIndex(gcs.model_copy(update={"bucket_upload_path": "other"})).namespace
+    )
+
+
+def test_provider_post_save_and_clean_keep_index_in_sync(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    def fake_age_archive(backup_file: Path) -> Path:
+        return backup_file.rename(f"{backup_file}.lz.age")
+
+    monkeypatch.setattr(core, "run_create_age_archive", fake_age_archive)
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    list_spy = Mock(wraps=provider._all_target_backups)
+    monkeypatch.setattr(provider, "_all_target_backups", list_spy)
+
+    backup_dir = config.CONST_DATA_FOLDER_PATH / "env"
+    backup_dir.mkdir()
+    assert provider.all_target_backups("env") == []
+
+    for name in [
+        "file_20230425_0105_dummy_xfcs",
+        "file_20230426_0105_dummy_xfcs",
+        "file_20230427_0105_dummy_xfcs",
+    ]:
+        (backup_dir / name).touch()
+        provider.post_save(backup_dir / name)
+
+    debug_dir = config.CONST_DEBUG_FOLDER_PATH / "env"
+    assert provider.all_target_backups("env") == [
+        f"{debug_dir}/file_20230427_0105_dummy_xfcs.lz.age",
+        f"{debug_dir}/file_20230426_0105_dummy_xfcs.lz.age",
+        f"{debug_dir}/file_20230425_0105_dummy_xfcs.lz.age",
+    ]
+
+    provider.clean(backup_dir / "file", max_backups=1, min_retention_days=0)
+
+    assert provider.all_target_backups("env") == [
+        f"{debug_dir}/file_20230427_0105_dummy_xfcs.lz.age",
+    ]
+    list_spy.assert_called_once_with("env")
+
+
+def test_listing_index_keeps_updates_of_concurrent_writers() -> None:
+    # Separate instances share only the lock file, like worker processes
+    writers = [ListingIndex(provider_model=DebugProviderModel()) for _ in range(4)]
+    writers[0].replace("env", [])
+    entries = [_entry(f"202301{day:02}_0105") for day in range(1, 29)]
+
+    with ThreadPoolExecutor(max_workers=len(writers)) as executor:
+        for index, entry in enumerate(entries):
+            executor.submit(writers[index % len(writers)].add, "env", entry)
+
+    index_path = writers[0].index_path("env")
+    assert writers[0].backups("env", Mock()) == core.sort_backup_entries(entries)
+    assert list(index_path.parent.glob("*.tmp")) == []
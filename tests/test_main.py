@@ -2,9 +2,11 @@
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
 import argparse
+import pickle
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, NoReturn
 from unittest.mock import Mock
@@ -12,7 +14,8 @@ from unittest.mock import Mock
 import google.cloud.storage as cloud_storage
 import pytest
 
-from ogion import config, core, main
+from ogion import config, core, history, main, metrics, verify
+from ogion.backup_targets import base_target
 from ogion.models import upload_provider_models
 from ogion.notifications.notifications_context import NotificationsContext
 from ogion.upload_providers.debug import UploadProviderLocalDebug
@@ -214,6 +217,34 @@ def test_run_backup_notifications_fail_message_is_fired_when_it_fails(
     fail_message_mock.assert_called_once()
 
 
+def test_run_backup_with_target_scratch_dir(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(
+        core,
+        "create_target_models",
+        Mock(return_value=[FILE_1.model_copy(update={"scratch_dir": str(tmp_path)})]),
+    )
+    target = main.backup_targets()[0]
+    backup_file = Path("/tmp/fake")
+    scratch_folders: list[Path] = []
+
+    def backup() -> Path:
+        scratch_folders.append(core.get_scratch_folder())
+        return backup_file
+
+    monkeypatch.setattr(target, "backup", backup)
+    provider = UploadProviderLocalDebug(upload_provider_models.DebugProviderModel())
+    monkeypatch.setattr(provider, "post_save", Mock())
+    monkeypatch.setattr(provider, "clean", Mock())
+    monkeypatch.setattr(main, "backup_provider", Mock(return_value=provider))
+
+    main.run_backup(target=target)
+
+    assert scratch_folders == [tmp_path]
+    assert core.get_scratch_folder() == config.CONST_DATA_FOLDER_PATH
+
+
 def test_quit(monkeypatch: pytest.MonkeyPatch) -> None:
     exit_mock = Mock()
     monkeypatch.setattr(main, "exit_event", exit_mock)
@@ -278,6 +309,288 @@ def test_run_backup_with_backup_delete_enabled(
         backup_file=backup_file,
         max_backups=target.max_backups,
         min_retention_days=target.min_retention_days,
+        keep_policy=target.keep_policy,
+    )
+
+
+def test_run_backup_with_cleanup_cron_rule_skips_cleanup(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test that cleanup is left to sweeps when BACKUP_CLEANUP_CRON_RULE is set."""
+    monkeypatch.setattr(config.options, "BACKUP_DELETE", True)
+    monkeypatch.setattr(config.options, "BACKUP_CLEANUP_CRON_RULE", "0 3 * * *")
+    monkeypatch.setattr(
+        core,
+        "create_target_models",
+        Mock(return_value=[FILE_1]),
+    )
+    target = main.backup_targets()[0]
+    monkeypatch.setattr(target, "backup", Mock(return_value=Path("/tmp/fake")))
+    provider = UploadProviderLocalDebug(upload_provider_models.DebugProviderModel())
+    clean_mock = Mock()
+    monkeypatch.setattr(provider, "post_save", Mock(return_value="/path/to/backup"))
+    monkeypatch.setattr(provider, "clean", clean_mock)
+    monkeypatch.setattr(main, "backup_provider", Mock(return_value=provider))
+
+    main.run_backup(target=target)
+
+    clean_mock.assert_not_called()
+
+
+def test_run_scheduled_backup_records_metrics(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_DELETE", False)
+    monkeypatch.setattr(
+        core,
+        "create_target_models",
+        Mock(return_value=[FILE_1]),
+    )
+    target = main.backup_targets()[0]
+    monkeypatch.setattr(target, "backup", Mock(return_value=Path("/tmp/fake")))
+    provider = UploadProviderLocalDebug(upload_provider_models.DebugProviderModel())
+    monkeypatch.setattr(provider, "post_save", Mock(return_value="/path/to/backup"))
+    monkeypatch.setattr(main, "backup_provider", Mock(return_value=provider))
+    dump_count = metrics.STAGE_DURATION.count(
+        target=target.env_name, stage=metrics.STAGE.DUMP
+    )
+
+    metrics.JOBS_QUEUED.inc()
+    main.run_scheduled_backup(target=target)
+
+    assert metrics.JOBS_QUEUED.value() == 0
+    assert metrics.JOBS_RUNNING.value() == 0
+    assert (
+        metrics.STAGE_DURATION.count(target=target.env_name, stage=metrics.STAGE.DUMP)
+        == dump_count + 1
+    )
+    assert metrics.LAST_SUCCESS.value(target=target.env_name) > 0
+    assert [
+        (stat.target, stat.stage, stat.runs, stat.failed)
+        for stat in history.stage_stats(target.env_name)
+    ] == [(target.env_name, metrics.STAGE.DUMP, 1, 0)]
+
+
+def test_run_backup_in_worker_returns_metrics_of_backup(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(core, "create_target_models", Mock(return_value=[FILE_1]))
+    target = main.backup_targets()[0]
+    monkeypatch.setattr(main, "run_backup", Mock(side_effect=ValueError("failed")))
+    metrics.RAW_BYTES.inc(10, target="test_worker_reset")
+
+    snapshot = main.run_backup_in_worker(target=pickle.loads(pickle.dumps(target)))
+
+    assert len(snapshot) == len(metrics.WORKER_REGISTRY)
+    assert metrics.RAW_BYTES.value(target="test_worker_reset") == 0
+
+
+def test_backup_worker_pool_merges_worker_metrics(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(core, "create_target_models", Mock(return_value=[FILE_1]))
+    target = main.backup_targets()[0]
+    worker_metrics = metrics.Counter("test_worker_total", "Test.", ("target",))
+    worker_metrics.inc(3, target=target.env_name)
+    monkeypatch.setattr(metrics, "WORKER_REGISTRY", [worker_metrics])
+    worker_snapshot = worker_metrics.snapshot()
+    started = threading.Event()
+    release = threading.Event()
+
+    def run_backup_in_worker(
+        target: base_target.BaseBackupTarget,
+    ) -> list[metrics.Snapshot]:
+        started.set()
+        release.wait(timeout=5)
+        return [worker_snapshot]
+
+    monkeypatch.setattr(main, "run_backup_in_worker", run_backup_in_worker)
+    pool = main.BackupWorkerPool(processes=1, max_tasks_per_child=1)
+    pool.executor.shutdown()
+    pool.executor = ThreadPoolExecutor(max_workers=1)  # type: ignore[assignment]
+
+    first = pool.submit(target)
+    second = pool.submit(target)
+    started.wait(timeout=5)
+    assert metrics.JOBS_RUNNING.value() == 1
+    assert metrics.JOBS_QUEUED.value() == 1
+
+    release.set()
+    second.result(timeout=5)
+    pool.shutdown(timeout_secs=5)
+    # Joins executor threads running done callbacks
+    pool.executor.shutdown(wait=True)
+
+    assert first.done()
+    assert metrics.JOBS_RUNNING.value() == 0
+    assert metrics.JOBS_QUEUED.value() == 0
+    assert worker_metrics.value(target=target.env_name) == 9  # noqa: PLR2004
+
+
+def test_stop_metrics_server_ends_its_thread(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config.options, "METRICS_PORT", 0)
+    main.metrics_server.cache_clear()
+    main.metrics_server()
+    (thread,) = [
+        thread for thread in threading.enumerate() if thread.name == "metrics_server"
+    ]
+
+    main.stop_metrics_server()
+    main.metrics_server.cache_clear()
+
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_backup_worker_pool_shutdown_waits_for_running_backups(
+    monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    monkeypatch.setattr(core, "create_target_models", Mock(return_value=[FILE_1]))
+    target = main.backup_targets()[0]
+    monkeypatch.setattr(metrics, "WORKER_REGISTRY", [])
+    started = threading.Event()
+
+    def run_backup_in_worker(
+        target: base_target.BaseBackupTarget,
+    ) -> list[metrics.Snapshot]:
+        started.set()
+        time.sleep(0.2)
+        return []
+
+    monkeypatch.setattr(main, "run_backup_in_worker", run_backup_in_worker)
+    pool = main.BackupWorkerPool(processes=1, max_tasks_per_child=1)
+    pool.executor.shutdown()
+    pool.executor = ThreadPoolExecutor(max_workers=1)  # type: ignore[assignment]
+    running = pool.submit(target)
+    queued = pool.submit(target)
+    started.wait(timeout=5)
+
+    pool.shutdown(timeout_secs=5)
+    pool.executor.shutdown(wait=True)
+
+    assert running.done()
+    assert not running.cancelled()
+    assert queued.cancelled()
+    assert f"cancelled 1 queued backups on shutdown: {target.env_name}" in caplog.text
+    assert metrics.JOBS_RUNNING.value() == 0
+    assert metrics.JOBS_QUEUED.value() == 0
+
+
+def test_schedule_backup_queues_backup_thread(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(core, "create_target_models", Mock(return_value=[FILE_1]))
+    target = main.backup_targets()[0]
+    started = threading.Event()
+    release = threading.Event()
+    queued: list[float] = []
+
+    def run_backup(target: base_target.BaseBackupTarget) -> None:
+        queued.append(metrics.JOBS_QUEUED.value())
+        started.set()
+        release.wait(timeout=5)
+
+    monkeypatch.setattr(main, "run_backup", run_backup)
+    monkeypatch.setattr(config.options, "BACKUP_WORKER_PROCESSES", 0)
+
+    main.schedule_backup(target)
+    started.wait(timeout=5)
+    release.set()
+
+    assert queued == [0]
+    assert metrics.JOBS_QUEUED.value() == 0
+
+
+def test_schedule_backup_uses_worker_pool(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(core, "create_target_models", Mock(return_value=[FILE_1]))
+    target = main.backup_targets()[0]
+    pool = Mock()
+    monkeypatch.setattr(main, "backup_worker_pool", Mock(return_value=pool))
+    monkeypatch.setattr(config.options, "BACKUP_WORKER_PROCESSES", 2)
+
+    main.schedule_backup(target)
+
+    pool.submit.assert_called_once_with(target)
+
+
+def test_run_history_report(capsys: pytest.CaptureFixture[str]) -> None:
+    with pytest.raises(SystemExit) as exit_info:
+        main.run_history_report(None)
+    assert exit_info.value.code == 0
+    assert capsys.readouterr().out == "no backup history yet\n"
+
+    history.save_run(
+        history.RunRecord(
+            target="target_a",
+            stages=[history.StageRecord("dump", 0, 12.34, 2, False)],
+        )
+    )
+    with pytest.raises(SystemExit):
+        main.run_history_report("TARGET_A")
+    assert capsys.readouterr().out.splitlines() == [
+        "target    stage  runs  failed  p50    p95    cpu p50  cpu p95",
+        "target_a  dump   1     0       12.3s  12.3s  2.0s     2.0s",
+    ]
+
+
+def test_run_cleanup_sweep(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(
+        core,
+        "create_target_models",
+        Mock(return_value=[FILE_1, FOLDER_1]),
+    )
+    targets = main.backup_targets()
+    provider = UploadProviderLocalDebug(upload_provider_models.DebugProviderModel())
+    clean_all_mock = Mock()
+    monkeypatch.setattr(provider, "clean_all", clean_all_mock)
+    monkeypatch.setattr(main, "backup_provider", Mock(return_value=provider))
+
+    main.run_cleanup_sweep(targets)
+
+    clean_all_mock.assert_called_once_with(target_models=[FILE_1, FOLDER_1])
+
+
+def test_run_cleanup_sweep_after_waits_for_backups(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    backup_done = threading.Event()
+    sweeps: list[bool] = []
+    monkeypatch.setattr(
+        main, "run_cleanup_sweep", lambda targets: sweeps.append(backup_done.is_set())
+    )
+
+    def backup() -> None:
+        time.sleep(0.1)
+        backup_done.set()
+
+    backup_thread = threading.Thread(target=backup)
+    backup_thread.start()
+
+    main.run_cleanup_sweep_after([], [backup_thread])
+
+    assert sweeps == [True]
+
+
+def test_run_verify_backups(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(
+        core,
+        "create_target_models",
+        Mock(return_value=[FILE_1, FOLDER_1]),
+    )
+    targets = main.backup_targets()
+    provider = UploadProviderLocalDebug(upload_provider_models.DebugProviderModel())
+    run_verify_mock = Mock(return_value=len(targets))
+    monkeypatch.setattr(verify, "run_verify", run_verify_mock)
+    monkeypatch.setattr(main, "backup_provider", Mock(return_value=provider))
+    monkeypatch.setattr(config.options, "VERIFY_WORKERS", 4)
+
+    assert main.run_verify_backups(targets, sample_days=7) == len(targets)
+
+    run_verify_mock.assert_called_once_with(
+        provider,
+        env_names=[FILE_1.env_name, FOLDER_1.env_name],
+        sample_days=7,
+        workers=4,
     )
 
 
@@ -311,6 +624,16 @@ def test_run_backup_with_backup_delete_enabled(
             ["main.py", "--target", "example_target", "--restore", "example_restore"],
             {"restore": "example_restore", "target": "example_target"},
         ),
+        (["main.py", "--history"], {"history": True, "target": None}),
+        (
+            ["main.py", "--target", "example_target", "--history"],
+            {"history": True, "target": "example_target"},
+        ),
+        (["main.py", "--verify"], {"verify": True, "target": None}),
+        (
+            ["main.py", "--target", "example_target", "--verify"],
+            {"verify": True, "target": "example_target"},
+        ),
     ],
 )
 def test_setup_runtime_arguments_parametrized(
@@ -391,6 +714,22 @@ def test_setup_runtime_arguments_parametrized(
             ["main.py", "--target", "test", "--list", "--restore", "file"],
             "--list cannot be combined with --restore-latest or --restore",
         ),
+        (
+            ["main.py", "--history", "--single"],
+            "--history can only be combined with --target",
+        ),
+        (
+            ["main.py", "--target", "test", "--history", "--list"],
+            "--history can only be combined with --target",
+        ),
+        (
+            ["main.py", "--verify", "--single"],
+            "--verify can only be combined with --target",
+        ),
+        (
+            ["main.py", "--verify", "--history"],
+            "--verify can only be combined with --target",
+        ),
     ],
 )
 def test_setup_runtime_arguments_validation_errors(
@@ -0,0 +1,143 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import urllib.error
+import urllib.request
+
+import pytest
+
+from ogion import metrics
+
+
+def test_counter_render() -> None:
+    counter = metrics.Counter("test_total", "Test counter.", ("target",))
+    counter.inc(target="a")
+    counter.inc(2.5, target="a")
+    counter.inc(target='b"\\')
+
+    assert counter.value(target="a") == 3.5  # noqa: PLR2004
+    assert counter.render() == (
+        "# HELP test_total Test counter.\n"
+        "# TYPE test_total counter\n"
+        'test_total{target="a"} 3.5\n'
+        'test_total{target="b\\"\\\\"} 1.0\n'
+    )
+
+
+def test_counter_rejects_negative_and_wrong_labels() -> None:
+    counter = metrics.Counter("test_total", "Test counter.", ("target",))
+
+    with pytest.raises(ValueError, match="only be incremented"):
+        counter.inc(-1, target="a")
+    with pytest.raises(ValueError, match="expects labels"):
+        counter.inc(stage="a")
+
+
+def test_gauge_set_inc_dec_and_track_inprogress() -> None:
+    gauge = metrics.Gauge("test_gauge", "Test gauge.")
+    gauge.set(5)
+    gauge.dec(2)
+
+    with gauge.track_inprogress():
+        assert gauge.value() == 4  # noqa: PLR2004
+    assert gauge.value() == 3  # noqa: PLR2004
+    assert gauge.render().endswith("test_gauge 3.0\n")
+
+
+def test_histogram_render() -> None:
+    histogram = metrics.Histogram(
+        "test_seconds", "Test histogram.", ("stage",), buckets=(1, 10)
+    )
+    histogram.observe(0.5, stage="dump")
+    histogram.observe(1, stage="dump")
+    histogram.observe(100, stage="dump")
+
+    assert histogram.count(stage="dump") == 3  # noqa: PLR2004
+    assert histogram.render() == (
+        "# HELP test_seconds Test histogram.\n"
+        "# TYPE test_seconds histogram\n"
+        'test_seconds_bucket{stage="dump",le="1.0"} 2\n'
+        'test_seconds_bucket{stage="dump",le="10.0"} 2\n'
+        'test_seconds_bucket{stage="dump",le="+Inf"} 3\n'
+        'test_seconds_sum{stage="dump"} 101.5\n'
+        'test_seconds_count{stage="dump"} 3\n'
+    )
+
+
+def test_stage_timer_records_duration_and_failures() -> None:
+    labels = {"target": "test_stage_timer", "stage": metrics.STAGE.DUMP}
+
+    with metrics.StageTimer("test_stage_timer", metrics.STAGE.DUMP) as timer:
+        pass
+    with (
+        pytest.raises(RuntimeError),
+        metrics.StageTimer("test_stage_timer", metrics.STAGE.DUMP),
+    ):
+        raise RuntimeError("dump failed")
+
+    assert timer.duration >= 0
+    assert metrics.STAGE_DURATION.count(**labels) == 2  # noqa: PLR2004
+    assert metrics.STAGE_FAILURES.value(**labels) == 1
+
+
+def test_metrics_server() -> None:
+    metrics.RAW_BYTES.inc(10, target="test_metrics_server")
+    server = metrics.start_metrics_server(port=0, host="127.0.0.1")
+    port = server.server_address[1]
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            body = response.read().decode()
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+        assert 'ogion_backup_raw_bytes_total{target="test_metrics_server"}' in body
+        assert "# TYPE ogion_stage_duration_seconds histogram" in body
+
+        with pytest.raises(urllib.error.HTTPError) as err:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other")
+        assert err.value.code == 404  # noqa: PLR2004
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_worker_snapshot_merge() -> None:
+    counter = metrics.Counter("test_merge_total", "Test counter.", ("target",))
+    gauge = metrics.Gauge("test_merge_gauge", "Test gauge.", ("target",))
+    histogram = metrics.Histogram(
+        "test_merge_seconds", "Test histogram.", ("target",), buckets=(1, 10)
+    )
+    counter.inc(2, target="a")
+    gauge.set(5, target="a")
+    histogram.observe(5, target="a")
+    snapshots = [metric.snapshot() for metric in (counter, gauge, histogram)]
+
+    gauge.set(1, target="a")
+    for metric, snapshot in zip((counter, gauge, histogram), snapshots, strict=True):
+        metric.merge(snapshot)
+
+    assert counter.value(target="a") == 4  # noqa: PLR2004
+    assert gauge.value(target="a") == 5  # noqa: PLR2004
+    assert histogram.count(target="a") == 2  # noqa: PLR2004
+    assert histogram.render().endswith(
+        'test_merge_seconds_sum{target="a"} 10.0\n'
+        'test_merge_seconds_count{target="a"} 2\n'
+    )
+
+    for metric in (counter, gauge, histogram):
+        metric.reset()
+    assert counter.render() == (
+        "# HELP test_merge_total Test counter.\n# TYPE test_merge_total counter\n"
+    )
+
+
+def test_merge_worker_snapshot_keeps_process_gauges() -> None:
+    target = "test_process_gauges"
+    metrics.SPOOLED_UPLOADS.set(1, target=target)
+    metrics.COMPRESSION_RATIO.set(3, target=target)
+    worker_snapshot = metrics.worker_snapshot()
+
+    metrics.SPOOLED_UPLOADS.set(5, target=target)
+    metrics.COMPRESSION_RATIO.set(2, target=target)
+    metrics.merge_worker_snapshot(worker_snapshot)
+
+    assert metrics.SPOOLED_UPLOADS.value(target=target) == 5  # noqa: PLR2004
+    assert metrics.COMPRESSION_RATIO.value(target=target) == 3  # noqa: PLR2004
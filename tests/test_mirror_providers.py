@@ -0,0 +1,149 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import time
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+
+from ogion import config, core, main
+from ogion.models.upload_provider_models import DebugProviderModel
+from ogion.upload_providers import spool
+from ogion.upload_providers.base_provider import UploadedBackup
+from ogion.upload_providers.debug import UploadProviderLocalDebug
+from ogion.upload_providers.google_cloud_storage import UploadProviderGCS
+
+BACKUP_NAME = "env_20240101_0000_db"
+
+
+@pytest.fixture
+def providers(
+    monkeypatch: pytest.MonkeyPatch,
+) -> tuple[UploadProviderLocalDebug, UploadProviderLocalDebug]:
+    monkeypatch.setattr(config.options, "UPLOAD_SPOOL_MAX_SIZE_MB", 1)
+    monkeypatch.setattr(
+        core,
+        "run_create_age_archive",
+        lambda backup_file: backup_file.with_name(f"{backup_file.name}.lz.age"),
+    )
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    mirror = UploadProviderLocalDebug(DebugProviderModel())
+    monkeypatch.setattr(mirror.listing_index, "namespace", "mirror")
+    monkeypatch.setattr(
+        mirror,
+        "_upload",
+        Mock(return_value=UploadedBackup(f"mirror/env/{BACKUP_NAME}.lz.age")),
+    )
+    provider.mirrors.append(mirror)
+    return provider, mirror
+
+
+def _backup_file() -> Path:
+    backup_file = config.CONST_DATA_FOLDER_PATH / "env" / BACKUP_NAME
+    backup_file.parent.mkdir()
+    backup_file.write_text("dump")
+    backup_file.with_name(f"{BACKUP_NAME}.lz.age").write_text("age")
+    return backup_file
+
+
+def test_backup_provider_initializes_mirrors(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv(
+        "BACKUP_MIRROR_OFFSITE",
+        "name=gcs bucket_name=name bucket_upload_path=test "
+        "service_account_base64=Z29vZ2xlX3NlcnZpY2VfYWNjb3VudAo=",
+    )
+
+    provider = main.backup_provider()
+
+    assert isinstance(provider, UploadProviderLocalDebug)
+    (mirror,) = provider.mirrors
+    assert isinstance(mirror, UploadProviderGCS)
+
+
+def test_backup_provider_rejects_duplicated_mirror(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setenv("BACKUP_MIRROR_COPY", "name=debug")
+
+    with pytest.raises(ValueError, match="backup_mirror_copy"):
+        main.backup_provider()
+
+
+def test_post_save_uploads_once_encrypted_file_to_all_providers(
+    providers: tuple[UploadProviderLocalDebug, UploadProviderLocalDebug],
+) -> None:
+    provider, mirror = providers
+    backup_file = _backup_file()
+    age_backup_file = backup_file.with_name(f"{BACKUP_NAME}.lz.age")
+
+    backup_path = provider.post_save(backup_file)
+
+    assert Path(backup_path).read_text() == "age"
+    assert provider.all_target_backups("env") == [backup_path]
+    assert isinstance(mirror._upload, Mock)
+    mirror._upload.assert_called_once_with(age_backup_file)
+    assert not age_backup_file.exists()
+    assert not backup_file.exists()
+
+
+def test_post_save_spools_backup_only_for_failed_mirror(
+    providers: tuple[UploadProviderLocalDebug, UploadProviderLocalDebug],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    provider, mirror = providers
+    upload_mock = Mock(side_effect=[ConnectionError("mirror down"), "retried"])
+    monkeypatch.setattr(mirror, "upload", upload_mock)
+
+    with pytest.raises(ConnectionError, match="mirror down"):
+        provider.post_save(_backup_file())
+
+    (item,) = spool.SPOOL.items()
+    assert item.providers == ["mirror"]
+    assert len(provider.all_target_backups("env")) == 1
+
+    primary_upload_mock = Mock()
+    monkeypatch.setattr(provider, "upload", primary_upload_mock)
+    monkeypatch.setattr(time, "time", lambda: item.next_attempt_at)
+    assert spool.SPOOL.upload_due(provider.upload_callables()) == 1
+
+    primary_upload_mock.assert_not_called()
+    assert upload_mock.call_args.args == (item.path,)
+    assert spool.SPOOL.items() == []
+
+
+def test_post_save_reports_all_failed_providers(
+    providers: tuple[UploadProviderLocalDebug, UploadProviderLocalDebug],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    provider, mirror = providers
+    monkeypatch.setattr(
+        provider, "_upload", Mock(side_effect=ConnectionError("primary down"))
+    )
+    monkeypatch.setattr(
+        mirror, "_upload", Mock(side_effect=ConnectionError("mirror down"))
+    )
+
+    with pytest.raises(ExceptionGroup, match="upload to 2 of 2 providers failed"):
+        provider.post_save(_backup_file())
+
+    (item,) = spool.SPOOL.items()
+    assert sorted(item.providers) == sorted(
+        [provider.listing_index.namespace, "mirror"]
+    )
+
+
+def test_clean_applies_retention_to_each_provider(
+    providers: tuple[UploadProviderLocalDebug, UploadProviderLocalDebug],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    provider, mirror = providers
+    clean_mock = Mock()
+    mirror_clean_mock = Mock()
+    monkeypatch.setattr(provider, "_clean_target", clean_mock)
+    monkeypatch.setattr(mirror, "_clean_target", mirror_clean_mock)
+
+    provider.clean(_backup_file(), max_backups=2, min_retention_days=0)
+
+    assert clean_mock.call_args == mirror_clean_mock.call_args
+    assert clean_mock.call_args.args == ("env",)
@@ -44,6 +44,21 @@ from ogion.models.backup_target_models import (
             {"env_name": "valid", "type": "postgresql", "cron_rule": "!"},
             False,
         ),
+        (
+            TargetModel,
+            {"env_name": "valid", "cron_rule": "* * * * *", "scratch_dir": "tmpfs"},
+            True,
+        ),
+        (
+            TargetModel,
+            {"env_name": "valid", "cron_rule": "* * * * *", "scratch_dir": "/mnt/nvme"},
+            True,
+        ),
+        (
+            TargetModel,
+            {"env_name": "valid", "cron_rule": "* * * * *", "scratch_dir": "mnt/nvme"},
+            False,
+        ),
         (
             PostgreSQLTargetModel,
             {"password": "secret", "env_name": "valid", "cron_rule": "5 5 * * *"},
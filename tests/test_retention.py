@@ -0,0 +1,166 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+from freezegun import freeze_time
+
+from ogion import config, core, retention
+from ogion.models.upload_provider_models import DebugProviderModel
+from ogion.upload_providers.debug import UploadProviderLocalDebug
+
+from .conftest import FILE_1
+
+BACKUPS = [
+    core.BackupEntry.from_key(f"env/file_{name}_dummy_xfcs.lz.age")
+    for name in ["20230427_0105", "20230426_0105", "20230425_0105"]
+]
+
+
+@freeze_time("2023-05-01")
+@pytest.mark.parametrize(
+    "max_backups,min_retention_days,expected",
+    [
+        (3, 0, []),
+        (2, 0, BACKUPS[2:]),
+        (1, 0, BACKUPS[:0:-1]),
+        (1, 5, BACKUPS[2:]),
+        (1, 7, []),
+    ],
+)
+def test_select_backups_to_delete(
+    max_backups: int, min_retention_days: int, expected: list[core.BackupEntry]
+) -> None:
+    backups = BACKUPS.copy()
+
+    assert (
+        retention.select_backups_to_delete(
+            backups, max_backups=max_backups, min_retention_days=min_retention_days
+        )
+        == expected
+    )
+    assert backups == BACKUPS
+
+
+def _hourly_backups(start: datetime, hours: int) -> list[core.BackupEntry]:
+    return [
+        core.BackupEntry.from_key(
+            f"env/file_{start - timedelta(hours=hour):%Y%m%d_%H%M}_dummy_xfcs.lz.age"
+        )
+        for hour in range(hours)
+    ]
+
+
+@freeze_time("2024-12-31 23:30")
+@pytest.mark.parametrize(
+    "keep_policy,expected_kept",
+    [
+        (retention.KeepPolicy(hourly=5), 5),
+        (retention.KeepPolicy(daily=7), 7),
+        (retention.KeepPolicy(hourly=24, daily=7), 24 + 6),
+        (retention.KeepPolicy(weekly=4), 4),
+        (retention.KeepPolicy(monthly=12), 12),
+        (retention.KeepPolicy(yearly=5), 1),
+        (retention.KeepPolicy(daily=7, weekly=4, monthly=12, yearly=2), 7 + 2 + 11),
+    ],
+)
+def test_select_backups_to_delete_keep_policy(
+    keep_policy: retention.KeepPolicy, expected_kept: int
+) -> None:
+    backups = _hourly_backups(datetime(2024, 12, 31, 23, 0), 24 * 366)
+
+    backups_to_delete = retention.select_backups_to_delete(
+        backups, max_backups=1, min_retention_days=0, keep_policy=keep_policy
+    )
+
+    assert len(backups) - len(backups_to_delete) == expected_kept
+    assert backups[0] not in backups_to_delete
+    assert backups_to_delete == sorted(backups_to_delete)
+
+
+@freeze_time("2024-12-31 23:30")
+def test_select_backups_to_delete_keep_policy_keeps_newest_in_period() -> None:
+    backups = _hourly_backups(datetime(2024, 12, 31, 23, 0), 24 * 3)
+
+    backups_to_delete = retention.select_backups_to_delete(
+        backups,
+        max_backups=1,
+        min_retention_days=0,
+        keep_policy=retention.KeepPolicy(daily=3),
+    )
+
+    assert [backup.key for backup in backups if backup not in backups_to_delete] == [
+        "env/file_20241231_2300_dummy_xfcs.lz.age",
+        "env/file_20241230_2300_dummy_xfcs.lz.age",
+        "env/file_20241229_2300_dummy_xfcs.lz.age",
+    ]
+
+
+@freeze_time("2024-12-31 23:30")
+def test_select_backups_to_delete_keep_policy_respects_max_and_retention() -> None:
+    backups = _hourly_backups(datetime(2024, 12, 31, 23, 0), 24 * 10)
+
+    backups_to_delete = retention.select_backups_to_delete(
+        backups,
+        max_backups=30,
+        min_retention_days=2,
+        keep_policy=retention.KeepPolicy(daily=7),
+    )
+
+    assert len(backups) - len(backups_to_delete) == 48 + 5  # noqa: PLR2004
+
+
+def test_keep_policy_from_target_model() -> None:
+    target_model = FILE_1.model_copy(update={"keep_daily": 7, "keep_monthly": 12})
+
+    assert retention.KeepPolicy.from_target_model(target_model) == retention.KeepPolicy(
+        daily=7, monthly=12
+    )
+    assert not any(retention.KeepPolicy.from_target_model(FILE_1))
+
+
+@freeze_time("2023-05-01")
+def test_provider_clean_all_sweeps_targets_with_single_listing(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 3600)
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    for env_name in ["first", "second", "unknown"]:
+        (config.CONST_DEBUG_FOLDER_PATH / env_name).mkdir()
+        for backup in BACKUPS:
+            (config.CONST_DEBUG_FOLDER_PATH / env_name / Path(backup.key).name).touch()
+    list_spy = Mock(wraps=provider._all_backups)
+    delete_spy = Mock(wraps=provider._delete_backups)
+    monkeypatch.setattr(provider, "_all_backups", list_spy)
+    monkeypatch.setattr(provider, "_delete_backups", delete_spy)
+    target_list_mock = Mock()
+    monkeypatch.setattr(provider, "_all_target_backups", target_list_mock)
+
+    provider.clean_all(
+        target_models=[
+            FILE_1.model_copy(
+                update={"env_name": "first", "max_backups": 1, "min_retention_days": 0}
+            ),
+            FILE_1.model_copy(
+                update={"env_name": "second", "max_backups": 2, "min_retention_days": 0}
+            ),
+        ]
+    )
+
+    list_spy.assert_called_once_with()
+    delete_spy.assert_called_once()
+    first = config.CONST_DEBUG_FOLDER_PATH / "first"
+    second = config.CONST_DEBUG_FOLDER_PATH / "second"
+    assert provider.all_target_backups("first") == [
+        f"{first}/file_20230427_0105_dummy_xfcs.lz.age"
+    ]
+    assert provider.all_target_backups("second") == [
+        f"{second}/file_20230427_0105_dummy_xfcs.lz.age",
+        f"{second}/file_20230426_0105_dummy_xfcs.lz.age",
+    ]
+    unknown = config.CONST_DEBUG_FOLDER_PATH / "unknown"
+    assert len(list(unknown.iterdir())) == len(BACKUPS)
+    target_list_mock.assert_not_called()
@@ -0,0 +1,66 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import multiprocessing
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from ogion import bandwidth, core, disk_space, shared_state
+
+MB = 1024 * 1024
+CTX = multiprocessing.get_context("forkserver")
+
+
+@pytest.fixture(scope="module")
+def state() -> Iterator[shared_state.SharedState]:
+    manager, state = shared_state.start(CTX)
+    yield state
+    manager.shutdown()
+
+
+def _borrow_in_worker(nbytes: int) -> float:
+    return bandwidth.LIMITER.shared.borrow(nbytes, limit=MB)
+
+
+def test_worker_processes_share_bandwidth_limiter(
+    state: shared_state.SharedState,
+) -> None:
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=CTX,
+        initializer=shared_state.use,
+        initargs=(state,),
+    ) as executor:
+        worker_wait = executor.submit(_borrow_in_worker, 100 * MB).result()
+
+    # Main process pays back bytes borrowed by the worker too
+    assert worker_wait > 0
+    assert state.limiter.borrow(MB, MB) > worker_wait
+
+
+def test_shared_disk_admission_raises_error_in_caller(
+    state: shared_state.SharedState, tmp_path: Path
+) -> None:
+    with pytest.raises(disk_space.NotEnoughDiskSpaceError, match="`env` needs"):
+        state.admission.reserve(tmp_path, 2**62, "env", 0)
+
+
+def test_use_points_module_limits_to_shared_state(
+    state: shared_state.SharedState,
+) -> None:
+    shared_state.use(state)
+    try:
+        assert core.CPU_TOKENS.shared is state.cpu_tokens
+        assert disk_space.ADMISSION.shared is state.admission
+        assert bandwidth.LIMITER.shared is state.limiter
+        with core.CPU_TOKENS.acquire() as tokens:
+            assert tokens >= 1
+    finally:
+        shared_state.use_local()
+
+    assert core.CPU_TOKENS.shared is core.CPU_TOKENS
+    assert disk_space.ADMISSION.shared is disk_space.ADMISSION
+    assert bandwidth.LIMITER.shared is bandwidth.LIMITER
@@ -0,0 +1,179 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import os
+import threading
+import time
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+
+from ogion import config, core, main, metrics
+from ogion.models.upload_provider_models import DebugProviderModel
+from ogion.upload_providers import spool
+from ogion.upload_providers.debug import UploadProviderLocalDebug
+
+KB = 1024
+
+
+def _age_file(env_name: str, name: str, size: int = 10) -> Path:
+    path = (
+        config.CONST_DATA_FOLDER_PATH
+        / env_name
+        / f"{env_name}_20240101_0000_{name}_token.lz.age"
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(os.urandom(size))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def spool_enabled(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config.options, "UPLOAD_SPOOL_MAX_SIZE_MB", 1)
+    monkeypatch.setattr(config.options, "UPLOAD_SPOOL_RETRY_SECS", 60)
+
+
+@pytest.fixture
+def failing_provider(monkeypatch: pytest.MonkeyPatch) -> UploadProviderLocalDebug:
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    monkeypatch.setattr(
+        provider, "_upload", Mock(side_effect=ConnectionError("provider down"))
+    )
+    monkeypatch.setattr(
+        core,
+        "run_create_age_archive",
+        lambda backup_file: backup_file.with_name(f"{backup_file.name}.lz.age"),
+    )
+    return provider
+
+
+def test_post_save_spools_backup_when_upload_fails(
+    failing_provider: UploadProviderLocalDebug,
+) -> None:
+    backup_file = config.CONST_DATA_FOLDER_PATH / "env" / "env_20240101_0000_db"
+    backup_file.parent.mkdir()
+    backup_file.write_text("dump")
+    backup_file.with_name(f"{backup_file.name}.lz.age").write_text("age")
+
+    with pytest.raises(ConnectionError):
+        failing_provider.post_save(backup_file)
+
+    (item,) = spool.SPOOL.items()
+    assert item.path == (
+        config.CONST_SPOOL_FOLDER_PATH / "env" / "env_20240101_0000_db.lz.age"
+    )
+    assert item.env_name == "env"
+    assert not backup_file.exists()
+    assert not list(backup_file.parent.iterdir())
+    assert spool.SPOOL.due() == []
+    assert spool.SPOOL.due(now=item.next_attempt_at) == [item]
+    assert metrics.SPOOLED_UPLOADS.snapshot()[("env",)][1] == 1
+
+
+def test_post_save_keeps_files_when_spool_disabled(
+    failing_provider: UploadProviderLocalDebug, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(config.options, "UPLOAD_SPOOL_MAX_SIZE_MB", 0)
+    backup_file = config.CONST_DATA_FOLDER_PATH / "env" / "env_20240101_0000_db"
+    backup_file.parent.mkdir()
+    backup_file.write_text("dump")
+    backup_file.with_name(f"{backup_file.name}.lz.age").write_text("age")
+
+    with pytest.raises(ConnectionError):
+        failing_provider.post_save(backup_file)
+
+    assert spool.SPOOL.items() == []
+    assert backup_file.exists()
+
+
+def test_upload_due_retries_oldest_first_and_survives_restart(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    first = spool.SPOOL.add(_age_file("env", "first"))
+    second = spool.SPOOL.add(_age_file("env", "second"))
+    assert first is not None
+    assert second is not None
+    upload_mock = Mock(side_effect=[ConnectionError("provider down"), "uploaded"])
+    monkeypatch.setattr(time, "time", lambda: second.next_attempt_at + 1)
+    namespace = provider.listing_index.namespace
+
+    assert spool.SPOOL.upload_due({namespace: upload_mock}) == 1
+
+    assert [call.args[0] for call in upload_mock.call_args_list] == [
+        first.path,
+        second.path,
+    ]
+    (failed,) = spool.UploadSpool().items()
+    assert failed.path == first.path
+    assert failed.attempts == 1
+    assert failed.last_error == "ConnectionError: provider down"
+    assert failed.providers == [namespace]
+    assert failed.next_attempt_at == second.next_attempt_at + 61
+    assert not second.state_path.exists()
+
+    monkeypatch.setattr(time, "time", lambda: failed.next_attempt_at)
+    assert spool.SPOOL.upload_due(provider.upload_callables()) == 1
+    assert spool.SPOOL.items() == []
+    assert (config.CONST_DEBUG_FOLDER_PATH / "env" / first.path.name).exists()
+
+
+def test_upload_backoff_is_exponential_and_capped(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    item = spool.SPOOL.add(_age_file("env", "first"))
+    assert item is not None
+    upload_mock = Mock(side_effect=ConnectionError("provider down"))
+    delays: list[float] = []
+    for _ in range(8):
+        now = spool.SPOOL.items()[0].next_attempt_at
+        monkeypatch.setattr(time, "time", lambda now=now: now)
+        spool.SPOOL.upload_due({"provider": upload_mock})
+        delays.append(spool.SPOOL.items()[0].next_attempt_at - now)
+
+    assert delays == [60, 120, 240, 480, 960, 1920, 3600, 3600]
+
+
+def test_add_drops_oldest_backups_when_spool_is_full() -> None:
+    first = spool.SPOOL.add(_age_file("env_a", "first", size=400 * KB))
+    spool.SPOOL.add(_age_file("env_b", "second", size=400 * KB))
+    spool.SPOOL.add(_age_file("env_a", "third", size=400 * KB))
+
+    assert first is not None
+    assert [item.path.name for item in spool.SPOOL.items()] == [
+        "env_b_20240101_0000_second_token.lz.age",
+        "env_a_20240101_0000_third_token.lz.age",
+    ]
+    assert not first.state_path.exists()
+    assert spool.SPOOL.add(_age_file("env_a", "huge", size=2048 * KB)) is None
+
+
+def test_items_include_file_without_state() -> None:
+    path = config.CONST_SPOOL_FOLDER_PATH / "env" / "orphan.lz.age"
+    path.parent.mkdir(parents=True)
+    path.write_text("age")
+
+    (item,) = spool.SPOOL.items()
+
+    assert item.path == path
+    assert item.created_at == path.stat().st_mtime
+    assert item.next_attempt_at == 0
+
+
+def test_schedule_spool_uploads_uploads_due_backups(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    monkeypatch.setattr(main, "backup_provider", Mock(return_value=provider))
+    item = spool.SPOOL.add(_age_file("env", "first"))
+    assert item is not None
+    monkeypatch.setattr(time, "time", lambda: item.next_attempt_at)
+
+    main.schedule_spool_uploads()
+    for thread in threading.enumerate():
+        if thread.name == main.UPLOAD_SPOOL_THREAD:
+            thread.join(timeout=5)
+
+    assert spool.SPOOL.items() == []
+    assert (config.CONST_DEBUG_FOLDER_PATH / "env" / item.path.name).exists()
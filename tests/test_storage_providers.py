@@ -1,15 +1,20 @@
 # Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
 # GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
 
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timedelta
 from pathlib import Path
-from unittest.mock import Mock
+from unittest.mock import MagicMock, Mock
 
+import google.cloud.storage as storage_client
 import pytest
-from azure.core.exceptions import ResourceNotFoundError
-from google.cloud.exceptions import NotFound
+from google.auth.credentials import AnonymousCredentials
 from pydantic import SecretStr
 
-from ogion import config
+from ogion import config, verify
 from ogion.models.upload_provider_models import (
     AzureProviderModel,
     DebugProviderModel,
@@ -19,9 +24,14 @@ from ogion.models.upload_provider_models import (
 from ogion.upload_providers.azure import UploadProviderAzure
 from ogion.upload_providers.base_provider import BaseUploadProvider
 from ogion.upload_providers.debug import UploadProviderLocalDebug
-from ogion.upload_providers.google_cloud_storage import UploadProviderGCS
+from ogion.upload_providers.google_cloud_storage import (
+    GCS_SLICES_PREFIX,
+    UploadProviderGCS,
+)
 from ogion.upload_providers.s3 import UploadProviderS3
 
+from .conftest import FILE_1
+
 
 def test_gcs_post_save(provider: BaseUploadProvider, provider_prefix: str) -> None:
     fake_backup_dir_path = config.CONST_DATA_FOLDER_PATH / "fake_env_name"
@@ -203,6 +213,159 @@ def test_gcs_download_backup(
     assert out.is_file()
 
 
+def test_upload_stream_from_running_process(
+    provider: BaseUploadProvider, provider_prefix: str
+) -> None:
+    data = os.urandom(2 * 1024 * 1024 + 100)
+    read_fd, write_fd = os.pipe()
+
+    def write_dump() -> None:
+        with open(write_fd, "wb") as pipe:
+            pipe.write(data)
+
+    writer = threading.Thread(target=write_dump)
+    writer.start()
+    with open(read_fd, "rb") as stream:
+        backup_path = provider.upload_stream(
+            stream, "fake_env_name", "file_20230426_0105_dummy_xfcs.lz.age"
+        )
+    writer.join()
+
+    assert backup_path == (
+        f"{provider_prefix}fake_env_name/file_20230426_0105_dummy_xfcs.lz.age"
+    )
+    assert provider.all_target_backups("fake_env_name") == [backup_path]
+    assert provider.download_backup(backup_path).read_bytes() == data
+
+
+def test_verify_streamed_backup(
+    provider: BaseUploadProvider, provider_prefix: str
+) -> None:
+    data = os.urandom(3 * 1024 * 1024 + 100)
+    age_file = (
+        config.CONST_DATA_FOLDER_PATH
+        / "fake_env_name"
+        / "file_20230426_0105_dummy_xfcs.lz.age"
+    )
+    age_file.parent.mkdir()
+    age_file.write_bytes(data)
+    provider.upload(age_file)
+    (entry,) = provider.all_target_entries("fake_env_name")
+
+    assert b"".join(provider.stream_backup(entry.key)) == data
+    assert provider.stored_sha256(entry) == hashlib.sha256(data).hexdigest()
+    verify.verify_backup(provider, entry, identity_path=None)
+
+
+def test_gcs_transfer_manager_upload_and_download() -> None:
+    client = storage_client.Client(
+        credentials=AnonymousCredentials()  # type: ignore[no-untyped-call]
+    )
+    bucket = client.create_bucket(str(time.time_ns()))
+    provider = UploadProviderGCS(
+        GCSProviderModel(
+            bucket_name=bucket.name or "",
+            bucket_upload_path="test",
+            service_account_base64=SecretStr("Z29vZ2xlX3NlcnZpY2VfYWNjb3VudAo="),
+            chunk_size_mb=1,
+            transfer_workers=4,
+        )
+    )
+    age_backup_file = (
+        config.CONST_DATA_FOLDER_PATH
+        / "fake_env_name"
+        / "file_20230426_0105_dummy_xfcs.lz.age"
+    )
+    age_backup_file.parent.mkdir()
+    data = os.urandom(3 * 1024 * 1024 + 100)
+    age_backup_file.write_bytes(data)
+
+    backup_path = provider.upload(age_backup_file)
+
+    assert backup_path == "test/fake_env_name/file_20230426_0105_dummy_xfcs.lz.age"
+    assert provider.all_target_backups("fake_env_name") == [backup_path]
+    assert not list(client.list_blobs(bucket, prefix=GCS_SLICES_PREFIX))
+    assert provider.download_backup(backup_path).read_bytes() == data
+
+
+def _azure_block_upload(
+    max_concurrency: int, age_backup_file: Path
+) -> tuple[UploadProviderAzure, str, int, float]:
+    from azure.storage.blob import BlobClient  # noqa: PLC0415
+
+    provider = UploadProviderAzure(
+        AzureProviderModel(
+            container_name=str(time.time_ns()),
+            connect_string=SecretStr(
+                "DefaultEndpointsProtocol=http;"
+                "AccountName=devstoreaccount1;"
+                "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"
+                "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+            ),
+            max_concurrency=max_concurrency,
+            max_block_size_mb=1,
+            max_single_put_size_mb=1,
+        )
+    )
+    provider.container_client.create_container()
+    stage_block = BlobClient.stage_block
+    lock = threading.Lock()
+    in_flight = [0]
+    max_in_flight = [0]
+
+    def stage_block_spy(self: BlobClient, *args: object, **kwargs: object) -> object:
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        try:
+            # Same latency for every block, so staging time depends only on
+            # how many blocks are staged at once
+            time.sleep(0.1)
+            return stage_block(self, *args, **kwargs)  # type: ignore[arg-type]
+        finally:
+            with lock:
+                in_flight[0] -= 1
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(BlobClient, "stage_block", stage_block_spy)
+        start = time.perf_counter()
+        backup_path = provider.upload(age_backup_file)
+        elapsed = time.perf_counter() - start
+    return provider, backup_path, max_in_flight[0], elapsed
+
+
+def test_azure_parallel_block_upload_is_faster_than_sequential() -> None:
+    age_backup_file = (
+        config.CONST_DATA_FOLDER_PATH
+        / "fake_env_name"
+        / "file_20230426_0105_dummy_xfaz.lz.age"
+    )
+    age_backup_file.parent.mkdir()
+    data = os.urandom(8 * 1024 * 1024 + 100)
+    age_backup_file.write_bytes(data)
+
+    _, _, sequential_in_flight, sequential_secs = _azure_block_upload(
+        1, age_backup_file
+    )
+    provider, backup_path, parallel_in_flight, parallel_secs = _azure_block_upload(
+        4, age_backup_file
+    )
+
+    assert sequential_in_flight == 1
+    assert parallel_in_flight > 1
+    # 9 blocks of 0.1s latency are staged in at least 3 rounds by 4 threads
+    assert parallel_secs < sequential_secs - 0.3, (
+        f"max_concurrency=4 took {parallel_secs:.2f}s, "
+        f"max_concurrency=1 took {sequential_secs:.2f}s"
+    )
+    assert backup_path == "fake_env_name/file_20230426_0105_dummy_xfaz.lz.age"
+    committed, _ = provider.container_client.get_blob_client(
+        backup_path
+    ).get_block_list("committed")
+    assert len(committed) == 9  # noqa: PLR2004
+    assert provider.download_backup(backup_path).read_bytes() == data
+
+
 @pytest.mark.parametrize(
     "provider_model,path",
     [
@@ -370,39 +533,28 @@ def test_gcs_clean_handles_already_deleted_blob(
     assert len(provider.all_target_backups("fake_env_name")) == expected_final_count
 
 
-def test_azure_clean_handles_resource_not_found_error(
-    monkeypatch: pytest.MonkeyPatch,
-) -> None:
-    """Test Azure clean() handles ResourceNotFoundError during deletion."""
-    # Create a mock Azure provider
+def _days_since(start: datetime, days: int) -> list[datetime]:
+    return [start + timedelta(days=day) for day in range(days)]
+
+
+def _mock_azure_provider(
+    monkeypatch: pytest.MonkeyPatch, blob_names: list[str]
+) -> tuple[UploadProviderAzure, Mock]:
     mock_container_client = Mock()
     mock_blob_service_client = Mock()
     mock_blob_service_client.get_container_client.return_value = mock_container_client
 
-    # Mock list_blobs to return 3 backups
-    mock_blob_1 = Mock()
-    mock_blob_1.name = "fake_env/file_20230425_0105_dummy.lz.age"
-    mock_blob_2 = Mock()
-    mock_blob_2.name = "fake_env/file_20230426_0105_dummy.lz.age"
-    mock_blob_3 = Mock()
-    mock_blob_3.name = "fake_env/file_20230427_0105_dummy.lz.age"
-    mock_container_client.list_blobs.return_value = [
-        mock_blob_1,
-        mock_blob_2,
-        mock_blob_3,
-    ]
-
-    # Mock delete_blob to raise ResourceNotFoundError (concurrent deletion)
-    mock_container_client.delete_blob.side_effect = ResourceNotFoundError(
-        "Blob not found"
-    )
+    blobs = []
+    for blob_name in blob_names:
+        blob = Mock(size=1, etag="etag")
+        blob.name = blob_name
+        blobs.append(blob)
+    mock_container_client.list_blobs.return_value = blobs
 
-    # Patch BlobServiceClient
     mock_blob_service_client_class = Mock(return_value=mock_blob_service_client)
     mock_blob_service_client_class.from_connection_string = Mock(
         return_value=mock_blob_service_client
     )
-
     monkeypatch.setattr(
         "azure.storage.blob.BlobServiceClient",
         mock_blob_service_client_class,
@@ -415,50 +567,144 @@ def test_azure_clean_handles_resource_not_found_error(
             "DefaultEndpointsProtocol=https;AccountName=test;AccountKey=test=="
         ),
     )
-    provider = UploadProviderAzure(provider_model)
+    return UploadProviderAzure(provider_model), mock_container_client
+
+
+def test_azure_clean_handles_resource_not_found_error(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test Azure clean() handles 404 responses in batch deletion."""
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 3600)
+    provider, mock_container_client = _mock_azure_provider(
+        monkeypatch,
+        [
+            "fake_env/file_20230425_0105_dummy.lz.age",
+            "fake_env/file_20230426_0105_dummy.lz.age",
+            "fake_env/file_20230427_0105_dummy.lz.age",
+        ],
+    )
+    # Blob already deleted (concurrent deletion)
+    mock_container_client.delete_blobs.return_value = iter([Mock(status_code=404)])
 
     fake_backup_dir_path = config.CONST_DATA_FOLDER_PATH / "fake_env"
     fake_backup_dir_path.mkdir(parents=True, exist_ok=True)
     fake_backup_file = fake_backup_dir_path / "file_20230427_0105_dummy.lz.age"
 
-    # Should not raise exception with ResourceNotFoundError
     provider.clean(fake_backup_file, max_backups=2, min_retention_days=1)
 
-    # Verify delete_blob was called (trying to delete the oldest backup)
-    assert mock_container_client.delete_blob.called
+    mock_container_client.delete_blobs.assert_called_once_with(
+        "fake_env/file_20230425_0105_dummy.lz.age", raise_on_any_failure=False
+    )
+    assert provider.all_target_backups("fake_env") == [
+        "fake_env/file_20230427_0105_dummy.lz.age",
+        "fake_env/file_20230426_0105_dummy.lz.age",
+    ]
 
 
-def test_gcs_clean_handles_not_found_error(monkeypatch: pytest.MonkeyPatch) -> None:
-    """Test GCS clean() handles NotFound error during deletion."""
-    # Create mock GCS components
-    mock_blob_1 = Mock()
-    mock_blob_1.name = "backups/fake_env/file_20230425_0105_dummy.lz.age"
-    mock_blob_2 = Mock()
-    mock_blob_2.name = "backups/fake_env/file_20230426_0105_dummy.lz.age"
-    mock_blob_3 = Mock()
-    mock_blob_3.name = "backups/fake_env/file_20230427_0105_dummy.lz.age"
-
-    # Mock blob.delete() to raise NotFound
-    mock_blob_to_delete = Mock()
-    mock_blob_to_delete.delete.side_effect = NotFound("Blob not found")  # type: ignore[no-untyped-call]
-
-    mock_bucket = Mock()
-    mock_bucket.blob.return_value = mock_blob_to_delete
-
-    mock_storage_client = Mock()
-    mock_storage_client.bucket.return_value = mock_bucket
-    # Mock list_blobs on storage_client (not bucket)
-    mock_storage_client.list_blobs.return_value = [
-        mock_blob_1,
-        mock_blob_2,
-        mock_blob_3,
+def test_azure_clean_deletes_in_batches(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 3600)
+    blob_names = [
+        f"fake_env/file_{day:%Y%m%d}_0105_dummy.lz.age"
+        for day in _days_since(datetime(2020, 1, 1), 300)
+    ]
+    provider, mock_container_client = _mock_azure_provider(monkeypatch, blob_names)
+    mock_container_client.delete_blobs.side_effect = lambda *blobs, **kwargs: iter(
+        [Mock(status_code=202) for _ in blobs]
+    )
+
+    fake_backup_dir_path = config.CONST_DATA_FOLDER_PATH / "fake_env"
+    fake_backup_dir_path.mkdir(parents=True, exist_ok=True)
+    fake_backup_file = fake_backup_dir_path / "file_20230427_0105_dummy.lz.age"
+
+    provider.clean(fake_backup_file, max_backups=1, min_retention_days=0)
+
+    calls = mock_container_client.delete_blobs.call_args_list
+    assert [len(call.args) for call in calls] == [256, 43]
+    assert provider.all_target_backups("fake_env") == [blob_names[-1]]
+
+
+def test_azure_clean_raises_on_failed_batch_delete(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    provider, mock_container_client = _mock_azure_provider(
+        monkeypatch,
+        [
+            "fake_env/file_20230425_0105_dummy.lz.age",
+            "fake_env/file_20230426_0105_dummy.lz.age",
+        ],
+    )
+    mock_container_client.delete_blobs.return_value = iter([Mock(status_code=403)])
+
+    fake_backup_dir_path = config.CONST_DATA_FOLDER_PATH / "fake_env"
+    fake_backup_dir_path.mkdir(parents=True, exist_ok=True)
+    fake_backup_file = fake_backup_dir_path / "file_20230427_0105_dummy.lz.age"
+
+    with pytest.raises(RuntimeError):
+        provider.clean(fake_backup_file, max_backups=1, min_retention_days=0)
+
+
+def test_azure_clean_all_deletes_all_targets_in_one_listing(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 3600)
+    blob_names = [
+        f"{env_name}/file_{day:%Y%m%d}_0105_dummy.lz.age"
+        for env_name in ["first", "second", "unknown"]
+        for day in _days_since(datetime(2020, 1, 1), 3)
     ]
+    # Blob outside of any folder belongs to no target and is left untouched
+    provider, mock_container_client = _mock_azure_provider(
+        monkeypatch, [*blob_names, "file_20200101_0105_dummy.lz.age"]
+    )
+    mock_container_client.delete_blobs.side_effect = lambda *blobs, **kwargs: iter(
+        [Mock(status_code=202) for _ in blobs]
+    )
+
+    provider.clean_all(
+        target_models=[
+            FILE_1.model_copy(
+                update={"env_name": env_name, "max_backups": 1, "min_retention_days": 0}
+            )
+            for env_name in ["first", "second"]
+        ]
+    )
+
+    mock_container_client.list_blobs.assert_called_once_with(include=["metadata"])
+    mock_container_client.delete_blobs.assert_called_once_with(
+        *blob_names[0:2],
+        *blob_names[3:5],
+        raise_on_any_failure=False,
+    )
+    assert provider.all_target_backups("first") == [blob_names[2]]
+    assert provider.all_target_backups("second") == [blob_names[5]]
+
+
+def _mock_gcs_provider(
+    monkeypatch: pytest.MonkeyPatch, blob_names: list[str], status_code: int
+) -> tuple[UploadProviderGCS, MagicMock]:
+    blobs = []
+    for blob_name in blob_names:
+        blob = Mock(size=1, etag="etag")
+        blob.name = blob_name
+        blobs.append(blob)
+
+    mock_storage_client = MagicMock()
+
+    def list_blobs(bucket: object, prefix: str | None) -> list[Mock]:
+        return [blob for blob in blobs if blob.name.startswith(prefix or "")]
+
+    def bucket_blob(name: str, **kwargs: object) -> Mock:
+        def delete() -> None:
+            # Failed delete leaves blob in bucket, 404 means it is already gone
+            if status_code in {204, 404}:
+                blobs[:] = [stored for stored in blobs if stored.name != name]
 
-    # Patch storage.Client
-    mock_client_class = Mock(return_value=mock_storage_client)
+        return Mock(delete=delete)
+
+    mock_storage_client.list_blobs.side_effect = list_blobs
+    mock_storage_client.bucket.return_value.blob.side_effect = bucket_blob
     monkeypatch.setattr(
-        "google.cloud.storage.Client",
-        mock_client_class,
+        "google.cloud.storage.Client", Mock(return_value=mock_storage_client)
     )
 
     provider_model = GCSProviderModel(
@@ -467,27 +713,86 @@ def test_gcs_clean_handles_not_found_error(monkeypatch: pytest.MonkeyPatch) -> N
         bucket_upload_path="backups",
         service_account_base64=SecretStr("dGVzdA=="),  # base64 "test"
     )
-    provider = UploadProviderGCS(provider_model)
+    return UploadProviderGCS(provider_model), mock_storage_client
+
+
+def test_gcs_clean_handles_not_found_error(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test GCS clean() handles 404 responses in batch deletion."""
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 3600)
+    provider, mock_storage_client = _mock_gcs_provider(
+        monkeypatch,
+        [
+            "backups/fake_env/file_20230425_0105_dummy.lz.age",
+            "backups/fake_env/file_20230426_0105_dummy.lz.age",
+            "backups/fake_env/file_20230427_0105_dummy.lz.age",
+        ],
+        status_code=404,
+    )
 
     fake_backup_dir_path = config.CONST_DATA_FOLDER_PATH / "fake_env"
     fake_backup_dir_path.mkdir(parents=True, exist_ok=True)
     fake_backup_file = fake_backup_dir_path / "file_20230427_0105_dummy.lz.age"
 
-    # This should not raise an exception even though blob.delete() raises NotFound
+    # This should not raise an exception even though blob was already deleted
     provider.clean(fake_backup_file, max_backups=2, min_retention_days=1)
 
-    # Verify delete was attempted
-    assert mock_blob_to_delete.delete.called
+    mock_storage_client.batch.assert_called_once_with(raise_exception=False)
+    assert provider.all_target_backups("fake_env") == [
+        "backups/fake_env/file_20230427_0105_dummy.lz.age",
+        "backups/fake_env/file_20230426_0105_dummy.lz.age",
+    ]
+
+
+def test_gcs_clean_deletes_in_batches(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config.options, "BACKUP_LISTING_INDEX_TTL_SECS", 3600)
+    blob_names = [
+        f"backups/fake_env/file_{day:%Y%m%d}_0105_dummy.lz.age"
+        for day in _days_since(datetime(2020, 1, 1), 250)
+    ]
+    provider, mock_storage_client = _mock_gcs_provider(
+        monkeypatch, blob_names, status_code=204
+    )
+
+    fake_backup_dir_path = config.CONST_DATA_FOLDER_PATH / "fake_env"
+    fake_backup_dir_path.mkdir(parents=True, exist_ok=True)
+    fake_backup_file = fake_backup_dir_path / "file_20230427_0105_dummy.lz.age"
+
+    provider.clean(fake_backup_file, max_backups=1, min_retention_days=0)
+
+    assert mock_storage_client.batch.call_count == 3  # noqa: PLR2004
+    # One listing to find old backups and one to check they are all deleted
+    assert mock_storage_client.list_blobs.call_count == 2  # noqa: PLR2004
+    assert provider.all_target_backups("fake_env") == [blob_names[-1]]
+
+
+def test_gcs_clean_raises_on_failed_batch_delete(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    provider, _ = _mock_gcs_provider(
+        monkeypatch,
+        [
+            "backups/fake_env/file_20230425_0105_dummy.lz.age",
+            "backups/fake_env/file_20230426_0105_dummy.lz.age",
+        ],
+        status_code=403,
+    )
+
+    fake_backup_dir_path = config.CONST_DATA_FOLDER_PATH / "fake_env"
+    fake_backup_dir_path.mkdir(parents=True, exist_ok=True)
+    fake_backup_file = fake_backup_dir_path / "file_20230427_0105_dummy.lz.age"
+
+    with pytest.raises(RuntimeError):
+        provider.clean(fake_backup_file, max_backups=1, min_retention_days=0)
 
 
 def test_s3_clean_filters_no_such_key_errors(monkeypatch: pytest.MonkeyPatch) -> None:
     """Test S3 clean() filters out NoSuchKey errors from delete responses."""
     # Create mock S3 components
-    mock_obj_1 = Mock()
+    mock_obj_1 = Mock(size=1, etag="etag")
     mock_obj_1.object_name = "fake_env/file_20230425_0105_dummy.lz.age"
-    mock_obj_2 = Mock()
+    mock_obj_2 = Mock(size=1, etag="etag")
     mock_obj_2.object_name = "fake_env/file_20230426_0105_dummy.lz.age"
-    mock_obj_3 = Mock()
+    mock_obj_3 = Mock(size=1, etag="etag")
     mock_obj_3.object_name = "fake_env/file_20230427_0105_dummy.lz.age"
 
     mock_client = Mock()
@@ -530,11 +835,11 @@ def test_s3_clean_raises_on_non_no_such_key_errors(
 ) -> None:
     """Test S3 clean() raises RuntimeError for non-NoSuchKey errors."""
     # Create mock S3 components
-    mock_obj_1 = Mock()
+    mock_obj_1 = Mock(size=1, etag="etag")
     mock_obj_1.object_name = "backups/fake_env/file_20230425_0105_dummy.lz.age"
-    mock_obj_2 = Mock()
+    mock_obj_2 = Mock(size=1, etag="etag")
     mock_obj_2.object_name = "backups/fake_env/file_20230426_0105_dummy.lz.age"
-    mock_obj_3 = Mock()
+    mock_obj_3 = Mock(size=1, etag="etag")
     mock_obj_3.object_name = "backups/fake_env/file_20230427_0105_dummy.lz.age"
 
     mock_client = Mock()
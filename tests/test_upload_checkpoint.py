@@ -0,0 +1,410 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import base64
+import hashlib
+import os
+import threading
+from http import HTTPStatus
+from pathlib import Path
+from typing import Any
+from unittest.mock import Mock
+
+import pytest
+from google import resumable_media
+from pydantic import SecretStr
+
+from ogion import config, core
+from ogion.models.upload_provider_models import (
+    AzureProviderModel,
+    DebugProviderModel,
+    S3ProviderModel,
+)
+from ogion.upload_providers import checkpoint, checksum, s3, spool
+from ogion.upload_providers.azure import UploadProviderAzure
+from ogion.upload_providers.debug import UploadProviderLocalDebug
+from ogion.upload_providers.google_cloud_storage import FileSlice, UploadProviderGCS
+from ogion.upload_providers.listing_index import ListingIndex
+from ogion.upload_providers.s3 import UploadProviderS3
+
+PART_SIZE = 1024
+FILE_SIZE = 3 * PART_SIZE + 100
+
+
+@pytest.fixture
+def age_file() -> Path:
+    path = config.CONST_DATA_FOLDER_PATH / "env" / "env_20240101_0000_db.lz.age"
+    path.parent.mkdir(parents=True)
+    path.write_bytes(os.urandom(FILE_SIZE))
+    return path
+
+
+def test_checkpoint_is_bound_to_file_and_namespace(age_file: Path) -> None:
+    upload_checkpoint = checkpoint.UploadCheckpoint(age_file, namespace="a")
+    assert upload_checkpoint.load() is None
+
+    upload_checkpoint.save({"upload_id": "id"})
+
+    assert checkpoint.UploadCheckpoint(age_file, namespace="a").load() == {
+        "upload_id": "id"
+    }
+    assert checkpoint.UploadCheckpoint(age_file, namespace="b").load() is None
+    age_file.write_bytes(b"changed")
+    assert checkpoint.UploadCheckpoint(age_file, namespace="a").load() is None
+
+    upload_checkpoint.clear()
+    assert not upload_checkpoint.path.exists()
+
+
+def test_spool_keeps_checkpoint_next_to_spooled_backup(
+    age_file: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(config.options, "UPLOAD_SPOOL_MAX_SIZE_MB", 1)
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    provider.upload_checkpoint(age_file).save({"upload_id": "id"})
+
+    item = spool.SPOOL.add(age_file)
+
+    assert item is not None
+    assert provider.upload_checkpoint(item.path).load() == {"upload_id": "id"}
+    provider.upload(item.path)
+    assert checkpoint.checkpoint_paths(item.path) == []
+
+
+def test_s3_multipart_upload_resumes_from_last_part(
+    age_file: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(s3, "S3_MIN_PART_SIZE", PART_SIZE)
+    provider = UploadProviderS3(
+        S3ProviderModel(
+            bucket_name="bucket",
+            bucket_upload_path="test",
+            access_key="minioadmin",
+            secret_key=SecretStr("minioadmin"),
+        )
+    )
+    uploaded_parts: dict[int, bytes] = {}
+
+    def upload_part(*args: Any) -> str:
+        (_, _, data, _, _, part_number) = args
+        if part_number == 3 and 3 not in uploaded_parts:  # noqa: PLR2004
+            uploaded_parts[part_number] = b""
+            raise ConnectionError("connection reset")
+        uploaded_parts[part_number] = data
+        return f"etag{part_number}"
+
+    create_mock = Mock(return_value="upload_id")
+    complete_mock = Mock()
+    monkeypatch.setattr(provider.client, "_create_multipart_upload", create_mock)
+    monkeypatch.setattr(provider.client, "_upload_part", upload_part)
+    monkeypatch.setattr(provider.client, "_complete_multipart_upload", complete_mock)
+    tags_mock = Mock()
+    monkeypatch.setattr(provider.client, "set_object_tags", tags_mock)
+
+    with pytest.raises(ConnectionError):
+        provider._upload(age_file)
+    state = provider.upload_checkpoint(age_file).load()
+    assert state is not None
+    assert state["parts"] == {"1": "etag1", "2": "etag2"}
+
+    upload_part_spy = Mock(side_effect=upload_part)
+    monkeypatch.setattr(provider.client, "_upload_part", upload_part_spy)
+    uploaded = provider._upload(age_file)
+
+    create_mock.assert_called_once()
+    assert [call.args[5] for call in upload_part_spy.call_args_list] == [3, 4]
+    assert b"".join(uploaded_parts[part] for part in range(1, 5)) == (
+        age_file.read_bytes()
+    )
+    (_, _, upload_id, parts) = complete_mock.call_args.args
+    assert upload_id == "upload_id"
+    assert [(part.part_number, part.etag) for part in parts] == [
+        (1, "etag1"),
+        (2, "etag2"),
+        (3, "etag3"),
+        (4, "etag4"),
+    ]
+    # Parts uploaded before failure are read again only to hash them
+    sha256 = hashlib.sha256(age_file.read_bytes()).hexdigest()
+    assert uploaded.sha256 == sha256
+    (_, _, tags) = tags_mock.call_args.args
+    assert tags[checksum.SHA256_KEY] == sha256
+
+
+def test_s3_failed_multipart_upload_is_aborted_when_not_spooled(
+    age_file: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(s3, "S3_MIN_PART_SIZE", PART_SIZE)
+    monkeypatch.setattr(config.options, "UPLOAD_SPOOL_MAX_SIZE_MB", 0)
+    monkeypatch.setattr(core, "run_create_age_archive", Mock(return_value=age_file))
+    provider = UploadProviderS3(
+        S3ProviderModel(
+            bucket_name="bucket",
+            bucket_upload_path="test",
+            access_key="minioadmin",
+            secret_key=SecretStr("minioadmin"),
+        )
+    )
+    monkeypatch.setattr(
+        provider.client, "_create_multipart_upload", Mock(return_value="upload_id")
+    )
+    monkeypatch.setattr(
+        provider.client,
+        "_upload_part",
+        Mock(side_effect=["etag1", ConnectionError("connection reset")]),
+    )
+    abort_mock = Mock()
+    monkeypatch.setattr(provider.client, "_abort_multipart_upload", abort_mock)
+
+    with pytest.raises(ConnectionError):
+        provider.post_save(age_file)
+
+    abort_mock.assert_called_once_with(
+        "bucket", f"test/env/{age_file.name}", "upload_id"
+    )
+    assert checkpoint.checkpoint_paths(age_file) == []
+
+
+GCS_CHUNK_SIZE = resumable_media.UPLOAD_CHUNK_SIZE
+GCS_FILE_SIZE = 3 * GCS_CHUNK_SIZE + 100
+
+
+class FakeResumableSession:
+    """GCS resumable upload session failing once at offset fail_at."""
+
+    def __init__(self, size: int, fail_at: int) -> None:
+        self.size = size
+        self.fail_at = fail_at
+        self.data = b""
+        self.offsets: list[int] = []
+        self.initiated = 0
+
+    def _incomplete(self) -> Mock:
+        headers = {"range": f"bytes=0-{len(self.data) - 1}"} if self.data else {}
+        return Mock(status_code=HTTPStatus.PERMANENT_REDIRECT, headers=headers)
+
+    def request(
+        self, method: str, url: str, data: bytes, headers: dict[str, str], **kwargs: Any
+    ) -> Mock:
+        if method == "POST":
+            self.initiated += 1
+            return Mock(
+                status_code=HTTPStatus.OK, headers={"location": "http://session"}
+            )
+        content_range = headers["content-range"].removeprefix("bytes ")
+        if content_range.startswith("*"):
+            return self._incomplete()
+
+        offset = int(content_range.split("-")[0])
+        self.offsets.append(offset)
+        if offset == self.fail_at:
+            self.fail_at = -1
+            return Mock(status_code=HTTPStatus.BAD_REQUEST, headers={})
+        self.data = self.data[:offset] + data
+        if len(self.data) < self.size:
+            return self._incomplete()
+        md5_hash = base64.b64encode(hashlib.md5(self.data).digest()).decode()
+        return Mock(
+            status_code=HTTPStatus.OK, json=Mock(return_value={"md5Hash": md5_hash})
+        )
+
+
+def test_gcs_resumable_upload_resumes_from_persisted_offset(tmp_path: Path) -> None:
+    age_file = tmp_path / "file.age"
+    age_file.write_bytes(os.urandom(GCS_FILE_SIZE))
+    provider = UploadProviderGCS.__new__(UploadProviderGCS)
+    provider.listing_index = ListingIndex(DebugProviderModel())
+    provider.chunk_size_bytes = GCS_CHUNK_SIZE
+    provider.chunk_timeout_secs = 1
+    provider.upload_url = "http://upload"
+    provider.bucket = Mock()
+    session = FakeResumableSession(GCS_FILE_SIZE, fail_at=2 * GCS_CHUNK_SIZE)
+    provider.transport = session  # type: ignore[assignment]
+    # Checkpoint left by composite upload is not resumed as resumable session
+    provider.upload_checkpoint(age_file).save(
+        {"kind": "composite", "object_name": "test/env/file", "slices": [0]}
+    )
+
+    with pytest.raises(resumable_media.InvalidResponse):
+        provider._resumable_upload("test/env/file", age_file, GCS_FILE_SIZE)
+    sha256 = provider._resumable_upload("test/env/file", age_file, GCS_FILE_SIZE)
+
+    assert session.data == age_file.read_bytes()
+    assert sha256 == hashlib.sha256(session.data).hexdigest()
+    assert session.offsets == [
+        0,
+        GCS_CHUNK_SIZE,
+        2 * GCS_CHUNK_SIZE,
+        2 * GCS_CHUNK_SIZE,
+        3 * GCS_CHUNK_SIZE,
+    ]
+    assert session.initiated == 1
+    provider.bucket.blob.return_value.delete.assert_not_called()
+
+
+def test_file_slice_reads_only_its_part(age_file: Path) -> None:
+    data = age_file.read_bytes()
+
+    with FileSlice(age_file, offset=PART_SIZE, length=PART_SIZE) as file_slice:
+        assert file_slice.read(10) == data[PART_SIZE : PART_SIZE + 10]
+        assert file_slice.read() == data[PART_SIZE + 10 : 2 * PART_SIZE]
+        assert file_slice.read() == b""
+        assert file_slice.seek(0, os.SEEK_END) == PART_SIZE
+        file_slice.seek(-5, os.SEEK_CUR)
+        assert file_slice.read() == data[2 * PART_SIZE - 5 : 2 * PART_SIZE]
+
+
+def test_gcs_composite_upload_retries_only_failed_slices(
+    age_file: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    from google.cloud.storage import transfer_manager  # noqa: PLC0415
+
+    provider = UploadProviderGCS.__new__(UploadProviderGCS)
+    provider.listing_index = ListingIndex(DebugProviderModel())
+    provider.chunk_size_bytes = PART_SIZE
+    provider.chunk_timeout_secs = 1
+    provider.transfer_workers = 4
+    provider.bucket = Mock()
+    provider.bucket.blob.side_effect = lambda name: Mock(name=name)
+    uploaded: dict[str, bytes] = {}
+    fail_at = ["_ogion_slices/test/env/file.00001"]
+
+    def upload_many(
+        file_blob_pairs: list[tuple[FileSlice, Mock]], **kwargs: Any
+    ) -> list[Exception | None]:
+        results: list[Exception | None] = []
+        for file_slice, blob in file_blob_pairs:
+            if blob._mock_name in fail_at:
+                fail_at.clear()
+                results.append(ConnectionError("connection reset"))
+                continue
+            uploaded[blob._mock_name] = file_slice.read()
+            results.append(None)
+        return results
+
+    upload_many_mock = Mock(side_effect=upload_many)
+    monkeypatch.setattr(transfer_manager, "upload_many", upload_many_mock)
+
+    with pytest.raises(ConnectionError):
+        provider._composite_upload("test/env/file", age_file, FILE_SIZE)
+    provider._composite_upload("test/env/file", age_file, FILE_SIZE)
+
+    first_call, second_call = upload_many_mock.call_args_list
+    assert len(first_call.args[0]) == 4  # noqa: PLR2004
+    ((_, retried_blob),) = second_call.args[0]
+    assert retried_blob._mock_name == "_ogion_slices/test/env/file.00001"
+    assert b"".join(uploaded[name] for name in sorted(uploaded)) == (
+        age_file.read_bytes()
+    )
+    provider.bucket.delete_blobs.assert_called_once()
+
+
+def test_gcs_abort_upload_deletes_uploaded_slices() -> None:
+    provider = UploadProviderGCS.__new__(UploadProviderGCS)
+    provider.chunk_timeout_secs = 1
+    provider.bucket = Mock()
+    provider.bucket.blob.side_effect = lambda name: Mock(name=name)
+
+    provider._abort_upload(
+        {"kind": "composite", "object_name": "test/env/file", "slices": [0, 2]}
+    )
+
+    (deleted,) = provider.bucket.delete_blobs.call_args.args
+    assert [blob._mock_name for blob in deleted] == [
+        "_ogion_slices/test/env/file.00000",
+        "_ogion_slices/test/env/file.00002",
+    ]
+
+
+def _azure_provider(max_concurrency: int) -> UploadProviderAzure:
+    provider = UploadProviderAzure(
+        AzureProviderModel(
+            container_name="container",
+            connect_string=SecretStr(
+                "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+                "AccountKey=a2V5;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+            ),
+            max_concurrency=max_concurrency,
+        )
+    )
+    provider.max_block_size = PART_SIZE
+    return provider
+
+
+class FakeBlobClient:
+    blob_name = "env/file"
+
+    def __init__(self, fail_at: str) -> None:
+        self.fail_at = fail_at
+        self.staged: dict[str, bytes] = {}
+        self.committed = b""
+
+    def stage_block(self, block_id: str, data: bytes) -> None:
+        if block_id == self.fail_at:
+            self.fail_at = ""
+            raise ConnectionError("connection reset")
+        self.staged[block_id] = data
+
+    def get_block_list(self, block_list_type: str) -> tuple[list[Any], list[Any]]:
+        return [], [Mock(id=block_id) for block_id in self.staged]
+
+    def commit_block_list(self, block_list: list[Any], **kwargs: Any) -> None:
+        self.committed = b"".join(self.staged[block.id] for block in block_list)
+        self.metadata = kwargs["metadata"]
+
+
+@pytest.mark.parametrize("max_concurrency", [1, 4])
+def test_azure_block_upload_stages_only_missing_blocks(
+    age_file: Path, monkeypatch: pytest.MonkeyPatch, max_concurrency: int
+) -> None:
+    provider = _azure_provider(max_concurrency)
+    blob_client = FakeBlobClient(fail_at="000002")
+
+    with pytest.raises(ConnectionError):
+        provider._block_upload(blob_client, age_file, FILE_SIZE)
+    stage_spy = Mock(side_effect=blob_client.stage_block)
+    monkeypatch.setattr(blob_client, "stage_block", stage_spy)
+    provider._block_upload(blob_client, age_file, FILE_SIZE)
+
+    restaged = [call.kwargs["block_id"] for call in stage_spy.call_args_list]
+    assert restaged[0] == "000002"
+    assert set(restaged) <= {"000002", "000003"}
+    assert blob_client.committed == age_file.read_bytes()
+    assert blob_client.metadata == {
+        checksum.SHA256_KEY: hashlib.sha256(blob_client.committed).hexdigest()
+    }
+
+
+def test_azure_block_upload_stops_staging_after_failed_block(
+    age_file: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    provider = _azure_provider(max_concurrency=1)
+    blob_client = FakeBlobClient(fail_at="000001")
+    stage_spy = Mock(side_effect=blob_client.stage_block)
+    monkeypatch.setattr(blob_client, "stage_block", stage_spy)
+
+    with pytest.raises(ConnectionError):
+        provider._block_upload(blob_client, age_file, FILE_SIZE)
+
+    staged = [call.kwargs["block_id"] for call in stage_spy.call_args_list]
+    assert staged == ["000000", "000001"]
+
+
+def test_azure_block_upload_stages_blocks_concurrently(
+    age_file: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    provider = _azure_provider(max_concurrency=2)
+    blob_client = FakeBlobClient(fail_at="")
+    # Every stage_block waits for another one, so calls that do not overlap
+    # break the barrier
+    barrier = threading.Barrier(2, timeout=5)
+
+    def stage_block(block_id: str, data: bytes) -> None:
+        barrier.wait()
+        blob_client.staged[block_id] = data
+
+    monkeypatch.setattr(blob_client, "stage_block", stage_block)
+
+    provider._block_upload(blob_client, age_file, 4 * PART_SIZE)
+
+    assert sorted(blob_client.staged) == ["000000", "000001", "000002", "000003"]
@@ -0,0 +1,301 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import base64
+import hashlib
+import io
+import os
+from http import HTTPStatus
+from typing import Any, override
+from unittest.mock import Mock
+
+import pytest
+from google import resumable_media
+from pydantic import SecretStr
+
+from ogion import config
+from ogion.models.upload_provider_models import (
+    AzureProviderModel,
+    DebugProviderModel,
+    S3ProviderModel,
+)
+from ogion.upload_providers import s3
+from ogion.upload_providers.azure import UploadProviderAzure
+from ogion.upload_providers.debug import UploadProviderLocalDebug
+from ogion.upload_providers.google_cloud_storage import UploadProviderGCS
+from ogion.upload_providers.listing_index import ListingIndex
+from ogion.upload_providers.s3 import UploadProviderS3
+from ogion.upload_providers.stream import ChunkedStream
+
+PART_SIZE = 1024
+BACKUP_NAME = "env_20240101_0000_db.lz.age"
+
+
+class PipeStream(io.RawIOBase):
+    """Stream returning short reads like a pipe, failing after fail_after bytes."""
+
+    def __init__(self, data: bytes, fail_after: int = -1) -> None:
+        super().__init__()
+        self.data = data
+        self.position = 0
+        self.fail_after = fail_after
+
+    @override
+    def readable(self) -> bool:
+        return True
+
+    @override
+    def readinto(self, buffer: Any) -> int:
+        if self.position == self.fail_after:
+            raise BrokenPipeError("dump failed")
+        size = min(len(buffer), 100, len(self.data) - self.position)
+        buffer[:size] = self.data[self.position : self.position + size]
+        self.position += size
+        return size
+
+
+@pytest.mark.parametrize(
+    "size,expected",
+    [
+        (0, [(0, True)]),
+        (PART_SIZE - 1, [(PART_SIZE - 1, True)]),
+        (2 * PART_SIZE, [(PART_SIZE, False), (PART_SIZE, True)]),
+        (2 * PART_SIZE + 1, [(PART_SIZE, False), (PART_SIZE, False), (1, True)]),
+    ],
+)
+def test_chunked_stream_fills_chunks_from_short_reads(
+    size: int, expected: list[tuple[int, bool]]
+) -> None:
+    data = os.urandom(size)
+    stream = ChunkedStream(PipeStream(data))  # type: ignore[arg-type]
+
+    chunks = list(stream.chunks(PART_SIZE))
+
+    assert [(len(chunk), is_last) for chunk, is_last in chunks] == expected
+    assert b"".join(chunk for chunk, _ in chunks) == data
+    assert stream.bytes_read == size
+
+
+def test_debug_upload_stream_adds_backup_to_listing() -> None:
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    data = os.urandom(3 * PART_SIZE)
+
+    backup_path = provider.upload_stream(
+        PipeStream(data),  # type: ignore[arg-type]
+        "env",
+        BACKUP_NAME,
+    )
+
+    assert backup_path == str(config.CONST_DEBUG_FOLDER_PATH / "env" / BACKUP_NAME)
+    (entry,) = provider.all_target_entries("env")
+    assert (entry.key, entry.size, entry.sha256) == (
+        backup_path,
+        len(data),
+        hashlib.sha256(data).hexdigest(),
+    )
+    assert provider.download_backup(backup_path).read_bytes() == data
+
+
+def test_debug_upload_stream_removes_partial_backup_on_error() -> None:
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+
+    with pytest.raises(BrokenPipeError):
+        provider.upload_stream(
+            PipeStream(os.urandom(PART_SIZE), fail_after=500),  # type: ignore[arg-type]
+            "env",
+            BACKUP_NAME,
+        )
+
+    assert provider.all_target_backups("env") == []
+
+
+@pytest.fixture
+def s3_provider(monkeypatch: pytest.MonkeyPatch) -> UploadProviderS3:
+    monkeypatch.setattr(s3, "S3_MIN_PART_SIZE", PART_SIZE)
+    provider = UploadProviderS3(
+        S3ProviderModel(
+            bucket_name="bucket",
+            bucket_upload_path="test",
+            access_key="minioadmin",
+            secret_key=SecretStr("minioadmin"),
+        )
+    )
+    for method in [
+        "put_object",
+        "_create_multipart_upload",
+        "_upload_part",
+        "_complete_multipart_upload",
+        "_abort_multipart_upload",
+        "set_object_tags",
+    ]:
+        monkeypatch.setattr(provider.client, method, Mock())
+    provider.client._create_multipart_upload.return_value = "upload_id"  # type: ignore[attr-defined]
+    return provider
+
+
+def test_s3_upload_stream_uploads_parts_as_they_are_read(
+    s3_provider: UploadProviderS3,
+) -> None:
+    data = os.urandom(2 * PART_SIZE + 10)
+    client: Any = s3_provider.client
+
+    backup_path = s3_provider.upload_stream(
+        PipeStream(data),  # type: ignore[arg-type]
+        "env",
+        BACKUP_NAME,
+    )
+
+    assert backup_path == f"test/env/{BACKUP_NAME}"
+    client.put_object.assert_not_called()
+    uploaded = [call.args for call in client._upload_part.call_args_list]
+    assert [args[5] for args in uploaded] == [1, 2, 3]
+    assert b"".join(args[2] for args in uploaded) == data
+    (_, _, upload_id, parts) = client._complete_multipart_upload.call_args.args
+    assert upload_id == "upload_id"
+    assert [part.part_number for part in parts] == [1, 2, 3]
+
+
+def test_s3_upload_stream_puts_small_stream_in_single_request(
+    s3_provider: UploadProviderS3,
+) -> None:
+    client: Any = s3_provider.client
+
+    s3_provider.upload_stream(
+        PipeStream(b"dump"),  # type: ignore[arg-type]
+        "env",
+        BACKUP_NAME,
+    )
+
+    assert client.put_object.call_args.kwargs["data"].read() == b"dump"
+    client._create_multipart_upload.assert_not_called()
+
+
+def test_s3_upload_stream_aborts_multipart_upload_on_error(
+    s3_provider: UploadProviderS3,
+) -> None:
+    client: Any = s3_provider.client
+
+    with pytest.raises(BrokenPipeError):
+        s3_provider.upload_stream(
+            PipeStream(os.urandom(3 * PART_SIZE), fail_after=2 * PART_SIZE),  # type: ignore[arg-type]
+            "env",
+            BACKUP_NAME,
+        )
+
+    client._abort_multipart_upload.assert_called_once_with(
+        "bucket", f"test/env/{BACKUP_NAME}", "upload_id"
+    )
+    client._complete_multipart_upload.assert_not_called()
+
+
+GCS_CHUNK_SIZE = resumable_media.UPLOAD_CHUNK_SIZE
+
+
+class FakeStreamSession:
+    """Resumable session persisting at most max_persisted bytes per request."""
+
+    def __init__(self, max_persisted: int) -> None:
+        self.max_persisted = max_persisted
+        self.data = b""
+        self.content_ranges: list[str] = []
+
+    def request(
+        self, method: str, url: str, data: bytes, headers: dict[str, str], **kwargs: Any
+    ) -> Mock:
+        if method == "POST":
+            return Mock(
+                status_code=HTTPStatus.OK, headers={"location": "http://session"}
+            )
+        content_range = headers["content-range"].removeprefix("bytes ")
+        self.content_ranges.append(content_range)
+        self.data += data[: self.max_persisted]
+        if content_range.endswith("*") or len(self.data) != int(
+            content_range.split("/")[1]
+        ):
+            return Mock(
+                status_code=HTTPStatus.PERMANENT_REDIRECT,
+                headers={"range": f"bytes=0-{len(self.data) - 1}"},
+            )
+        md5_hash = base64.b64encode(hashlib.md5(self.data).digest()).decode()
+        return Mock(
+            status_code=HTTPStatus.OK, json=Mock(return_value={"md5Hash": md5_hash})
+        )
+
+
+C = GCS_CHUNK_SIZE
+
+
+@pytest.mark.parametrize(
+    "size,max_persisted,expected_ranges",
+    [
+        (0, C, ["*/0"]),
+        (
+            2 * C + 10,
+            C,
+            [f"0-{C - 1}/*", f"{C}-{2 * C - 1}/*", f"{2 * C}-{2 * C + 9}/{2 * C + 10}"],
+        ),
+        (2 * C, C, [f"0-{C - 1}/*", f"{C}-{2 * C - 1}/*", f"*/{2 * C}"]),
+        (
+            C + 10,
+            C - 24,
+            [f"0-{C - 1}/*", f"{C - 24}-{C + 9}/{C + 10}"],
+        ),
+    ],
+)
+def test_gcs_upload_stream_sends_total_size_with_last_chunk(
+    size: int, max_persisted: int, expected_ranges: list[str]
+) -> None:
+    provider = UploadProviderGCS.__new__(UploadProviderGCS)
+    provider.listing_index = ListingIndex(DebugProviderModel())
+    provider.bucket_upload_path = "test"
+    provider.chunk_size_bytes = GCS_CHUNK_SIZE
+    provider.chunk_timeout_secs = 1
+    provider.upload_url = "http://upload"
+    provider.bucket = Mock()
+    session = FakeStreamSession(max_persisted)
+    provider.transport = session  # type: ignore[assignment]
+    data = os.urandom(size)
+
+    backup_path = provider.upload_stream(
+        PipeStream(data),  # type: ignore[arg-type]
+        "env",
+        BACKUP_NAME,
+    )
+
+    assert backup_path == f"test/env/{BACKUP_NAME}"
+    assert session.content_ranges == expected_ranges
+    assert session.data == data
+    provider.bucket.blob.return_value.delete.assert_not_called()
+
+
+def test_azure_upload_stream_stages_blocks_as_they_are_read() -> None:
+    provider = UploadProviderAzure(
+        AzureProviderModel(
+            container_name="container",
+            connect_string=SecretStr(
+                "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+                "AccountKey=a2V5;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+            ),
+        )
+    )
+    provider.max_block_size = PART_SIZE
+    blob_client = Mock()
+    blob_client.__enter__ = Mock(return_value=blob_client)
+    blob_client.__exit__ = Mock(return_value=None)
+    provider.container_client = Mock()
+    provider.container_client.get_blob_client.return_value = blob_client
+    data = os.urandom(2 * PART_SIZE + 10)
+
+    backup_path = provider.upload_stream(
+        PipeStream(data),  # type: ignore[arg-type]
+        "env",
+        BACKUP_NAME,
+    )
+
+    assert backup_path == f"env/{BACKUP_NAME}"
+    staged = [call.kwargs for call in blob_client.stage_block.call_args_list]
+    assert [kwargs["block_id"] for kwargs in staged] == ["000000", "000001", "000002"]
+    assert b"".join(kwargs["data"] for kwargs in staged) == data
+    (block_list,) = blob_client.commit_block_list.call_args.args
+    assert [block.id for block in block_list] == ["000000", "000001", "000002"]
+    blob_client.upload_blob.assert_not_called()
@@ -0,0 +1,145 @@
+# Copyright: (c) 2024, Rafał Safin <rafal.safin@rafsaf.pl>
+# GNU General Public License v3.0+ (see LICENSE or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+import gzip
+import os
+from datetime import date, timedelta
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+from pydantic import SecretStr
+
+from ogion import config, core, verify
+from ogion.models.upload_provider_models import DebugProviderModel
+from ogion.upload_providers import checksum
+from ogion.upload_providers.debug import UploadProviderLocalDebug
+
+DATA = os.urandom(3000)
+
+
+def _upload(provider: UploadProviderLocalDebug, name: str, data: bytes) -> str:
+    age_file = config.CONST_DATA_FOLDER_PATH / "env" / name
+    age_file.parent.mkdir(exist_ok=True)
+    age_file.write_bytes(data)
+    return provider.upload(age_file)
+
+
+def _gzip_commands(codec: str, identity_path: Path) -> list[list[str]]:
+    # Neither age nor plzip is needed to check pipeline of decoding processes
+    return [["gzip", "-d"]]
+
+
+def test_in_sample_selects_every_backup_once_in_sample_days() -> None:
+    keys = [f"env/env_202401{day:02}_0000_db.lz.age" for day in range(1, 29)]
+    start = date(2024, 1, 1)
+
+    sampled = [
+        key
+        for offset in range(7)
+        for key in keys
+        if verify.in_sample(key, 7, start + timedelta(days=offset))
+    ]
+
+    assert sorted(sampled) == keys
+    assert all(verify.in_sample(key, 1, start) for key in keys)
+
+
+@pytest.mark.parametrize(
+    "codec,expected",
+    [
+        ("lz.age", [["age", "-d", "-i", "key.txt"], ["plzip", "-d", "-n", "1"]]),
+        ("age", [["age", "-d", "-i", "key.txt"]]),
+        ("", []),
+    ],
+)
+def test_decode_commands(codec: str, expected: list[list[str]]) -> None:
+    assert verify.decode_commands(codec, Path("key.txt")) == expected
+
+
+def test_decode_pipeline_counts_restored_bytes() -> None:
+    with verify.DecodePipeline([["gzip", "-d"], ["cat"]]) as pipeline:
+        compressed = gzip.compress(DATA)
+        pipeline.write(compressed[:100])
+        pipeline.write(compressed[100:])
+        pipeline.close()
+
+    assert pipeline.restored_bytes == len(DATA)
+
+
+def test_decode_pipeline_fails_on_corrupted_stream() -> None:
+    with (
+        pytest.raises(core.CoreSubprocessError, match="gzip failed"),
+        verify.DecodePipeline([["gzip", "-d"]]) as pipeline,
+    ):
+        pipeline.write(b"not gzip" * 100_000)
+        pipeline.close()
+
+
+def test_verify_backup_decodes_stream(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(verify, "decode_commands", _gzip_commands)
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    _upload(provider, "env_20240101_0000_db.lz.age", gzip.compress(DATA))
+    (entry,) = provider.all_target_entries("env")
+
+    verify.verify_backup(provider, entry, identity_path=Path("key.txt"))
+
+
+def test_verify_backup_rejects_changed_backup() -> None:
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    backup_path = _upload(provider, "env_20240101_0000_db.lz.age", DATA)
+    with open(backup_path, "r+b") as file:
+        file.write(b"corrupted")
+    (entry,) = provider.all_target_entries("env")
+
+    with pytest.raises(checksum.ChecksumMismatchError, match="sha256"):
+        verify.verify_backup(provider, entry, identity_path=None)
+
+    with open(backup_path, "ab") as file:
+        file.write(b"appended")
+
+    with pytest.raises(checksum.ChecksumMismatchError, match="size"):
+        verify.verify_backup(provider, entry, identity_path=None)
+
+
+def test_run_verify_reports_all_failed_backups(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(verify, "decode_commands", _gzip_commands)
+    monkeypatch.setattr(config.options, "DEBUG_AGE_SECRET_KEY", "")
+    monkeypatch.setattr(
+        config.options, "VERIFY_AGE_SECRET_KEY", SecretStr("AGE-SECRET-KEY-1")
+    )
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    _upload(provider, "env_20240101_0000_db.lz.age", gzip.compress(DATA))
+    broken_path = _upload(provider, "env_20240102_0000_db.lz.age", DATA)
+
+    with pytest.raises(ExceptionGroup) as exc_info:
+        verify.run_verify(provider, env_names=["env"], workers=2)
+
+    assert str(exc_info.value).startswith("verification of 1 of 2 backups failed")
+    (error,) = exc_info.value.exceptions
+    assert isinstance(error, core.CoreSubprocessError)
+    assert error.__notes__ == [f"backup: {broken_path}"]
+
+
+def test_run_verify_only_sampled_backups(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config.options, "DEBUG_AGE_SECRET_KEY", "")
+    provider = UploadProviderLocalDebug(DebugProviderModel())
+    backup_paths = [
+        _upload(provider, f"env_2024010{day}_0000_db.lz.age", DATA)
+        for day in range(1, 8)
+    ]
+    verify_backup = Mock()
+    monkeypatch.setattr(verify, "verify_backup", verify_backup)
+
+    verified = [
+        verify.run_verify(provider, ["env"], sample_days=3, day=date(2024, 1, day))
+        for day in range(1, 4)
+    ]
+
+    assert sum(verified) == len(backup_paths)
+    assert sorted(call.args[1].key for call in verify_backup.call_args_list) == (
+        sorted(backup_paths)
+    )
+    assert all(call.args[2] is None for call in verify_backup.call_args_list)